@@ -6,18 +6,34 @@ from PIL import Image
 import PyPDF2
 import re
 import pytesseract
-from pdf2image import convert_from_path
 import requests
 from urllib.parse import urlparse
+import hashlib
 import tempfile
+import threading
+import uuid
+from data.ImagePreparer import ImagePreparer
+from data.text_readers import detect_file_type, read_docx, read_html, read_txt
 
 
 class FileReader:
-    """This class is created to read PDF files including machine-readable and non machine-readable."""
+    """
+    This class is created to read PDF files including machine-readable and non machine-readable,
+    images, and DOCX, HTML and plain text files.
+    """
 
-    def __init__(self) -> None:
+    def __init__(self, image_preparer=None) -> None:
+        """
+        Args:
+            image_preparer (ImagePreparer, optional): Renders PDF pages for orientation detection and OCR.
+                Defaults to None, an ImagePreparer with the default settings.
+        """
+        self.image_preparer = image_preparer or ImagePreparer()
         self.pdf_file_types = [".pdf", ".PDF"]
         self.image_file_types = [".jpg", ".jpeg", ".JPG", ".JPEG", ".png", ".PNG"]
+        # Keep-alive sessions, one per download thread since requests.Session isn't thread-safe.
+        # Connections to the same host are reused across the downloads of a thread
+        self.local = threading.local()
 
     def read_pdf(self, path):
         """Reads PDF files using Langchain's UnstructuredFileLoader
@@ -38,7 +54,9 @@ class FileReader:
 
     def read_contract(self, filepath):
         """
-        Reads a contract file from the specified sub-folder path and filename.
+        Reads a contract file from the specified sub-folder path and filename. The format is detected
+        from the content of the file. DOCX, HTML and plain text files are read natively, without
+        UnstructuredFileLoader or OCR. Scanned PDFs, without a text layer, are OCRed with ocr_pdf.
 
         Args:
             filepath (str): The path to the contract file.
@@ -49,12 +67,22 @@ class FileReader:
         Raises:
             ValueError: If the file type is not supported or if a PDF file requires rotating.
         """
-        if any(filepath.endswith(file_type) for file_type in self.pdf_file_types):
-            orients = self.detect_pdf_orientation(filepath)
+        file_type = detect_file_type(filepath)
+        if file_type == "docx":
+            return read_docx(filepath)
+        elif file_type == "html":
+            return read_html(filepath)
+        elif file_type == "txt":
+            return read_txt(filepath)
+        elif file_type == "pdf":
+            orients, ocr_dpis = self.scan_pdf_pages(filepath)
             if 180 in orients:
                 raise ValueError("Rotation for PDF not supported: " + filepath)
+            if not self.has_text_layer(filepath):
+                # Scanned PDF, OCR on pages rendered by the image preparer
+                return self.ocr_pdf(filepath, ocr_dpis)
             return self.read_pdf(filepath)
-        elif any(filepath.endswith(file_type) for file_type in self.image_file_types):
+        elif file_type == "image":
             orients = self.detect_image_orientation(filepath)
             if 180 in orients:
                 print(
@@ -128,17 +156,83 @@ class FileReader:
         Returns:
             list: list of orientations of each page
         """
-        images = convert_from_path(file_path)
+        return self.scan_pdf_pages(file_path)[0]
+
+    def scan_pdf_pages(self, file_path):
+        """
+        Detects the orientation of every page of a PDF, and chooses its OCR DPI from the same render.
+
+        A low DPI grayscale render is enough to detect the orientation of most pages. When tesseract
+        fails on it, e.g. with too few characters on a sparse page, the page is rendered again at the
+        lowest OCR DPI, and is taken as upright if that fails too.
 
+        Args:
+            file_path (str): path to file
+
+        Returns:
+            tuple[list[int], list[int]]: The orientation and the OCR DPI of each page.
+        """
+        preparer = self.image_preparer
         orients = []
-        for image in images:
-            image = image.convert("RGB")
-            image = image.crop((0, 0, image.size[0], image.size[1] // 2))
+        dpis = []
+        for page, image in enumerate(preparer.iter_osd_pages(file_path), start=1):
+            dpis.append(preparer.choose_ocr_dpi(image, preparer.osd_dpi))
+            try:
+                orients.append(self._detect_orientation(image))
+                continue
+            except pytesseract.TesseractError:
+                pass
+            image = preparer.render_for_osd(
+                file_path, page, page, dpi=preparer.min_ocr_dpi
+            )[0]
+            try:
+                orients.append(self._detect_orientation(image))
+            except pytesseract.TesseractError as e:
+                print(f"Orientation of page {page} not detected, taken as 0: {e}")
+                orients.append(0)
+        return orients, dpis
+
+    def _detect_orientation(self, image):
+        # The top half of the page holds enough text, and OSD is faster on it
+        image = image.crop((0, 0, image.size[0], image.size[1] // 2))
+        osd = pytesseract.image_to_osd(image)
+        return int(re.search("(?<=Rotate: )\d+", osd).group(0))
+
+    def has_text_layer(self, filepath, max_pages=3, min_chars_per_page=20):
+        """
+        Checks whether a PDF is machine-readable, from the text of its first pages.
 
-            # Detect the orientation of the image using pytesseract
-            osd = pytesseract.image_to_osd(image)
-            orients.append(int(re.search("(?<=Rotate: )\d+", osd).group(0)))
-        return orients
+        Args:
+            filepath (str): path to file
+            max_pages (int, optional): The number of pages checked. Defaults to 3.
+            min_chars_per_page (int, optional): The fewest characters per page of a text layer. Defaults to 20.
+
+        Returns:
+            bool: False if the PDF is scanned.
+        """
+        reader = PyPDF2.PdfReader(filepath)
+        pages = reader.pages[:max_pages]
+        if not pages:
+            return False
+        chars = sum(len((page.extract_text() or "").strip()) for page in pages)
+        return chars >= min_chars_per_page * len(pages)
+
+    def ocr_pdf(self, filepath, dpis=None):
+        """
+        Reads a scanned PDF with tesseract, rendering each page at the DPI chosen by the image preparer.
+
+        Args:
+            filepath (str): path to file
+            dpis (list[int], optional): The OCR DPI of each page, see scan_pdf_pages. Defaults to None,
+                chosen by the image preparer from a preview.
+
+        Returns:
+            str: The text of the pages, separated by form feeds.
+        """
+        return "\f".join(
+            pytesseract.image_to_string(image)
+            for image in self.image_preparer.iter_ocr_pages(filepath, dpis=dpis)
+        )
 
     def delete_local_file(self, filepath):
         """
@@ -152,9 +246,48 @@ class FileReader:
         """
         os.remove(filepath)
 
+    def hash_file(self, filepath):
+        """
+        Computes the SHA-256 of a file's content.
+
+        Args:
+            filepath (str): The path to the file.
+
+        Returns:
+            str: The hex digest of the content.
+        """
+        sha = hashlib.sha256()
+        with open(filepath, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def get_session(self):
+        """Returns the requests session of the current thread."""
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        return session
+
+    def read_url_bytes(self, url):
+        """
+        Downloads a file into memory.
+
+        Args:
+            url (str): The URL of the file.
+
+        Returns:
+            bytes: The content of the file.
+        """
+        response = self.get_session().get(url)
+        response.raise_for_status()
+        return response.content
+
     def read_url(self, url):
         # Get URL
-        response = requests.get(url)
+        response = self.get_session().get(url)
+        # Error pages would be read as contracts
+        response.raise_for_status()
 
         # Create a temporary file in the system's temp directory
         # temp_file = tempfile.NamedTemporaryFile(delete=False)
@@ -167,15 +300,28 @@ class FileReader:
         filename = os.path.basename(a.path)
 
         # Save file
-        if not os.path.exists("./tmp"):
-            os.makedirs("./tmp")
-        filepath = "./tmp/" + filename
+        os.makedirs("./tmp", exist_ok=True)
+        # Prefix with a unique id, concurrent downloads may share a filename
+        filepath = "./tmp/" + uuid.uuid4().hex + "_" + filename
         with open(filepath, "wb") as f:
             f.write(response.content)
         return filepath
 
     def read_contract_from_url(self, url):
         temp_file_path = self.read_url(url)
-        contract = self.read_contract(temp_file_path)
-        os.remove(temp_file_path)  # Delete the temp file
-        return contract
+        return self.read_contract_and_delete(temp_file_path)
+
+    def read_contract_and_delete(self, filepath):
+        """
+        Reads a downloaded contract file and deletes it afterwards.
+
+        Args:
+            filepath (str): The path to the contract file.
+
+        Returns:
+            The content of the contract file.
+        """
+        try:
+            return self.read_contract(filepath)
+        finally:
+            os.remove(filepath)  # Delete the temp file
@@ -0,0 +1,301 @@
+import re
+
+import numpy as np
+from PIL import Image
+from pdf2image import convert_from_path, pdfinfo_from_path
+
+# Pixels of a page rendered for OCR, about an A4 page at 300 DPI
+MAX_OCR_PIXELS = 9_000_000
+# Share of dark pixels above which a page is considered dense (small fonts, tables)
+DENSE_TEXT_INK_RATIO = 0.08
+# Page size assumed when pdfinfo doesn't report it, A4 in points
+DEFAULT_PAGE_SIZE_POINTS = (595, 842)
+
+
+class ImagePreparer:
+    """
+    Renders PDF pages to images for orientation detection and OCR.
+
+    Orientation detection only needs a small grayscale render. For OCR, every page is rendered at the
+    lowest DPI that keeps its text readable: pages with dense text get max_ocr_dpi, the others min_ocr_dpi,
+    and large pages are capped at MAX_OCR_PIXELS. Tesseract's time grows with the number of pixels.
+
+    The iter_ methods render a window of pages at a time and yield them one by one, so that the memory
+    used by a document doesn't grow with its number of pages. The window is as large as fits in
+    max_window_bytes, at least one page.
+
+    Args:
+        osd_dpi (int, optional): The DPI of the orientation detection render. Defaults to 100.
+        min_ocr_dpi (int, optional): The DPI of pages with sparse text. Defaults to 200.
+        max_ocr_dpi (int, optional): The DPI of pages with dense text. Defaults to 300.
+        grayscale (bool, optional): Whether OCR images are rendered in grayscale. Defaults to True.
+        binarize (bool, optional): Whether OCR images are binarized with Otsu's threshold. Defaults to False.
+        deskew (bool, optional): Whether OCR images are straightened (up to max_skew_angle degrees). Defaults to False.
+        max_skew_angle (float, optional): The largest corrected skew in degrees. Defaults to 5.
+        thread_count (int, optional): Number of poppler processes rendering pages. Defaults to 4.
+        max_window_bytes (int, optional): Memory of the pages rendered at the same time. Defaults to 256 MB.
+    """
+
+    def __init__(
+        self,
+        osd_dpi=100,
+        min_ocr_dpi=200,
+        max_ocr_dpi=300,
+        grayscale=True,
+        binarize=False,
+        deskew=False,
+        max_skew_angle=5,
+        thread_count=4,
+        max_window_bytes=256 * 1024 * 1024,
+    ):
+        if min_ocr_dpi > max_ocr_dpi:
+            raise ValueError("min_ocr_dpi must not be greater than max_ocr_dpi.")
+        self.osd_dpi = osd_dpi
+        self.min_ocr_dpi = min_ocr_dpi
+        self.max_ocr_dpi = max_ocr_dpi
+        self.grayscale = grayscale
+        self.binarize = binarize
+        self.deskew = deskew
+        self.max_skew_angle = max_skew_angle
+        self.thread_count = thread_count
+        self.max_window_bytes = max_window_bytes
+
+    def render_for_osd(self, pdf_path, first_page=None, last_page=None, dpi=None):
+        """
+        Renders the pages of a PDF at a low DPI in grayscale, for orientation detection.
+
+        Args:
+            pdf_path (str): The path to the PDF file.
+            first_page (int, optional): The first page to render (1-based). Defaults to None, the first page.
+            last_page (int, optional): The last page to render. Defaults to None, the last page.
+            dpi (int, optional): Defaults to None, osd_dpi.
+
+        Returns:
+            list[PIL.Image.Image]: The rendered pages.
+        """
+        return convert_from_path(
+            pdf_path,
+            dpi=dpi or self.osd_dpi,
+            grayscale=True,
+            thread_count=self.thread_count,
+            first_page=first_page,
+            last_page=last_page,
+        )
+
+    def ink_ratio(self, image):
+        """Returns the share of dark pixels of a page image, a proxy for its text density."""
+        pixels = np.asarray(image.convert("L"))
+        return float((pixels < 128).mean())
+
+    def choose_ocr_dpi(self, preview, preview_dpi):
+        """
+        Chooses the OCR DPI of a page from its size and text density.
+
+        Args:
+            preview (PIL.Image.Image): A render of the page, e.g. from render_for_osd.
+            preview_dpi (int): The DPI of the preview.
+
+        Returns:
+            int: The DPI to render the page at for OCR.
+        """
+        if self.ink_ratio(preview) >= DENSE_TEXT_INK_RATIO:
+            dpi = self.max_ocr_dpi
+        else:
+            dpi = self.min_ocr_dpi
+
+        width_inches = preview.size[0] / preview_dpi
+        height_inches = preview.size[1] / preview_dpi
+        max_dpi_for_size = int((MAX_OCR_PIXELS / (width_inches * height_inches)) ** 0.5)
+        return max(min(dpi, max_dpi_for_size), 72)
+
+    def prepare_for_ocr(self, image):
+        """
+        Applies the configured grayscale conversion, deskewing and binarization to a page image.
+
+        Args:
+            image (PIL.Image.Image): The page image.
+
+        Returns:
+            PIL.Image.Image: The prepared image.
+        """
+        if self.grayscale or self.binarize or self.deskew:
+            image = image.convert("L")
+        if self.deskew:
+            angle = self.estimate_skew(image)
+            if angle != 0:
+                image = image.rotate(
+                    angle, resample=Image.BILINEAR, expand=True, fillcolor=255
+                )
+        if self.binarize:
+            threshold = otsu_threshold(image)
+            image = image.point(lambda pixel: 255 if pixel > threshold else 0)
+        return image
+
+    def estimate_skew(self, image, step=0.5):
+        """
+        Estimates the skew of a page with the projection profile method: text lines are horizontal
+        when the row sums of the dark pixels vary the most.
+
+        Args:
+            image (PIL.Image.Image): The grayscale page image.
+            step (float, optional): The angle resolution in degrees. Defaults to 0.5.
+
+        Returns:
+            float: The angle in degrees to rotate the image by (counter-clockwise).
+        """
+        # The angle doesn't depend on the resolution, estimate on a small copy
+        scale = min(1.0, 1000 / max(image.size))
+        small = image.resize(
+            (max(int(image.size[0] * scale), 1), max(int(image.size[1] * scale), 1))
+        )
+        threshold = otsu_threshold(small)
+        ink = small.point(lambda pixel: 255 if pixel <= threshold else 0)
+
+        best_angle, best_score = 0.0, -1.0
+        for angle in np.arange(
+            -self.max_skew_angle, self.max_skew_angle + step / 2, step
+        ):
+            rotated = np.asarray(ink.rotate(float(angle), fillcolor=0))
+            score = float(rotated.sum(axis=1, dtype=np.float64).var())
+            if score > best_score:
+                best_angle, best_score = float(angle), score
+        return best_angle
+
+    def page_window(self, pdf_path, dpi, channels):
+        """
+        Computes the number of pages of a PDF and how many of them fit in max_window_bytes.
+
+        Args:
+            pdf_path (str): The path to the PDF file.
+            dpi (int): The DPI the pages are rendered at.
+            channels (int): The bytes per pixel, 1 for grayscale and 3 for RGB.
+
+        Returns:
+            tuple[int, int]: The number of pages and the number of pages per window.
+        """
+        info = pdfinfo_from_path(pdf_path)
+        # pdfinfo reports the size of the first page, e.g. "595.276 x 841.89 pts (A4)"
+        match = re.match(r"([\d.]+) x ([\d.]+)", str(info.get("Page size", "")))
+        if match:
+            width_points, height_points = float(match.group(1)), float(match.group(2))
+        else:
+            width_points, height_points = DEFAULT_PAGE_SIZE_POINTS
+        page_bytes = (width_points / 72 * dpi) * (height_points / 72 * dpi) * channels
+        return info["Pages"], max(1, int(self.max_window_bytes // page_bytes))
+
+    def _page_ranges(self, pdf_path, dpi, channels, first_page, last_page):
+        num_pages, window = self.page_window(pdf_path, dpi, channels)
+        first_page = first_page or 1
+        last_page = min(last_page or num_pages, num_pages)
+        for start in range(first_page, last_page + 1, window):
+            yield start, min(start + window - 1, last_page)
+
+    def iter_osd_pages(self, pdf_path, first_page=None, last_page=None):
+        """
+        Renders the pages of a PDF like render_for_osd, a window of pages at a time.
+
+        Args:
+            pdf_path (str): The path to the PDF file.
+            first_page (int, optional): The first page to render (1-based). Defaults to None, the first page.
+            last_page (int, optional): The last page to render. Defaults to None, the last page.
+
+        Yields:
+            PIL.Image.Image: The rendered pages, in order.
+        """
+        for start, end in self._page_ranges(
+            pdf_path, self.osd_dpi, 1, first_page, last_page
+        ):
+            yield from self.render_for_osd(pdf_path, start, end)
+
+    def iter_ocr_pages(self, pdf_path, first_page=None, last_page=None, dpis=None):
+        """
+        Renders the pages of a PDF for OCR, each at its chosen DPI, a window of pages at a time.
+        Consecutive pages with the same DPI are rendered together, so that poppler renders them in parallel.
+
+        Args:
+            pdf_path (str): The path to the PDF file.
+            first_page (int, optional): The first page to render (1-based). Defaults to None, the first page.
+            last_page (int, optional): The last page to render. Defaults to None, the last page.
+            dpis (list[int], optional): The OCR DPI of every page of the PDF from the first one, e.g. chosen
+                from the orientation detection renders. Defaults to None, chosen from a preview of each window.
+
+        Yields:
+            PIL.Image.Image: The prepared images of the pages, in order.
+        """
+        channels = 1 if self.grayscale else 3
+        for window_start, window_end in self._page_ranges(
+            pdf_path, self.max_ocr_dpi, channels, first_page, last_page
+        ):
+            if dpis is not None:
+                window_dpis = dpis[window_start - 1 : window_end]
+            else:
+                previews = self.render_for_osd(pdf_path, window_start, window_end)
+                window_dpis = [
+                    self.choose_ocr_dpi(preview, self.osd_dpi) for preview in previews
+                ]
+                del previews
+
+            start = 0
+            while start < len(window_dpis):
+                end = start
+                while (
+                    end + 1 < len(window_dpis)
+                    and window_dpis[end + 1] == window_dpis[start]
+                ):
+                    end += 1
+                pages = convert_from_path(
+                    pdf_path,
+                    dpi=window_dpis[start],
+                    grayscale=self.grayscale,
+                    thread_count=self.thread_count,
+                    first_page=window_start + start,
+                    last_page=window_start + end,
+                )
+                # Release every page once it is consumed
+                pages.reverse()
+                while pages:
+                    yield self.prepare_for_ocr(pages.pop())
+                start = end + 1
+
+    def render_for_ocr(self, pdf_path, first_page=None, last_page=None):
+        """
+        Renders the pages of a PDF for OCR, see iter_ocr_pages. All pages are kept in memory, prefer
+        iter_ocr_pages for long documents.
+
+        Args:
+            pdf_path (str): The path to the PDF file.
+            first_page (int, optional): The first page to render (1-based). Defaults to None, the first page.
+            last_page (int, optional): The last page to render. Defaults to None, the last page.
+
+        Returns:
+            list[PIL.Image.Image]: The prepared images of the pages.
+        """
+        return list(self.iter_ocr_pages(pdf_path, first_page, last_page))
+
+
+def otsu_threshold(image):
+    """
+    Computes Otsu's threshold of a grayscale image, the gray level that best separates text and background.
+
+    Args:
+        image (PIL.Image.Image): The grayscale image.
+
+    Returns:
+        int: The threshold, pixels above it are background.
+    """
+    histogram = np.asarray(image.histogram()[:256], dtype=np.float64)
+    total = histogram.sum()
+    if total == 0:
+        return 127
+    levels = np.arange(256)
+    weight_background = np.cumsum(histogram)
+    weight_foreground = total - weight_background
+    cumulative_mean = np.cumsum(histogram * levels)
+    mean_background = cumulative_mean / np.maximum(weight_background, 1)
+    mean_foreground = (cumulative_mean[-1] - cumulative_mean) / np.maximum(
+        weight_foreground, 1
+    )
+    between_variance = (
+        weight_background * weight_foreground * (mean_background - mean_foreground) ** 2
+    )
+    return int(np.argmax(between_variance))
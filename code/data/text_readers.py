@@ -0,0 +1,215 @@
+"""
+Native readers of text-based contract formats. They return the same shape as UnstructuredFileLoader:
+the text elements (paragraphs, headings, table cells) separated by blank lines.
+"""
+
+import re
+import zipfile
+from html.parser import HTMLParser
+from xml.etree import ElementTree
+
+WORD_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+# Elements of HTML that start a new text element
+HTML_BLOCK_TAGS = {
+    "address",
+    "article",
+    "aside",
+    "blockquote",
+    "br",
+    "dd",
+    "div",
+    "dl",
+    "dt",
+    "fieldset",
+    "figcaption",
+    "figure",
+    "footer",
+    "form",
+    "h1",
+    "h2",
+    "h3",
+    "h4",
+    "h5",
+    "h6",
+    "header",
+    "hr",
+    "li",
+    "main",
+    "nav",
+    "ol",
+    "p",
+    "pre",
+    "section",
+    "table",
+    "td",
+    "th",
+    "tr",
+    "ul",
+}
+HTML_SKIPPED_TAGS = {"head", "script", "style", "noscript", "template"}
+
+
+def detect_file_type(filepath):
+    """
+    Detects the format of a file from its first bytes, regardless of its extension.
+
+    Args:
+        filepath (str): The path to the file.
+
+    Returns:
+        str: "pdf", "image", "docx", "html" or "txt", None if the format is not supported. XML and
+        JSON files, typically error bodies of failed downloads, are not supported.
+    """
+    with open(filepath, "rb") as f:
+        head = f.read(4096)
+
+    if head.startswith(b"%PDF"):
+        return "pdf"
+    if head.startswith(b"\x89PNG\r\n\x1a\n") or head.startswith(b"\xff\xd8\xff"):
+        return "image"
+    if head.startswith(b"PK\x03\x04"):
+        try:
+            with zipfile.ZipFile(filepath) as archive:
+                if "word/document.xml" in archive.namelist():
+                    return "docx"
+        except zipfile.BadZipFile:
+            pass
+        return None
+    if b"\x00" in head:
+        return None
+
+    try:
+        text = head.decode("utf-8")
+    except UnicodeDecodeError as e:
+        if e.start >= len(head) - 3:
+            # A multi-byte character cut at the end of the read bytes
+            text = head[: e.start].decode("utf-8")
+        else:
+            text = head.decode("cp1252", "replace")
+    start = text.lstrip("\ufeff \t\r\n")[:1024].lower()
+    if "<html" in start or (
+        # Exported fragments without the <html> element
+        start.startswith("<")
+        and re.search(r"<(body|head|div|p|table|span|h[1-6])\b", start)
+    ):
+        return "html"
+    if start.startswith("<"):
+        # XML that isn't HTML, e.g. the error body of an S3 or API download
+        return None
+    if re.match(r"[{\[]\s*[\"{\[\]}]", start):
+        # JSON, e.g. the error body of an API
+        return None
+    return "txt" if _is_printable(text) else None
+
+
+def _is_printable(text):
+    control = sum(1 for c in text if ord(c) < 32 and c not in "\t\r\n\f")
+    return control <= len(text) * 0.01
+
+
+def decode_text(data):
+    """Decodes bytes as UTF-8, or as Windows-1252 (common in exported contracts) if they aren't UTF-8."""
+    try:
+        return data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return data.decode("cp1252", "replace")
+
+
+def join_elements(elements):
+    """Normalizes the whitespace of each text element and separates them by blank lines."""
+    elements = (re.sub(r"[ \t\r\f\v]+", " ", element).strip() for element in elements)
+    return "\n\n".join(element for element in elements if element)
+
+
+def read_txt(filepath):
+    """
+    Reads a plain text file, paragraphs are separated by blank lines.
+
+    Args:
+        filepath (str): The path to the file.
+
+    Returns:
+        str: The text of the file.
+    """
+    with open(filepath, "rb") as f:
+        text = decode_text(f.read())
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return join_elements(re.split(r"\n\s*\n", text))
+
+
+def read_docx(filepath):
+    """
+    Reads the paragraphs of a DOCX file, including those of its tables, in document order.
+
+    Args:
+        filepath (str): The path to the file.
+
+    Returns:
+        str: The text of the file.
+    """
+    with zipfile.ZipFile(filepath) as archive:
+        root = ElementTree.fromstring(archive.read("word/document.xml"))
+
+    paragraphs = []
+    for paragraph in root.iter(WORD_NAMESPACE + "p"):
+        parts = []
+        for element in paragraph.iter():
+            if element.tag == WORD_NAMESPACE + "t":
+                parts.append(element.text or "")
+            elif element.tag == WORD_NAMESPACE + "tab":
+                parts.append("\t")
+            elif element.tag in (WORD_NAMESPACE + "br", WORD_NAMESPACE + "cr"):
+                parts.append("\n")
+        paragraphs.append("".join(parts))
+    return join_elements(paragraphs)
+
+
+class _HTMLTextParser(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.elements = []
+        self.current = []
+        self.skipped_depth = 0
+
+    def _flush(self):
+        if self.current:
+            self.elements.append("".join(self.current))
+            self.current = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in HTML_SKIPPED_TAGS:
+            self.skipped_depth += 1
+        elif tag in HTML_BLOCK_TAGS:
+            self._flush()
+
+    def handle_endtag(self, tag):
+        if tag in HTML_SKIPPED_TAGS:
+            self.skipped_depth = max(self.skipped_depth - 1, 0)
+        elif tag in HTML_BLOCK_TAGS:
+            self._flush()
+
+    def handle_data(self, data):
+        if self.skipped_depth == 0:
+            # Line breaks in the source are spaces in the rendered text
+            self.current.append(data.replace("\n", " "))
+
+
+def read_html(filepath):
+    """
+    Reads the visible text of an HTML file, each block element (paragraph, heading, list item,
+    table cell...) is a text element.
+
+    Args:
+        filepath (str): The path to the file.
+
+    Returns:
+        str: The text of the file.
+    """
+    with open(filepath, "rb") as f:
+        html = decode_text(f.read())
+    parser = _HTMLTextParser()
+    parser.feed(html)
+    parser.close()
+    parser._flush()
+    return join_elements(parser.elements)
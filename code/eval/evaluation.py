@@ -109,3 +109,44 @@ def evaluate_number_similarity(
         return True
     else:
         return False
+
+
+def evaluate_prediction(
+    ground_truth,
+    prediction,
+    distance_evaluator,
+    string_distance_threshold: float = 0.1,
+    number_distance_threshold: float = 0,
+) -> bool:
+    """
+    Evaluates a parsed output against its ground truth: N/A outputs are wrong (unless the ground truth
+    is N/A too), strings are compared with evaluate_string_similarity and numbers with
+    evaluate_number_similarity.
+
+    Args:
+        ground_truth: The expected value, "N/A" if the information is not in the document.
+        prediction: The parsed output.
+        distance_evaluator: The string distance evaluator.
+        string_distance_threshold (float, optional): Defaults to 0.1.
+        number_distance_threshold (float, optional): Defaults to 0.
+
+    Returns:
+        bool: True if the prediction is correct.
+
+    Raises:
+        ValueError: If the type of the prediction is not supported.
+    """
+    if prediction == "N/A" or ground_truth == "N/A":
+        return prediction == ground_truth
+    elif type(prediction) == str:
+        return evaluate_string_similarity(
+            str(ground_truth), prediction, distance_evaluator, string_distance_threshold
+        )
+    elif type(prediction) == int or type(prediction) == float:
+        return evaluate_number_similarity(
+            float(ground_truth), prediction, number_distance_threshold
+        )
+    else:
+        raise ValueError(
+            f"Output type {type(prediction)} not supported for evaluation."
+        )
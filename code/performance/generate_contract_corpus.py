@@ -0,0 +1,588 @@
+"""
+Generates a reproducible corpus of synthetic employment contracts with known ground truth for every
+question of question_id_list.json, to benchmark OCR, orientation detection, extraction throughput and
+accuracy without real documents.
+
+Each contract is written in the requested forms, one folder per form:
+    txt/: Plain text, the corpus format of prompt_benchmark.py.
+    pdf/: Machine-readable PDFs with a text layer.
+    scanned/: Image-only PDFs of the rendered pages, with noise, skew, and pages turned sideways or
+        upside down.
+    images/: The first page of each contract as a PNG or JPEG photo-like scan.
+
+Every folder has a labels.csv with a "filename" column and one column per questionid ("N/A" if the
+information is not in the file). The scanned/ and images/ folders also have a pages.csv with the
+rotation tesseract's OSD should report for each page ("Rotate: N") and the skew angle.
+
+    python generate_contract_corpus.py --contracts 200 --output ../../data/synthetic_corpus
+    # Longer scanned contracts only, a third of the pages upside down
+    python generate_contract_corpus.py --forms scanned --min-pages 8 --max-pages 20 --upside-down-rate 0.33
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import textwrap
+
+import numpy as np
+import pandas as pd
+from PIL import Image, ImageDraw, ImageFilter, ImageFont
+
+QUESTION_ID_LIST_FILE = "../serve/question_id_list.json"
+FORMS = ("txt", "pdf", "scanned", "images")
+# Width and height in points
+PAGE_SIZES = {"a4": (595, 842), "letter": (612, 792)}
+MARGIN = 72
+FONT_SIZE = 11
+LINE_HEIGHT = 1.45
+
+EMPLOYERS = [
+    "Nordwind Logistics GmbH",
+    "Bergmann & Söhne KG",
+    "Helios Software Solutions AG",
+    "Alpenblick Hotels GmbH",
+    "Kranich Engineering GmbH",
+    "Meridian Health Services Ltd.",
+    "Rheinland Retail GmbH & Co. KG",
+    "BlueHarbor Consulting Ltd.",
+]
+FIRST_NAMES = ["Anna", "Lukas", "Sophie", "Jonas", "Marie", "Felix", "Elena", "Paul"]
+LAST_NAMES = ["Becker", "Schneider", "Wagner", "Hoffmann", "Novak", "Fischer", "Klein"]
+STREETS = [
+    "Hauptstraße",
+    "Lindenallee",
+    "Gartenweg",
+    "Bahnhofstraße",
+    "Mühlenweg",
+    "Schillerplatz",
+]
+CITIES = [
+    ("10115", "Berlin"),
+    ("20095", "Hamburg"),
+    ("80331", "München"),
+    ("50667", "Köln"),
+    ("60311", "Frankfurt am Main"),
+    ("70173", "Stuttgart"),
+]
+JOB_TITLES = [
+    "Software Developer",
+    "Warehouse Supervisor",
+    "Accountant",
+    "Sales Representative",
+    "Registered Nurse",
+    "Project Manager",
+    "Customer Service Agent",
+    "Mechanical Engineer",
+]
+# Notice period in months and how the contract states it
+NOTICE_PERIODS = [
+    (1.0, "one month"),
+    (1.5, "six weeks"),
+    (2.0, "two months"),
+    (3.0, "three months"),
+    (6.0, "six months"),
+]
+MONTH_NAMES = [
+    "January",
+    "February",
+    "March",
+    "April",
+    "May",
+    "June",
+    "July",
+    "August",
+    "September",
+    "October",
+    "November",
+    "December",
+]
+FILLER_CLAUSES = [
+    "Working Hours. The regular working time is {hours} hours per week. The distribution of the "
+    "working time over the days of the week is determined by the Employer in line with operational "
+    "requirements. Overtime shall be compensated by time off in lieu.",
+    "Vacation. The Employee is entitled to {vacation} working days of paid vacation per calendar year. "
+    "Vacation shall be requested in writing and approved by the Employer in due time.",
+    "Sickness. The Employee shall inform the Employer of any incapacity to work and its expected "
+    "duration without undue delay. A medical certificate is required from the third day of illness.",
+    "Confidentiality. The Employee shall keep secret all business and trade secrets of the Employer "
+    "which become known to the Employee during the employment, also after its termination.",
+    "Secondary Employment. Any secondary employment requires the prior written consent of the "
+    "Employer, which shall not be refused without good reason.",
+    "Data Protection. The Employer processes the personal data of the Employee only as far as this is "
+    "necessary for the performance of the employment relationship and in accordance with the law.",
+    "Expenses. Travel and other business expenses are reimbursed according to the internal travel "
+    "policy of the Employer in its current version, against submission of the original receipts.",
+    "Exclusion Period. All claims arising from the employment relationship lapse if they are not "
+    "asserted in writing within three months after they become due.",
+    "Amendments. Amendments and supplements to this contract must be made in writing. This also "
+    "applies to any waiver of the written form requirement.",
+    "Severability. Should any provision of this contract be or become invalid, the validity of the "
+    "remaining provisions shall not be affected. The invalid provision shall be replaced by a valid "
+    "provision that comes closest to the economic purpose of the invalid one.",
+]
+
+
+def random_date(rng, start_year, end_year):
+    start = datetime.date(start_year, 1, 1)
+    days = (datetime.date(end_year, 12, 31) - start).days
+    return start + datetime.timedelta(days=rng.randint(0, days))
+
+
+def format_label_date(date):
+    return date.strftime("%d.%m.%Y")
+
+
+def format_text_date(rng, date):
+    """Writes a date in one of the formats found in contracts."""
+    style = rng.choice(["numeric", "day_month", "month_day"])
+    if style == "numeric":
+        return date.strftime("%d.%m.%Y")
+    if style == "day_month":
+        return f"{date.day} {MONTH_NAMES[date.month - 1]} {date.year}"
+    return f"{MONTH_NAMES[date.month - 1]} {date.day}, {date.year}"
+
+
+def random_address(rng):
+    postcode, city = rng.choice(CITIES)
+    return f"{rng.choice(STREETS)} {rng.randint(1, 120)}, {postcode} {city}"
+
+
+def generate_contract(rng, missing_rate):
+    """
+    Generates the text of a contract and its ground truth.
+
+    Args:
+        rng (random.Random): The random generator.
+        missing_rate (float): The probability that each optional field (birth date, salary, notice
+            period) is left out of the contract.
+
+    Returns:
+        tuple[list[tuple[str, set]], dict]: The paragraphs of the contract with the questionids
+        each paragraph states, and the ground truth of each questionid.
+    """
+    employee = f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+    start_date = random_date(rng, 2019, 2025)
+    truth = {
+        "employer_name": rng.choice(EMPLOYERS),
+        "address_employer": random_address(rng),
+        "address_employee": random_address(rng),
+        "birth_date": format_label_date(random_date(rng, 1960, 2002)),
+        "job_title": rng.choice(JOB_TITLES),
+        "type_of_contract": rng.choice(["permanent", "fixed-term"]),
+        "start_date": format_label_date(start_date),
+        "sign_date": format_label_date(
+            start_date - datetime.timedelta(days=rng.randint(7, 60))
+        ),
+    }
+    notice_months, notice_text = rng.choice(NOTICE_PERIODS)
+    truth["notice_period"] = str(notice_months)
+    if rng.random() < 0.5:
+        amount = rng.randrange(30000, 120000, 500)
+        truth["annual_gross_salary"] = f"{amount}/year"
+        salary_text = f"an annual gross salary of EUR {amount:,}"
+    else:
+        amount = rng.randrange(2500, 10000, 50)
+        truth["annual_gross_salary"] = f"{amount}/month"
+        salary_text = f"a monthly gross salary of EUR {amount:,}"
+    for questionid in ("birth_date", "annual_gross_salary", "notice_period"):
+        if rng.random() < missing_rate:
+            truth[questionid] = "N/A"
+
+    def date_text(questionid):
+        return format_text_date(
+            rng, datetime.datetime.strptime(truth[questionid], "%d.%m.%Y").date()
+        )
+
+    paragraphs = [
+        ("EMPLOYMENT CONTRACT", set()),
+        (
+            f"between {truth['employer_name']}, {truth['address_employer']} "
+            f'(hereinafter "the Employer")',
+            {"employer_name", "address_employer"},
+        ),
+    ]
+    if truth["birth_date"] != "N/A":
+        paragraphs.append(
+            (
+                f"and {employee}, born on {date_text('birth_date')}, residing at "
+                f'{truth["address_employee"]} (hereinafter "the Employee")',
+                {"birth_date", "address_employee"},
+            )
+        )
+    else:
+        paragraphs.append(
+            (
+                f"and {employee}, residing at {truth['address_employee']} "
+                f'(hereinafter "the Employee")',
+                {"address_employee"},
+            )
+        )
+    paragraphs.append(
+        (
+            f"1. Position. The Employee is employed as {truth['job_title']}. The Employer may assign "
+            "other reasonable tasks that correspond to the qualifications of the Employee.",
+            {"job_title"},
+        )
+    )
+    if truth["type_of_contract"] == "permanent":
+        term = "The employment is concluded for an indefinite period of time."
+    else:
+        end_date = datetime.datetime.strptime(
+            truth["start_date"], "%d.%m.%Y"
+        ).date() + datetime.timedelta(days=365 * rng.choice([1, 2]))
+        term = (
+            "The employment is fixed-term and ends without notice on "
+            f"{format_text_date(rng, end_date)}."
+        )
+    paragraphs.append(
+        (
+            f"2. Commencement and Term. The employment begins on {date_text('start_date')}. {term} "
+            "The first six months are a probationary period.",
+            {"start_date", "type_of_contract"},
+        )
+    )
+    if truth["annual_gross_salary"] != "N/A":
+        paragraphs.append(
+            (
+                f"3. Remuneration. The Employee receives {salary_text}, payable in arrears at the end "
+                "of each month to an account named by the Employee.",
+                {"annual_gross_salary"},
+            )
+        )
+    else:
+        paragraphs.append(
+            (
+                "3. Remuneration. The remuneration of the Employee is governed by the collective "
+                "agreement applicable to the Employer in its current version.",
+                set(),
+            )
+        )
+    filler = [
+        clause.format(hours=rng.choice([20, 30, 38, 40]), vacation=rng.randint(24, 30))
+        for clause in rng.sample(FILLER_CLAUSES, len(FILLER_CLAUSES))
+    ]
+    # Clauses from a longer contract, numbered after the fixed ones
+    paragraphs.extend((clause, set()) for clause in filler[:3])
+    if truth["notice_period"] != "N/A":
+        paragraphs.append(
+            (
+                f"Termination. After the probationary period, either party may terminate this contract "
+                f"with a notice period of {notice_text} to the end of a calendar month.",
+                {"notice_period"},
+            )
+        )
+    paragraphs.extend((clause, set()) for clause in filler[3:])
+    paragraphs.append(
+        (
+            f"{rng.choice(CITIES)[1]}, {date_text('sign_date')}",
+            {"sign_date"},
+        )
+    )
+    paragraphs.append(
+        (f"{truth['employer_name']}                    {employee}", set())
+    )
+    return paragraphs, truth
+
+
+def layout_pages(paragraphs, page_size, target_pages, rng):
+    """
+    Wraps the paragraphs into the lines of pages, and repeats boilerplate clauses before the signature
+    until the contract has target_pages pages.
+
+    Returns:
+        tuple[list[list[str]], list[set], list[tuple[str, set]]]: The lines of each page, the questionids
+        stated on each page, and the paragraphs with the repeated clauses.
+    """
+    width, height = page_size
+    # Helvetica averages about half the font size per character
+    chars_per_line = int((width - 2 * MARGIN) / (FONT_SIZE * 0.5))
+    lines_per_page = int((height - 2 * MARGIN) / (FONT_SIZE * LINE_HEIGHT))
+
+    def paginate(paragraphs):
+        pages = [[]]
+        page_fields = [set()]
+        for text, fields in paragraphs:
+            lines = textwrap.wrap(text, chars_per_line) + [""]
+            for line in lines:
+                if len(pages[-1]) >= lines_per_page:
+                    pages.append([])
+                    page_fields.append(set())
+                pages[-1].append(line)
+            # Fields of a paragraph split over pages are attributed to both pages
+            page_fields[-1] |= fields
+            if len(lines) > len(pages[-1]):
+                page_fields[-2] |= fields
+        return pages, page_fields
+
+    pages, page_fields = paginate(paragraphs)
+    extra = []
+    while len(pages) < target_pages:
+        extra.append(
+            (
+                rng.choice(FILLER_CLAUSES).format(
+                    hours=rng.choice([20, 30, 38, 40]), vacation=rng.randint(24, 30)
+                ),
+                set(),
+            )
+        )
+        pages, page_fields = paginate(paragraphs[:-2] + extra + paragraphs[-2:])
+    # Before the place, date and signatures
+    paragraphs = paragraphs[:-2] + extra + paragraphs[-2:]
+    return pages, page_fields, paragraphs
+
+
+def pdf_string(text):
+    text = text.encode("cp1252", "replace").decode("latin-1")
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_text_pdf(pages, page_size, path):
+    """Writes a machine-readable PDF, each line as text in Helvetica."""
+    width, height = page_size
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # the page tree, written once the pages are known
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+    ]
+    page_ids = []
+    for lines in pages:
+        commands = [
+            f"BT /F1 {FONT_SIZE} Tf {FONT_SIZE * LINE_HEIGHT:.2f} TL "
+            f"{MARGIN} {height - MARGIN} Td"
+        ]
+        commands.extend(f"({pdf_string(line)}) Tj T*" for line in lines)
+        commands.append("ET")
+        stream = "\n".join(commands).encode("latin-1")
+        objects.append(
+            b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream)
+        )
+        objects.append(
+            (
+                f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width} {height}] "
+                f"/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>"
+            ).encode()
+        )
+        page_ids.append(len(objects))
+    objects[1] = (
+        f"<< /Type /Pages /Kids [{' '.join(f'{i} 0 R' for i in page_ids)}] "
+        f"/Count {len(page_ids)} >>"
+    ).encode()
+
+    with open(path, "wb") as f:
+        f.write(b"%PDF-1.4\n")
+        offsets = []
+        for i, obj in enumerate(objects, start=1):
+            offsets.append(f.tell())
+            f.write(b"%d 0 obj\n%s\nendobj\n" % (i, obj))
+        xref_offset = f.tell()
+        f.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        f.writelines(b"%010d 00000 n \n" % offset for offset in offsets)
+        f.write(
+            b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+            % (len(objects) + 1, xref_offset)
+        )
+
+
+def load_font(size):
+    for name in ("DejaVuSans.ttf", "LiberationSans-Regular.ttf", "Arial.ttf"):
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            pass
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        # Pillow < 10.1, a small bitmap font
+        return ImageFont.load_default()
+
+
+def render_page(lines, page_size, dpi):
+    """Renders the lines of a page as a grayscale image at the given DPI."""
+    scale = dpi / 72
+    image = Image.new(
+        "L", (int(page_size[0] * scale), int(page_size[1] * scale)), color=255
+    )
+    draw = ImageDraw.Draw(image)
+    font = load_font(int(FONT_SIZE * scale))
+    y = MARGIN * scale
+    for line in lines:
+        draw.text((MARGIN * scale, y), line, fill=0, font=font)
+        y += FONT_SIZE * LINE_HEIGHT * scale
+    return image
+
+
+def degrade(image, rng, noise, max_skew, rotate):
+    """
+    Makes a rendered page look scanned: a slight skew, blur, speckle noise and uneven gray levels,
+    then turns it by rotate degrees counterclockwise.
+
+    Returns:
+        tuple[PIL.Image.Image, float]: The degraded page and its skew angle in degrees.
+    """
+    skew = rng.uniform(-max_skew, max_skew)
+    image = image.rotate(skew, resample=Image.BICUBIC, fillcolor=255)
+    image = image.filter(ImageFilter.GaussianBlur(radius=0.6))
+
+    pixels = np.asarray(image, dtype=np.float32)
+    np_rng = np.random.default_rng(rng.getrandbits(32))
+    pixels = pixels * np_rng.uniform(0.85, 1.0) + np_rng.normal(0, 8, pixels.shape)
+    speckles = np_rng.random(pixels.shape)
+    pixels[speckles < noise / 2] = 0
+    pixels[speckles > 1 - noise / 2] = 255
+    image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+    if rotate:
+        image = image.rotate(rotate, expand=True)
+    return image, skew
+
+
+def choose_rotation(rng, sideways_rate, upside_down_rate):
+    """Returns the rotation of a scanned page, what tesseract's OSD reports as "Rotate"."""
+    draw = rng.random()
+    if draw < upside_down_rate:
+        return 180
+    if draw < upside_down_rate + sideways_rate:
+        return rng.choice([90, 270])
+    return 0
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--output", default="../../data/synthetic_corpus")
+    arg_parser.add_argument("--contracts", type=int, default=50)
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--forms", nargs="*", choices=FORMS, default=list(FORMS))
+    arg_parser.add_argument("--min-pages", type=int, default=1)
+    arg_parser.add_argument("--max-pages", type=int, default=4)
+    arg_parser.add_argument("--page-size", choices=PAGE_SIZES, default="a4")
+    arg_parser.add_argument("--dpi", type=int, default=200, help="DPI of the scans")
+    arg_parser.add_argument(
+        "--missing-rate",
+        type=float,
+        default=0.2,
+        help="Probability that each optional field is left out of a contract",
+    )
+    arg_parser.add_argument(
+        "--noise", type=float, default=0.01, help="Share of speckled pixels"
+    )
+    arg_parser.add_argument("--max-skew", type=float, default=2.0, help="Degrees")
+    arg_parser.add_argument("--sideways-rate", type=float, default=0.05)
+    arg_parser.add_argument("--upside-down-rate", type=float, default=0.1)
+    arg_parser.add_argument(
+        "--image-format", choices=["png", "jpeg", "mixed"], default="mixed"
+    )
+    arg_parser.add_argument("--jpeg-quality", type=int, default=75)
+    args = arg_parser.parse_args()
+
+    with open(QUESTION_ID_LIST_FILE) as f:
+        questionids = list(json.load(f).keys())
+
+    rng = random.Random(args.seed)
+    page_size = PAGE_SIZES[args.page_size]
+    for form in args.forms:
+        os.makedirs(os.path.join(args.output, form), exist_ok=True)
+    labels = {form: [] for form in args.forms}
+    page_rows = {form: [] for form in args.forms}
+
+    for index in range(1, args.contracts + 1):
+        name = f"contract_{index:04d}"
+        paragraphs, truth = generate_contract(rng, args.missing_rate)
+        unknown = [questionid for questionid in questionids if questionid not in truth]
+        if index == 1 and unknown:
+            print("No generator for questions, labelled N/A: ", unknown)
+        truth = {questionid: truth.get(questionid, "N/A") for questionid in questionids}
+        target_pages = rng.randint(args.min_pages, args.max_pages)
+        pages, page_fields, paragraphs = layout_pages(
+            paragraphs, page_size, target_pages, rng
+        )
+
+        if "txt" in args.forms:
+            with open(os.path.join(args.output, "txt", name + ".txt"), "w") as f:
+                f.write("\n\n".join(text for text, _ in paragraphs))
+            labels["txt"].append({"filename": name + ".txt", **truth})
+        if "pdf" in args.forms:
+            write_text_pdf(
+                pages, page_size, os.path.join(args.output, "pdf", name + ".pdf")
+            )
+            labels["pdf"].append({"filename": name + ".pdf", **truth})
+        if "scanned" in args.forms:
+            scans = []
+            for page, lines in enumerate(pages, start=1):
+                rotate = choose_rotation(rng, args.sideways_rate, args.upside_down_rate)
+                scan, skew = degrade(
+                    render_page(lines, page_size, args.dpi),
+                    rng,
+                    args.noise,
+                    args.max_skew,
+                    rotate,
+                )
+                scans.append(scan)
+                page_rows["scanned"].append(
+                    {
+                        "filename": name + ".pdf",
+                        "page": page,
+                        "osd_rotate": rotate,
+                        "skew": round(skew, 2),
+                    }
+                )
+            scans[0].save(
+                os.path.join(args.output, "scanned", name + ".pdf"),
+                save_all=True,
+                append_images=scans[1:],
+                resolution=args.dpi,
+            )
+            labels["scanned"].append({"filename": name + ".pdf", **truth})
+        if "images" in args.forms:
+            image_format = args.image_format
+            if image_format == "mixed":
+                image_format = "png" if index % 2 else "jpeg"
+            filename = name + (".png" if image_format == "png" else ".jpg")
+            rotate = choose_rotation(rng, args.sideways_rate, args.upside_down_rate)
+            scan, skew = degrade(
+                render_page(pages[0], page_size, args.dpi),
+                rng,
+                args.noise,
+                args.max_skew,
+                rotate,
+            )
+            save_kwargs = (
+                {"quality": args.jpeg_quality} if image_format == "jpeg" else {}
+            )
+            scan.save(
+                os.path.join(args.output, "images", filename),
+                format=image_format.upper(),
+                dpi=(args.dpi, args.dpi),
+                **save_kwargs,
+            )
+            # Only the first page is in the image
+            labels["images"].append(
+                {
+                    "filename": filename,
+                    **{
+                        questionid: value if questionid in page_fields[0] else "N/A"
+                        for questionid, value in truth.items()
+                    },
+                }
+            )
+            page_rows["images"].append(
+                {
+                    "filename": filename,
+                    "page": 1,
+                    "osd_rotate": rotate,
+                    "skew": round(skew, 2),
+                }
+            )
+        print(f"Generated {name}: {len(pages)} pages")
+
+    for form in args.forms:
+        folder = os.path.join(args.output, form)
+        pd.DataFrame(labels[form]).to_csv(
+            os.path.join(folder, "labels.csv"), index=False
+        )
+        if page_rows[form]:
+            pd.DataFrame(page_rows[form]).to_csv(
+                os.path.join(folder, "pages.csv"), index=False
+            )
+    print("Corpus written to ", args.output)
@@ -0,0 +1,130 @@
+"""
+Measures the throughput and the per-question latency of concurrent contracts, with every question
+generated on its own (the engine serialized, as without micro-batching) and through MicroBatchingBackend.
+
+Each simulated contract asks its questions one after the other, like process_contract_questions. The
+fake engine takes --step-latency seconds per call plus --prompt-latency seconds per prompt of the call,
+the cost profile of a GPU that is far from saturated by a single sequence.
+
+    # Simulated engine
+    python micro_batching_benchmark.py --contracts 20 --questions 10
+    # The in-process model
+    python micro_batching_benchmark.py --backend vllm --contracts 20
+"""
+
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import sys
+
+sys.path.append("../")
+sys.path.append("../serve/")
+
+# My Modules
+from backends import FakeBackend, MicroBatchingBackend, VLLMBackend
+from scheduler import percentile
+
+MODEL_ID = "mistralai/Mistral-7B-Instruct-v0.2"
+PROMPT = (
+    "[INST] Extract the {field} of the employee as JSON.\nContract:\n"
+    "This employment contract between ACME GmbH and Jane Doe starts on 01.0{index}.2024. "
+    "The monthly gross salary is 4.{index}00 EUR.\nEnd of the contract. [/INST]"
+)
+
+
+class SimulatedEngine(FakeBackend):
+    """A fake backend whose calls take step_latency seconds plus prompt_latency seconds per prompt."""
+
+    def __init__(self, step_latency, prompt_latency):
+        super().__init__(lambda prompt: '{"answer": "N/A"}')
+        self.step_latency = step_latency
+        self.prompt_latency = prompt_latency
+
+    def generate_with_confidence(self, prompts):
+        time.sleep(self.step_latency + self.prompt_latency * len(prompts))
+        return super().generate_with_confidence(prompts)
+
+
+class SerializedBackend:
+    """One call at a time, as the single LLM worker runs an in-process engine without micro-batching."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.lock = threading.Lock()
+
+    def __call__(self, prompt):
+        with self.lock:
+            return self.backend(prompt)
+
+
+def run_contracts(llm, contracts, questions):
+    latencies = []
+
+    def run_contract(index):
+        for question in range(questions):
+            start_time = time.time()
+            llm(PROMPT.format(field=f"field_{question}", index=index % 9 + 1))
+            latencies.append(time.time() - start_time)
+
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=contracts) as executor:
+        list(executor.map(run_contract, range(contracts)))
+    wall_time = time.time() - start_time
+    latencies.sort()
+    return {
+        "prompts_per_second": len(latencies) / wall_time,
+        "wall_time": wall_time,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+    }
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--backend", choices=["fake", "vllm"], default="fake")
+    arg_parser.add_argument("--contracts", type=int, default=20)
+    arg_parser.add_argument("--questions", type=int, default=10)
+    arg_parser.add_argument("--max-batch-size", type=int, default=32)
+    arg_parser.add_argument("--max-wait", type=float, default=0.01)
+    arg_parser.add_argument("--step-latency", type=float, default=0.05)
+    arg_parser.add_argument("--prompt-latency", type=float, default=0.002)
+    args = arg_parser.parse_args()
+
+    if args.backend == "fake":
+        engine = SimulatedEngine(args.step_latency, args.prompt_latency)
+    else:
+        from langchain.llms import VLLM
+
+        engine = VLLMBackend(
+            VLLM(
+                model=MODEL_ID,
+                trust_remote_code=True,
+                max_new_tokens=128,
+                top_k=10,
+                top_p=0.95,
+                temperature=0.1,
+                vllm_kwargs={"max_model_len": 16000},
+            )
+        )
+
+    serialized = run_contracts(
+        SerializedBackend(engine), args.contracts, args.questions
+    )
+    batcher = MicroBatchingBackend(engine, args.max_batch_size, args.max_wait)
+    micro_batched = run_contracts(batcher, args.contracts, args.questions)
+
+    print(f"{args.contracts} concurrent contracts of {args.questions} questions")
+    for name, result in [("serialized", serialized), ("micro-batched", micro_batched)]:
+        print(
+            f"{name:>14}: {result['prompts_per_second']:8.1f} prompts/s, "
+            f"latency p50 {result['latency_p50']:.3f}s p95 {result['latency_p95']:.3f}s"
+        )
+    print("Batcher: ", batcher.metrics())
+    print(
+        "Throughput gain: ",
+        round(
+            micro_batched["prompts_per_second"] / serialized["prompts_per_second"], 2
+        ),
+    )
@@ -0,0 +1,113 @@
+"""
+Compares OCR time and accuracy of scanned PDFs across rasterization settings.
+
+Every PDF of data_folder is read with tesseract using each setting. The accuracy of a setting is the
+word-level similarity of its text with the ground truth, a .txt file with the same name as the PDF,
+or with the text of the reference setting if there is no ground truth.
+
+    python ocr_settings_benchmark.py
+"""
+
+import difflib
+import os
+import time
+
+import pandas as pd
+import pytesseract
+
+import sys
+
+sys.path.append("../")
+
+# My Modules
+from data.ImagePreparer import ImagePreparer
+
+data_folder = "/home/ec2-user/project/data/scanned_contracts"
+output_file = "output/ocr_settings_benchmark.csv"
+
+settings = {
+    # pdf2image's defaults, what the readers used before
+    "color_200dpi": dict(
+        min_ocr_dpi=200, max_ocr_dpi=200, grayscale=False, thread_count=1
+    ),
+    "reference_300dpi": dict(min_ocr_dpi=300, max_ocr_dpi=300),
+    "gray_200dpi": dict(min_ocr_dpi=200, max_ocr_dpi=200),
+    "gray_150dpi": dict(min_ocr_dpi=150, max_ocr_dpi=150),
+    "adaptive": dict(),
+    "adaptive_binarized": dict(binarize=True),
+    "adaptive_binarized_deskewed": dict(binarize=True, deskew=True),
+}
+reference_setting = "reference_300dpi"
+
+
+def word_accuracy(text, reference):
+    return difflib.SequenceMatcher(
+        None, text.split(), reference.split(), autojunk=False
+    ).ratio()
+
+
+def ocr(pdf_path, image_preparer):
+    start_time = time.time()
+    images = image_preparer.render_for_ocr(pdf_path)
+    render_time = time.time() - start_time
+
+    start_time = time.time()
+    text = "\f".join(pytesseract.image_to_string(image) for image in images)
+    ocr_time = time.time() - start_time
+
+    pixels = sum(image.size[0] * image.size[1] for image in images)
+    return text, len(images), pixels, render_time, ocr_time
+
+
+pdf_filenames = sorted(
+    filename
+    for filename in os.listdir(data_folder)
+    if filename.lower().endswith(".pdf")
+)
+
+result = []
+for pdf_filename in pdf_filenames:
+    pdf_path = os.path.join(data_folder, pdf_filename)
+    texts = {}
+    for setting_name, setting in settings.items():
+        text, num_pages, pixels, render_time, ocr_time = ocr(
+            pdf_path, ImagePreparer(**setting)
+        )
+        texts[setting_name] = text
+        result.append(
+            {
+                "filename": pdf_filename,
+                "setting": setting_name,
+                "pages": num_pages,
+                "megapixels": pixels / 1e6,
+                "render_time": render_time,
+                "ocr_time": ocr_time,
+                "total_time": render_time + ocr_time,
+            }
+        )
+
+    ground_truth_path = os.path.splitext(pdf_path)[0] + ".txt"
+    if os.path.exists(ground_truth_path):
+        with open(ground_truth_path) as f:
+            reference = f.read()
+    else:
+        reference = texts[reference_setting]
+    for row in result[-len(settings) :]:
+        row["word_accuracy"] = word_accuracy(texts[row["setting"]], reference)
+    print("Done: ", pdf_filename)
+
+df = pd.DataFrame(result)
+os.makedirs(os.path.dirname(output_file), exist_ok=True)
+df.to_csv(output_file, index=False)
+
+summary = df.groupby("setting").agg(
+    pages=("pages", "sum"),
+    megapixels=("megapixels", "sum"),
+    render_time=("render_time", "sum"),
+    ocr_time=("ocr_time", "sum"),
+    word_accuracy=("word_accuracy", "mean"),
+)
+summary["seconds_per_page"] = (summary["render_time"] + summary["ocr_time"]) / summary[
+    "pages"
+]
+print(summary.sort_values("seconds_per_page").to_string())
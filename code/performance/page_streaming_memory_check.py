@@ -0,0 +1,79 @@
+"""
+Checks that the memory used to render a PDF for OCR doesn't grow with its number of pages.
+
+Synthetic scans of increasing length are rendered page by page with ImagePreparer.iter_ocr_pages, each in
+a fresh process, and the peak RSS of the processes is compared. Exits with 1 if the peak RSS of the longest
+scan exceeds the shortest one's by more than max_growth_bytes.
+
+    python page_streaming_memory_check.py
+"""
+
+import os
+import resource
+import subprocess
+import tempfile
+
+from PIL import Image, ImageDraw
+
+import sys
+
+sys.path.append("../")
+
+# My Modules
+from data.ImagePreparer import ImagePreparer
+
+page_counts = [5, 20, 60]
+max_window_bytes = 64 * 1024 * 1024
+max_growth_bytes = 64 * 1024 * 1024
+
+
+def write_scan(pdf_path, num_pages):
+    # An A4 page at 300 DPI with lines of "text"
+    page = Image.new("L", (2480, 3508), 255)
+    draw = ImageDraw.Draw(page)
+    for y in range(200, 3300, 60):
+        draw.rectangle((200, y, 2280, y + 20), fill=30)
+    page.save(
+        pdf_path, save_all=True, append_images=[page] * (num_pages - 1), resolution=300
+    )
+
+
+def measure_peak_rss(pdf_path):
+    """Renders the PDF in this process and returns the peak RSS in bytes."""
+    image_preparer = ImagePreparer(max_window_bytes=max_window_bytes)
+    num_pages = 0
+    for image in image_preparer.iter_ocr_pages(pdf_path):
+        num_pages += 1
+    # ru_maxrss is in kilobytes on Linux
+    return num_pages, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--measure":
+        num_pages, peak_rss = measure_peak_rss(sys.argv[2])
+        print(num_pages, peak_rss)
+        sys.exit(0)
+
+    peak_rss_per_count = {}
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        for num_pages in page_counts:
+            pdf_path = os.path.join(tmp_folder, f"scan_{num_pages}.pdf")
+            write_scan(pdf_path, num_pages)
+            output = subprocess.run(
+                [sys.executable, __file__, "--measure", pdf_path],
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout.split()
+            rendered_pages, peak_rss = int(output[-2]), int(output[-1])
+            if rendered_pages != num_pages:
+                print(f"Rendered {rendered_pages} pages of {num_pages}.")
+                sys.exit(1)
+            peak_rss_per_count[num_pages] = peak_rss
+            print(f"{num_pages} pages: peak RSS {peak_rss / 1024 / 1024:.0f} MB")
+
+    growth = peak_rss_per_count[page_counts[-1]] - peak_rss_per_count[page_counts[0]]
+    if growth > max_growth_bytes:
+        print(f"FAILED: peak RSS grew by {growth / 1024 / 1024:.0f} MB.")
+        sys.exit(1)
+    print(f"OK: peak RSS grew by {growth / 1024 / 1024:.0f} MB.")
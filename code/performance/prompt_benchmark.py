@@ -0,0 +1,348 @@
+"""
+Measures extraction accuracy and latency together over a labelled corpus, for a matrix of prompt files,
+contract layouts and sampling settings, and gates regressions against a saved baseline.
+
+The corpus folder has the contract texts as <name>.txt files and a labels.csv with a "filename" column
+and one column per questionid with the ground truth ("N/A" if the information is not in the contract).
+
+The matrix is a JSON list of variants, e.g.
+    [{"name": "baseline"},
+     {"name": "preprocessed", "layout": "preprocessed"},
+     {"name": "v2_dates", "prompt_files": {"start_date": "exp5_startdate.txt"}},
+     {"name": "greedy", "sampling": {"temperature": 0.0, "top_k": 1}}]
+Missing keys take the DEFAULT_VARIANT values.
+
+    # The pipeline itself, on CPU with a deterministic fake model
+    python prompt_benchmark.py --backend fake
+    # A running generation server, saving the baseline the next runs are gated against
+    python prompt_benchmark.py --backend server --url http://localhost:8000 --save-baseline
+"""
+
+import argparse
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+import sys
+
+sys.path.append("../")
+sys.path.append("../serve/")
+
+# My Modules
+from eval.evaluation import evaluate_prediction
+from preprocess.preprocessing import preprocess
+from post_operations.parsing import (
+    ExtractedDate,
+    ExtractedName,
+    ExtractedNumber,
+    ExtractedFloat,
+    parse_output_with_error,
+)
+from backends import FakeBackend, OpenAICompletionBackend, VLLMBackend
+from routing import estimate_tokens
+from scheduler import percentile
+from utils import QuestionIdManager, PydanticCategoryManager, build_question_prompt
+
+from langchain.evaluation import load_evaluator, StringDistance
+from langchain.output_parsers import PydanticOutputParser
+
+MODEL_ID = "mistralai/Mistral-7B-Instruct-v0.2"
+QUESTION_ID_LIST_FILE = "../serve/question_id_list.json"
+STRING_DISTANCE_THRESHOLD = 0.1  # same as the API
+DEFAULT_VARIANT = {
+    "prompt_folder": "../prompts/",
+    # questionid -> prompt file replacing the registry's
+    "prompt_files": {},
+    # "raw" or "preprocessed" (preprocess.preprocessing.preprocess)
+    "layout": "raw",
+    "sampling": {"max_new_tokens": 128, "top_k": 10, "top_p": 0.95, "temperature": 0.1},
+}
+
+
+def fake_answer(prompt):
+    """
+    A deterministic stand-in for the model: answers dates and numbers with the first one found in the
+    contract of the prompt, and everything else with N/A.
+    """
+    fields = re.findall(r'\{"(\w+)":', prompt)
+    field = fields[-1] if fields else "answer"
+    match = re.search(r"Contract:\n(.*)\nEnd of the contract\.", prompt, re.DOTALL)
+    contract = match.group(1) if match else prompt
+
+    value = "N/A"
+    if field == "date_found":
+        date = re.search(r"\b\d{2}\.\d{2}\.\d{4}\b", contract)
+        value = date.group(0) if date else "N/A"
+    elif field == "number":
+        number = re.search(r"\b\d+(?:\.\d+)?\b", contract)
+        value = number.group(0) if number else "N/A"
+    return json.dumps({field: value})
+
+
+def load_corpus(corpus_folder):
+    labels = pd.read_csv(
+        os.path.join(corpus_folder, "labels.csv"), dtype=str, keep_default_na=False
+    )
+    contracts = {}
+    for filename in labels["filename"]:
+        with open(os.path.join(corpus_folder, filename)) as f:
+            contracts[filename] = f.read()
+    return contracts, labels.set_index("filename")
+
+
+def make_backend(args, sampling, vllm_backend=None):
+    if args.backend == "fake":
+        return FakeBackend(fake_answer)
+    if args.backend == "server":
+        return OpenAICompletionBackend(
+            args.url,
+            MODEL_ID,
+            max_connections=args.concurrency,
+            chunk_size=args.batch_size,
+            **sampling,
+        )
+    # Sampling parameters of the loaded model are changed in place
+    for name, value in sampling.items():
+        setattr(vllm_backend.llm, name, value)
+    return vllm_backend
+
+
+def run_variant(variant, contracts, labels, questionids, args, vllm_backend=None):
+    question_id_manager = QuestionIdManager(QUESTION_ID_LIST_FILE)
+    pydantic_category_manager = PydanticCategoryManager(
+        {
+            "string": ExtractedName,
+            "number": ExtractedNumber,
+            "date": ExtractedDate,
+            "float": ExtractedFloat,
+        }
+    )
+    backend = make_backend(args, variant["sampling"], vllm_backend)
+
+    pairs = []
+    for filename, contract in contracts.items():
+        if variant["layout"] == "preprocessed":
+            contract = preprocess(contract)
+        for questionid in questionids:
+            obj_dict = dict(question_id_manager.get_questionid(questionid))
+            obj_dict["prompt_file"] = variant["prompt_files"].get(
+                questionid, obj_dict["prompt_file"]
+            )
+            parser = PydanticOutputParser(
+                pydantic_object=pydantic_category_manager.get_pydantic_object(
+                    obj_dict["pydantic_object"]
+                )
+            )
+            prompt = build_question_prompt(contract, obj_dict, variant["prompt_folder"])
+            pairs.append((filename, questionid, prompt, parser))
+
+    batches = [
+        pairs[i : i + args.batch_size] for i in range(0, len(pairs), args.batch_size)
+    ]
+
+    def run_batch(batch):
+        start_time = time.time()
+        outputs = backend.batch([prompt for _, _, prompt, _ in batch])
+        return outputs, time.time() - start_time
+
+    start_time = time.time()
+    # In-process engine calls are not thread safe
+    workers = 1 if args.backend == "vllm" else args.concurrency
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        batch_results = list(executor.map(run_batch, batches))
+    wall_time = time.time() - start_time
+
+    rows = []
+    for batch, (outputs, latency) in zip(batches, batch_results):
+        for (filename, questionid, prompt, parser), output in zip(batch, outputs):
+            prediction, error = parse_output_with_error(output, parser)
+            ground_truth = labels.loc[filename, questionid]
+            rows.append(
+                {
+                    "variant": variant["name"],
+                    "filename": filename,
+                    "questionid": questionid,
+                    "ground_truth": ground_truth,
+                    "prediction": prediction,
+                    "parse_failed": error is not None,
+                    "correct": evaluate_prediction(
+                        ground_truth,
+                        prediction,
+                        distance_evaluator,
+                        STRING_DISTANCE_THRESHOLD,
+                    ),
+                    "prompt_tokens": count_tokens(prompt),
+                    "output_tokens": count_tokens(output),
+                    "latency": latency,
+                }
+            )
+    return rows, wall_time
+
+
+def summarize(df, wall_times):
+    summary = {}
+    for variant_name, variant_df in df.groupby("variant", sort=False):
+        latencies = sorted(variant_df["latency"])
+        field_accuracy = variant_df.groupby("questionid")["correct"].mean()
+        summary[variant_name] = {
+            "accuracy": {
+                **field_accuracy.to_dict(),
+                "overall": variant_df["correct"].mean(),
+            },
+            "parse_failure_rate": variant_df["parse_failed"].mean(),
+            "mean_prompt_tokens": variant_df["prompt_tokens"].mean(),
+            "mean_output_tokens": variant_df["output_tokens"].mean(),
+            "latency_p50": percentile(latencies, 50),
+            "latency_p95": percentile(latencies, 95),
+            "latency_p99": percentile(latencies, 99),
+            "prompts_per_second": len(variant_df) / wall_times[variant_name],
+        }
+    return summary
+
+
+def check_regressions(summary, baseline, max_accuracy_drop, max_latency_increase):
+    """Returns the regressions of each variant found in the baseline, as messages."""
+    regressions = []
+    for variant_name, metrics in summary.items():
+        if variant_name not in baseline:
+            continue
+        baseline_metrics = baseline[variant_name]
+        for field, accuracy in metrics["accuracy"].items():
+            baseline_accuracy = baseline_metrics["accuracy"].get(field)
+            if (
+                baseline_accuracy is not None
+                and accuracy < baseline_accuracy - max_accuracy_drop
+            ):
+                regressions.append(
+                    f"{variant_name}: {field} accuracy {accuracy:.3f} < baseline {baseline_accuracy:.3f}"
+                )
+        if metrics["latency_p95"] > baseline_metrics["latency_p95"] * (
+            1 + max_latency_increase
+        ):
+            regressions.append(
+                f"{variant_name}: latency p95 {metrics['latency_p95']:.3f}s > baseline "
+                f"{baseline_metrics['latency_p95']:.3f}s"
+            )
+    return regressions
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--corpus", default="../../data/benchmark")
+    arg_parser.add_argument("--matrix", default=None, help="JSON file of the variants")
+    arg_parser.add_argument(
+        "--backend", choices=["fake", "server", "vllm"], default="fake"
+    )
+    arg_parser.add_argument("--url", default="http://localhost:8000")
+    arg_parser.add_argument(
+        "--tokenizer", default=None, help="Hugging Face tokenizer to count tokens"
+    )
+    arg_parser.add_argument("--questions", nargs="*", default=None)
+    arg_parser.add_argument("--batch-size", type=int, default=16)
+    arg_parser.add_argument("--concurrency", type=int, default=4)
+    arg_parser.add_argument("--output", default="output/prompt_benchmark")
+    arg_parser.add_argument(
+        "--baseline-file", default="output/prompt_benchmark_baseline.json"
+    )
+    arg_parser.add_argument("--save-baseline", action="store_true")
+    arg_parser.add_argument("--max-accuracy-drop", type=float, default=0.02)
+    arg_parser.add_argument(
+        "--max-latency-increase",
+        type=float,
+        default=0.2,
+        help="Tolerated relative increase of the latency p95",
+    )
+    args = arg_parser.parse_args()
+
+    if args.tokenizer is not None:
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+        count_tokens = lambda text: len(tokenizer.encode(str(text)))
+    else:
+        count_tokens = estimate_tokens
+
+    distance_evaluator = load_evaluator(
+        "string_distance", distance=StringDistance.LEVENSHTEIN
+    )
+
+    variants = [{"name": "baseline"}]
+    if args.matrix is not None:
+        with open(args.matrix) as f:
+            variants = json.load(f)
+    variants = [
+        {
+            **DEFAULT_VARIANT,
+            **variant,
+            "sampling": {**DEFAULT_VARIANT["sampling"], **variant.get("sampling", {})},
+        }
+        for variant in variants
+    ]
+
+    contracts, labels = load_corpus(args.corpus)
+    questionids = args.questions or [
+        column for column in labels.columns if column != "filename"
+    ]
+
+    vllm_backend = None
+    if args.backend == "vllm":
+        from langchain.llms import VLLM
+
+        vllm_backend = VLLMBackend(
+            VLLM(
+                model=MODEL_ID,
+                trust_remote_code=True,
+                vllm_kwargs={"max_model_len": 16000},
+                **DEFAULT_VARIANT["sampling"],
+            )
+        )
+
+    rows = []
+    wall_times = {}
+    for variant in variants:
+        print("Running variant: ", variant["name"])
+        variant_rows, wall_times[variant["name"]] = run_variant(
+            variant, contracts, labels, questionids, args, vllm_backend
+        )
+        rows.extend(variant_rows)
+
+    df = pd.DataFrame(rows)
+    summary = summarize(df, wall_times)
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    df.to_csv(args.output + "_details.csv", index=False)
+    table = pd.DataFrame(
+        {
+            variant_name: {
+                **{
+                    "accuracy_" + field: accuracy
+                    for field, accuracy in metrics["accuracy"].items()
+                },
+                **{
+                    name: value for name, value in metrics.items() if name != "accuracy"
+                },
+            }
+            for variant_name, metrics in summary.items()
+        }
+    )
+    table.to_csv(args.output + "_summary.csv")
+    print(table.to_string(float_format="{:.3f}".format))
+
+    if args.save_baseline:
+        with open(args.baseline_file, "w") as f:
+            json.dump(summary, f, indent=4)
+        print("Saved baseline: ", args.baseline_file)
+    elif os.path.exists(args.baseline_file):
+        with open(args.baseline_file) as f:
+            baseline = json.load(f)
+        regressions = check_regressions(
+            summary, baseline, args.max_accuracy_drop, args.max_latency_increase
+        )
+        if regressions:
+            print("FAILED:\n" + "\n".join(regressions))
+            sys.exit(1)
+        print("PASSED: no regression against ", args.baseline_file)
@@ -0,0 +1,146 @@
+"""
+Measures the extraction time of FileReader.read_contract per detected file format, optionally against
+UnstructuredFileLoader on the same files.
+
+    # Every file of a folder
+    python reader_benchmark.py --folder /home/ec2-user/project/data/employment_contracts
+    # The same contract as TXT, HTML and DOCX, written from a text file
+    python reader_benchmark.py --from-text contract.txt --compare-unstructured
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import zipfile
+from html import escape
+from xml.sax.saxutils import escape as xml_escape
+
+import pandas as pd
+from langchain.document_loaders import UnstructuredFileLoader
+
+import sys
+
+sys.path.append("../")
+
+# My Modules
+from data.FileReader import FileReader
+from data.text_readers import detect_file_type
+
+DOCX_CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>
+</Types>"""
+DOCX_RELATIONSHIPS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>
+</Relationships>"""
+
+
+def write_formats(text, folder):
+    """Writes the paragraphs of a text as TXT, HTML and DOCX files, returns their paths."""
+    paragraphs = [paragraph.strip() for paragraph in text.split("\n\n")]
+    paragraphs = [paragraph for paragraph in paragraphs if paragraph]
+
+    txt_path = os.path.join(folder, "contract.txt")
+    with open(txt_path, "w") as f:
+        f.write("\n\n".join(paragraphs))
+
+    html_path = os.path.join(folder, "contract.html")
+    with open(html_path, "w") as f:
+        f.write("<!DOCTYPE html><html><head><title>Contract</title></head><body>\n")
+        f.writelines(f"<p>{escape(paragraph)}</p>\n" for paragraph in paragraphs)
+        f.write("</body></html>\n")
+
+    docx_path = os.path.join(folder, "contract.docx")
+    body = "".join(
+        f'<w:p><w:r><w:t xml:space="preserve">{xml_escape(paragraph)}</w:t></w:r></w:p>'
+        for paragraph in paragraphs
+    )
+    with zipfile.ZipFile(docx_path, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("[Content_Types].xml", DOCX_CONTENT_TYPES)
+        archive.writestr("_rels/.rels", DOCX_RELATIONSHIPS)
+        archive.writestr(
+            "word/document.xml",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+            f"<w:body>{body}</w:body></w:document>",
+        )
+    return [txt_path, html_path, docx_path]
+
+
+def time_reader(read_fn, filepath, repeats):
+    start_time = time.time()
+    for _ in range(repeats):
+        text = read_fn(filepath)
+    return (time.time() - start_time) / repeats, len(text)
+
+
+def read_with_unstructured(filepath):
+    return "\n\n".join(
+        page.page_content for page in UnstructuredFileLoader(filepath).load()
+    )
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--folder", default=None)
+    arg_parser.add_argument("--from-text", default=None)
+    arg_parser.add_argument("--repeats", type=int, default=5)
+    arg_parser.add_argument("--compare-unstructured", action="store_true")
+    arg_parser.add_argument("--output", default="output/reader_benchmark.csv")
+    args = arg_parser.parse_args()
+
+    filereader = FileReader()
+    tmp_folder = tempfile.mkdtemp()
+    filepaths = []
+    if args.from_text is not None:
+        with open(args.from_text) as f:
+            filepaths.extend(write_formats(f.read(), tmp_folder))
+    if args.folder is not None:
+        filepaths.extend(
+            os.path.join(args.folder, filename)
+            for filename in sorted(os.listdir(args.folder))
+        )
+
+    result = []
+    for filepath in filepaths:
+        file_type = detect_file_type(filepath)
+        if file_type is None:
+            print("Skipping unsupported file: ", filepath)
+            continue
+        # Scanned formats are slow, they are read once
+        repeats = args.repeats if file_type in ("txt", "html", "docx") else 1
+        seconds, characters = time_reader(filereader.read_contract, filepath, repeats)
+        row = {
+            "filename": os.path.basename(filepath),
+            "format": file_type,
+            "bytes": os.path.getsize(filepath),
+            "characters": characters,
+            "seconds": seconds,
+        }
+        if args.compare_unstructured:
+            row["unstructured_seconds"], _ = time_reader(
+                read_with_unstructured, filepath, repeats
+            )
+        result.append(row)
+        print(row)
+
+    df = pd.DataFrame(result)
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    df.to_csv(args.output, index=False)
+    aggregations = {
+        "files": ("filename", "count"),
+        "characters": ("characters", "sum"),
+        "seconds": ("seconds", "sum"),
+    }
+    if args.compare_unstructured:
+        aggregations["unstructured_seconds"] = ("unstructured_seconds", "sum")
+    summary = df.groupby("format").agg(**aggregations)
+    summary["seconds_per_file"] = summary["seconds"] / summary["files"]
+    summary["characters_per_second"] = summary["characters"] / summary["seconds"]
+    if args.compare_unstructured:
+        summary["speedup"] = summary["unstructured_seconds"] / summary["seconds"]
+    print(summary.to_string())
@@ -118,6 +118,21 @@ def parse_responses(results_anti, parser, field=None):
 
 
 def parse_output(output, parser, field=None):
+    return parse_output_with_error(output, parser, field)[0]
+
+
+def parse_output_with_error(output, parser, field=None):
+    """
+    Parses the output of the model like parse_output, and also reports why parsing failed.
+
+    Args:
+        output (str): The output of the model.
+        parser (PydanticOutputParser): The parser of the expected output format.
+        field (str, optional): The field to extract. Defaults to the only field of the pydantic object.
+
+    Returns:
+        tuple: The extracted value ("N/A" on failure) and the error message (None on success).
+    """
     if field is None:
         # If there is only one field in the pydantic object, use that
         available_fields = list(parser.pydantic_object.__fields__.keys())
@@ -128,6 +143,6 @@ def parse_output(output, parser, field=None):
                 f"Please specify the field to extract from the pydantic object. Available fields: {available_fields}"
             )
     try:
-        return parser.parse(output).__getattribute__(field)
-    except:
-        return "N/A"
+        return parser.parse(output).__getattribute__(field), None
+    except Exception as e:
+        return "N/A", str(e)
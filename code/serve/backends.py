@@ -0,0 +1,552 @@
+import hashlib
+import math
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from prompt_tokens import TokenizedPrompt, prompt_text
+
+
+class GenerationBackend:
+    """
+    Base class of the generation backends. A backend can be used wherever the langchain llm is used:
+    backend(prompt) returns the completion of one prompt, backend.batch(prompts) the completions of
+    many prompts in a single engine call.
+
+    Prompts are str or TokenizedPrompt. Subclasses implement generate_with_confidence.
+    """
+
+    model = None
+
+    def __call__(self, prompt):
+        return self.batch([prompt])[0]
+
+    def batch(self, prompts):
+        return [text for text, _ in self.generate_with_confidence(prompts)]
+
+    def generate_with_confidence(self, prompts):
+        """
+        Generates the completions of the given prompts.
+
+        Args:
+            prompts (list[str]): The prompts.
+
+        Returns:
+            list[tuple[str, float]]: The completion of each prompt and its confidence, the geometric mean
+            of the token probabilities (None if the backend can't report it).
+        """
+        raise NotImplementedError
+
+    def prompt_token_ids(self, prompt):
+        """Returns the token ids of a prompt tokenized for the model of the backend, else None."""
+        if isinstance(prompt, TokenizedPrompt) and prompt.model == self.model:
+            return prompt.token_ids
+        return None
+
+
+class VLLMBackend(GenerationBackend):
+    """
+    A backend running a model in-process, around langchain's VLLM.
+
+    Args:
+        llm (langchain.llms.VLLM): The loaded model.
+    """
+
+    def __init__(self, llm):
+        self.llm = llm
+        self.model = llm.model
+
+    def __call__(self, prompt):
+        if isinstance(prompt, str):
+            return self.llm(prompt)
+        return super().__call__(prompt)
+
+    def batch(self, prompts):
+        if all(isinstance(prompt, str) for prompt in prompts):
+            return self.llm.batch(prompts)
+        return super().batch(prompts)
+
+    def generate_with_confidence(self, prompts):
+        from vllm import SamplingParams
+
+        # Same sampling as langchain's VLLM, with the logprob of each generated token
+        sampling_params = SamplingParams(**{**self.llm._default_params, "logprobs": 1})
+        token_ids = [self.prompt_token_ids(prompt) for prompt in prompts]
+        if all(ids is None for ids in token_ids):
+            outputs = self.llm.client.generate(
+                [prompt_text(prompt) for prompt in prompts], sampling_params
+            )
+        else:
+            # Tokenized prompts skip the engine's tokenization
+            outputs = self.llm.client.generate(
+                [
+                    prompt_text(prompt) if ids is None else None
+                    for prompt, ids in zip(prompts, token_ids)
+                ],
+                sampling_params,
+                prompt_token_ids=token_ids,
+            )
+
+        results = []
+        for output in outputs:
+            completion = output.outputs[0]
+            num_tokens = max(len(completion.token_ids), 1)
+            results.append(
+                (completion.text, math.exp(completion.cumulative_logprob / num_tokens))
+            )
+        return results
+
+
+class FakeBackend(GenerationBackend):
+    """
+    A deterministic backend for running the service and the benchmarks without a GPU.
+
+    Args:
+        answer_fn (Callable[[str], str]): Returns the completion of a prompt.
+        confidence (float, optional): The confidence reported for every completion. Defaults to 1.0.
+    """
+
+    def __init__(self, answer_fn, confidence=1.0):
+        self.answer_fn = answer_fn
+        self.confidence = confidence
+        self.calls = 0
+
+    def generate_with_confidence(self, prompts):
+        self.calls += 1
+        return [
+            (self.answer_fn(prompt_text(prompt)), self.confidence) for prompt in prompts
+        ]
+
+
+class OpenAICompletionBackend(GenerationBackend):
+    """
+    A backend calling a separate OpenAI-compatible completion server, e.g. vLLM's
+    `python -m vllm.entrypoints.openai.api_server`, so that API workers don't hold the model.
+
+    Connections are kept alive in a pool shared by all threads. Batches are split into chunks
+    that are sent as concurrent requests, each chunk is batched by the server.
+
+    Args:
+        base_url (str): The URL of the server, e.g. "http://localhost:8000".
+        model (str): The model name served by the server.
+        max_new_tokens (int, optional): Defaults to 128.
+        top_k (int, optional): Defaults to 10.
+        top_p (float, optional): Defaults to 0.95.
+        temperature (float, optional): Defaults to 0.1.
+        timeout (float, optional): Seconds to wait for a response. Defaults to 120.
+        max_connections (int, optional): Size of the connection pool and number of concurrent requests. Defaults to 16.
+        chunk_size (int, optional): Number of prompts per request. Defaults to 8.
+    """
+
+    def __init__(
+        self,
+        base_url,
+        model,
+        max_new_tokens=128,
+        top_k=10,
+        top_p=0.95,
+        temperature=0.1,
+        timeout=120,
+        max_connections=16,
+        chunk_size=8,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.url = self.base_url + "/v1/completions"
+        self.model = model
+        self.sampling_params = {
+            "max_tokens": max_new_tokens,
+            "top_k": top_k,  # vLLM extension of the OpenAI API
+            "top_p": top_p,
+            "temperature": temperature,
+        }
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=max_connections,
+            # Only connection errors and overloaded servers are retried. Completions are not idempotent,
+            # a request that timed out while reading is still generated by the server and isn't resent.
+            max_retries=Retry(
+                total=2,
+                connect=2,
+                read=0,
+                other=0,
+                backoff_factor=0.5,
+                status_forcelist=[502, 503],
+                allowed_methods=None,
+            ),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_connections, thread_name_prefix="completion"
+        )
+
+    def check_health(self):
+        """Returns True if the server answers its /health endpoint."""
+        try:
+            return self.session.get(self.base_url + "/health", timeout=5).ok
+        except requests.exceptions.RequestException:
+            return False
+
+    def _complete(self, prompts):
+        token_ids = [self.prompt_token_ids(prompt) for prompt in prompts]
+        if any(ids is None for ids in token_ids):
+            # The API doesn't accept text and token ids in the same request
+            payload_prompts = [prompt_text(prompt) for prompt in prompts]
+        else:
+            payload_prompts = token_ids
+        response = self.session.post(
+            self.url,
+            json={
+                "model": self.model,
+                "prompt": payload_prompts,
+                "logprobs": 1,
+                **self.sampling_params,
+            },
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        choices = sorted(response.json()["choices"], key=lambda c: c["index"])
+
+        results = []
+        for choice in choices:
+            token_logprobs = [
+                logprob
+                for logprob in (choice.get("logprobs") or {}).get("token_logprobs", [])
+                if logprob is not None
+            ]
+            confidence = (
+                math.exp(sum(token_logprobs) / len(token_logprobs))
+                if token_logprobs
+                else None
+            )
+            results.append((choice["text"], confidence))
+        return results
+
+    def generate_with_confidence(self, prompts):
+        chunks = [
+            prompts[i : i + self.chunk_size]
+            for i in range(0, len(prompts), self.chunk_size)
+        ]
+        if len(chunks) == 1:
+            return self._complete(chunks[0])
+        results = []
+        for chunk_results in self.executor.map(self._complete, chunks):
+            results.extend(chunk_results)
+        return results
+
+
+class MicroBatchingBackend(GenerationBackend):
+    """
+    Batches the generations of concurrent requests: the prompts that callers submit within max_wait
+    seconds of each other, up to max_batch_size, are generated by a single call of the wrapped backend,
+    and each caller gets the completions of its own prompts.
+
+    Only the batching thread calls the wrapped backend, so an in-process engine, which is not thread safe,
+    can be shared by many request workers. A caller's prompts are never split between batches, a call
+    with more than max_batch_size prompts is a batch of its own.
+
+    Args:
+        backend (GenerationBackend): The batched backend.
+        max_batch_size (int, optional): The largest number of prompts of a batch. Defaults to 32.
+        max_wait (float, optional): Seconds a batch waits for more prompts after its first one, the
+            latency added to a request when the engine is idle. Defaults to 0.01.
+    """
+
+    def __init__(self, backend, max_batch_size=32, max_wait=0.01):
+        self.backend = backend
+        self.model = backend.model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.condition = threading.Condition()
+        # (prompts, future, submit time) of each waiting call
+        self.pending = deque()
+        self.pending_prompts = 0
+
+        # Metrics
+        self.batches = 0
+        self.prompts = 0
+        self.calls = 0
+        self.wait_times = deque(maxlen=1000)
+
+        threading.Thread(
+            target=self._batch_loop, name="micro-batcher", daemon=True
+        ).start()
+
+    def generate_with_confidence(self, prompts):
+        prompts = list(prompts)
+        if not prompts:
+            return []
+        future = Future()
+        with self.condition:
+            self.pending.append((prompts, future, time.monotonic()))
+            self.pending_prompts += len(prompts)
+            self.condition.notify()
+        return future.result()
+
+    def _next_batch(self):
+        with self.condition:
+            while not self.pending:
+                self.condition.wait()
+            # The window starts with the oldest waiting call, prompts that queued up while the
+            # previous batch was generated don't wait again
+            deadline = self.pending[0][2] + self.max_wait
+            while self.pending_prompts < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            calls = [self.pending.popleft()]
+            size = len(calls[0][0])
+            while (
+                self.pending and size + len(self.pending[0][0]) <= self.max_batch_size
+            ):
+                calls.append(self.pending.popleft())
+                size += len(calls[-1][0])
+            self.pending_prompts -= size
+        return calls, size
+
+    def _batch_loop(self):
+        while True:
+            calls, size = self._next_batch()
+            start_time = time.monotonic()
+            try:
+                results = self.backend.generate_with_confidence(
+                    [prompt for prompts, _, _ in calls for prompt in prompts]
+                )
+            except Exception as e:
+                for _, future, _ in calls:
+                    future.set_exception(e)
+                continue
+
+            with self.condition:
+                self.batches += 1
+                self.prompts += size
+                self.calls += len(calls)
+                self.wait_times.extend(
+                    start_time - submit_time for _, _, submit_time in calls
+                )
+            offset = 0
+            for prompts, future, _ in calls:
+                future.set_result(results[offset : offset + len(prompts)])
+                offset += len(prompts)
+
+    def metrics(self):
+        """
+        Returns the number of batches, the mean number of prompts and calls per batch, and the time the
+        calls waited for their batch.
+
+        Returns:
+            dict: The metrics of the batcher.
+        """
+        with self.condition:
+            wait_times = sorted(self.wait_times)
+            metrics = {
+                "batches": self.batches,
+                "prompts": self.prompts,
+                "waiting_prompts": self.pending_prompts,
+                "mean_batch_size": (
+                    self.prompts / self.batches if self.batches else None
+                ),
+                "mean_calls_per_batch": (
+                    self.calls / self.batches if self.batches else None
+                ),
+            }
+        metrics["wait_mean"] = sum(wait_times) / len(wait_times) if wait_times else None
+        metrics["wait_p95"] = (
+            wait_times[int(0.95 * (len(wait_times) - 1))] if wait_times else None
+        )
+        return metrics
+
+
+_affinity = threading.local()
+
+
+@contextmanager
+def generation_affinity(key):
+    """
+    Within the block, generations of the current thread prefer the same replica of a ReplicaPoolBackend,
+    e.g. all questions of one contract, so that the replica's prefix cache stays warm.
+
+    Args:
+        key (str): The affinity key, e.g. the hash of the contract.
+    """
+    previous = getattr(_affinity, "key", None)
+    _affinity.key = key
+    try:
+        yield
+    finally:
+        _affinity.key = previous
+
+
+def is_replica_failure(exception):
+    """
+    Checks whether an error of a generation request is a failure of the replica (connection error,
+    timeout or 5xx status) rather than of the request (4xx status, e.g. a prompt too long).
+    """
+    if isinstance(
+        exception, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+    ):
+        return True
+    if isinstance(exception, requests.exceptions.HTTPError):
+        response = exception.response
+        return response is None or response.status_code >= 500
+    return False
+
+
+class ReplicaPoolBackend(GenerationBackend):
+    """
+    Spreads generations over several replicas of the same model.
+
+    Requests go to the healthy replica with the least outstanding requests. Within generation_affinity,
+    requests with the same key go to the same replica, unless it is overloaded compared to the others.
+    A replica that fails a request (see is_replica_failure) is ejected, the request is retried on another
+    replica, and a background thread re-admits the replica once its health check passes. Errors of the
+    request itself, e.g. a 4xx status, are raised without ejecting the replica.
+
+    Args:
+        replicas (dict): The name of each replica mapped to its backend, which must implement check_health.
+        affinity_slack (int, optional): Number of outstanding requests the affine replica may have more than
+            the least loaded one. Defaults to 4.
+        health_check_interval (float, optional): Seconds between the health checks of ejected replicas. Defaults to 10.
+    """
+
+    def __init__(self, replicas, affinity_slack=4, health_check_interval=10):
+        self.replicas = {
+            name: {
+                "backend": backend,
+                "outstanding": 0,
+                "requests": 0,
+                "errors": 0,
+                "ejected": False,
+                "latencies": deque(maxlen=1000),
+            }
+            for name, backend in replicas.items()
+        }
+        self.affinity_slack = affinity_slack
+        self.health_check_interval = health_check_interval
+        self.lock = threading.Lock()
+
+        threading.Thread(
+            target=self._health_check_loop, name="replica-health-check", daemon=True
+        ).start()
+
+    def _health_check_loop(self):
+        while True:
+            time.sleep(self.health_check_interval)
+            with self.lock:
+                ejected = [
+                    name
+                    for name, replica in self.replicas.items()
+                    if replica["ejected"]
+                ]
+            # Health checks are network calls, made without holding the lock
+            for name in ejected:
+                if self.replicas[name]["backend"].check_health():
+                    print("Re-admitting generation replica: ", name)
+                    with self.lock:
+                        self.replicas[name]["ejected"] = False
+
+    def _acquire(self, excluded):
+        with self.lock:
+            candidates = [
+                name
+                for name, replica in self.replicas.items()
+                if not replica["ejected"] and name not in excluded
+            ]
+            if not candidates:
+                return None
+
+            least_outstanding = min(
+                self.replicas[name]["outstanding"] for name in candidates
+            )
+            key = getattr(_affinity, "key", None)
+            chosen = None
+            if key is not None:
+                # Rendezvous hashing, the key keeps its replica as long as the replica is healthy
+                chosen = max(
+                    candidates,
+                    key=lambda name: hashlib.sha1((key + name).encode()).digest(),
+                )
+                if (
+                    self.replicas[chosen]["outstanding"]
+                    > least_outstanding + self.affinity_slack
+                ):
+                    chosen = None
+            if chosen is None:
+                chosen = random.choice(
+                    [
+                        name
+                        for name in candidates
+                        if self.replicas[name]["outstanding"] == least_outstanding
+                    ]
+                )
+            self.replicas[chosen]["outstanding"] += 1
+            self.replicas[chosen]["requests"] += 1
+            return chosen
+
+    def generate_with_confidence(self, prompts):
+        excluded = set()
+        last_error = None
+        while True:
+            name = self._acquire(excluded)
+            if name is None:
+                if last_error is not None:
+                    raise last_error
+                raise RuntimeError("No healthy generation replica available.")
+            replica = self.replicas[name]
+            start_time = time.monotonic()
+            try:
+                results = replica["backend"].generate_with_confidence(prompts)
+                replica["latencies"].append(time.monotonic() - start_time)
+                return results
+            except Exception as e:
+                if not is_replica_failure(e):
+                    raise
+                print(f"Generation replica {name} failed, ejecting it: ", e)
+                with self.lock:
+                    replica["errors"] += 1
+                    replica["ejected"] = True
+                excluded.add(name)
+                last_error = e
+            finally:
+                with self.lock:
+                    replica["outstanding"] -= 1
+
+    def metrics(self):
+        """
+        Returns the load, error and latency metrics of each replica.
+
+        Returns:
+            dict: The metrics of each replica.
+        """
+        metrics = {}
+        with self.lock:
+            for name, replica in self.replicas.items():
+                latencies = sorted(replica["latencies"])
+                metrics[name] = {
+                    "outstanding": replica["outstanding"],
+                    "requests": replica["requests"],
+                    "errors": replica["errors"],
+                    "ejected": replica["ejected"],
+                    "latency_mean": (
+                        sum(latencies) / len(latencies) if latencies else None
+                    ),
+                    "latency_p95": (
+                        latencies[int(0.95 * (len(latencies) - 1))]
+                        if latencies
+                        else None
+                    ),
+                }
+        return metrics
@@ -0,0 +1,113 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into a single computation.
+
+    The first caller of a key runs the function, callers arriving while it is running wait for
+    its result (or exception) instead of repeating the work. Once the computation is finished,
+    the key is released and the next call computes again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.coalesced_calls = 0
+
+    def do(self, key, fn):
+        """
+        Runs fn, or waits for the running computation of the same key.
+
+        Args:
+            key (Hashable): The key identifying the computation.
+            fn (Callable[[], Any]): The computation.
+
+        Returns:
+            Any: The result of the computation.
+        """
+        with self.lock:
+            future = self.in_flight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self.in_flight[key] = future
+            else:
+                self.coalesced_calls += 1
+
+        if not is_leader:
+            return future.result()
+
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+        return future.result()
+
+
+class IdempotencyKeyReusedError(ValueError):
+    """Raised when an idempotency key is reused for a request with a different body."""
+
+
+class IdempotencyStore:
+    """
+    Keeps the results of completed requests by their idempotency key, so that retried requests
+    get the stored result instead of being processed again. Each result is stored with a fingerprint
+    of its request, a key reused for a different request doesn't get another request's result.
+
+    Args:
+        ttl (float, optional): Seconds a result is kept. Defaults to 24 hours.
+        max_entries (int, optional): Number of results kept, the oldest are dropped first. Defaults to 10000.
+    """
+
+    def __init__(self, ttl=24 * 3600, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.results = OrderedDict()
+
+    def get(self, key, fingerprint=None):
+        """
+        Returns the stored result of a key, or None if there is none or it expired.
+
+        Args:
+            key (Hashable): The idempotency key.
+            fingerprint (str, optional): The fingerprint of the request, e.g. a hash of its body.
+
+        Raises:
+            IdempotencyKeyReusedError: If the result was stored for a request with another fingerprint.
+        """
+        with self.lock:
+            entry = self.results.get(key)
+            if entry is None:
+                return None
+            stored_at, stored_fingerprint, result = entry
+            if time.time() - stored_at > self.ttl:
+                del self.results[key]
+                return None
+        if stored_fingerprint != fingerprint:
+            raise IdempotencyKeyReusedError(
+                "The Idempotency-Key was already used for a request with a different body."
+            )
+        return result
+
+    def put(self, key, result, fingerprint=None):
+        """
+        Stores the result of a completed request.
+
+        Args:
+            key (Hashable): The idempotency key.
+            result (Any): The result of the request.
+            fingerprint (str, optional): The fingerprint of the request, see get.
+        """
+        with self.lock:
+            self.results[key] = (time.time(), fingerprint, result)
+            self.results.move_to_end(key)
+            while len(self.results) > self.max_entries:
+                self.results.popitem(last=False)
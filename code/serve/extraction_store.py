@@ -0,0 +1,169 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class ExtractionStore:
+    """
+    A SQLite store of the processed documents: the text of each document by the SHA-256 of its file,
+    and the parsed output of each question with the version of the prompt that produced it.
+
+    Documents already read are not OCRed again, and results missing for new or changed questions can be
+    computed without processing the documents again, see backfill_batch.
+
+    Args:
+        db_path (str): The path of the SQLite database file, created if it doesn't exist.
+    """
+
+    def __init__(self, db_path):
+        directory = os.path.dirname(db_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        with self.lock, self.connection:
+            # Readers don't block the writer
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS documents (
+                    content_hash TEXT PRIMARY KEY,
+                    text TEXT NOT NULL,
+                    source_url TEXT,
+                    created_at REAL NOT NULL
+                )
+                """)
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS results (
+                    content_hash TEXT NOT NULL REFERENCES documents (content_hash),
+                    questionid TEXT NOT NULL,
+                    prompt_version TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (content_hash, questionid)
+                )
+                """)
+
+    def put_document(self, content_hash, text, source_url=None):
+        """
+        Stores the text of a document. A document already stored keeps its text and results.
+
+        Args:
+            content_hash (str): The SHA-256 of the document's file.
+            text (str): The text of the document.
+            source_url (str, optional): Where the document was downloaded from. Defaults to None.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO documents VALUES (?, ?, ?, ?)",
+                (content_hash, text, source_url, time.time()),
+            )
+
+    def get_text(self, content_hash):
+        """Returns the stored text of a document, or None if it is not stored."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT text FROM documents WHERE content_hash = ?", (content_hash,)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def get_texts(self, content_hashes):
+        """Returns the stored text of each of the given documents, by content hash."""
+        content_hashes = list(content_hashes)
+        if not content_hashes:
+            return {}
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT content_hash, text FROM documents WHERE content_hash IN ({})".format(
+                    ",".join("?" * len(content_hashes))
+                ),
+                content_hashes,
+            ).fetchall()
+        return dict(rows)
+
+    def put_results(self, content_hash, results, prompt_versions):
+        """
+        Stores the parsed outputs of a document, replacing older results of the same questions.
+
+        Args:
+            content_hash (str): The SHA-256 of the document's file.
+            results (dict): The parsed output of each questionid.
+            prompt_versions (dict): The prompt version of each questionid.
+        """
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        content_hash,
+                        questionid,
+                        prompt_versions[questionid],
+                        json.dumps(value),
+                        now,
+                    )
+                    for questionid, value in results.items()
+                ],
+            )
+
+    def get_results(self, content_hash, prompt_versions=None):
+        """
+        Returns the stored parsed outputs of a document.
+
+        Args:
+            content_hash (str): The SHA-256 of the document's file.
+            prompt_versions (dict, optional): When given, only the results of these questionids with the
+                same prompt version are returned. Defaults to None, all results.
+
+        Returns:
+            dict: The parsed output of each questionid.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT questionid, prompt_version, value FROM results WHERE content_hash = ?",
+                (content_hash,),
+            ).fetchall()
+        return {
+            questionid: json.loads(value)
+            for questionid, prompt_version, value in rows
+            if prompt_versions is None
+            or prompt_versions.get(questionid) == prompt_version
+        }
+
+    def find_missing(self, prompt_versions, limit=100):
+        """
+        Finds the (document, question) pairs without a result of the current prompt version.
+
+        Args:
+            prompt_versions (dict): The current prompt version of each questionid.
+            limit (int, optional): The largest number of pairs returned. Defaults to 100.
+
+        Returns:
+            list[tuple[str, str]]: The content hash and questionid of each missing pair, grouped by document.
+        """
+        pairs = []
+        with self.lock:
+            for questionid, prompt_version in prompt_versions.items():
+                if len(pairs) >= limit:
+                    break
+                rows = self.connection.execute(
+                    """
+                    SELECT documents.content_hash FROM documents
+                    LEFT JOIN results ON results.content_hash = documents.content_hash
+                        AND results.questionid = ?
+                    WHERE results.prompt_version IS NULL OR results.prompt_version != ?
+                    ORDER BY documents.content_hash
+                    LIMIT ?
+                    """,
+                    (questionid, prompt_version, limit - len(pairs)),
+                ).fetchall()
+                pairs.extend((row[0], questionid) for row in rows)
+        # Questions of the same document next to each other, they share the contract prefix
+        return sorted(pairs)
+
+    def count_documents(self):
+        """Returns the number of stored documents."""
+        with self.lock:
+            row = self.connection.execute("SELECT COUNT(*) FROM documents").fetchone()
+        return row[0]
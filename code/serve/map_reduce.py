@@ -0,0 +1,288 @@
+import os
+import re
+import threading
+from collections import defaultdict
+
+# Characters per token assumed without the model's tokenizer. German contracts are denser than the ~4 of
+# routing.estimate_tokens, an underestimate would make windows overflow the context.
+CHARS_PER_TOKEN = 3
+
+
+class MapReduceExtractor:
+    """
+    Extraction of contracts that don't fit in the model's context. The contract is split into
+    overlapping windows that fit with the prompt of every question, each question runs on every
+    window, and the answers of the windows are reconciled into one value per question, see reconcile.
+
+    Windows are made of whole text elements (the paragraphs separated by blank lines), elements longer
+    than the overlap are cut at line breaks or spaces. Consecutive windows share the last overlap_tokens
+    tokens of elements, so that a clause cut by a window boundary is complete in one of them. Each window
+    is measured as a whole, the tokens of its parts don't always add up to the tokens of the joined text.
+
+    Args:
+        template_folder (str): The folder of the prompt files.
+        max_model_len (int): The context length of the model.
+        max_new_tokens (int, optional): The number of tokens generated after the prompt. Defaults to 128.
+        overlap_tokens (int, optional): The tokens shared by consecutive windows. Defaults to 256.
+        max_window_tokens (int, optional): The largest window, smaller windows are more windows but shorter
+            prompts. Defaults to None, windows fill the context.
+        prompt_assembler (PromptAssembler, optional): Counts tokens with the model's tokenizer. Defaults
+            to None, tokens are estimated from the length of the text, see CHARS_PER_TOKEN.
+    """
+
+    def __init__(
+        self,
+        template_folder,
+        max_model_len,
+        max_new_tokens=128,
+        overlap_tokens=256,
+        max_window_tokens=None,
+        prompt_assembler=None,
+    ):
+        self.template_folder = template_folder
+        self.max_model_len = max_model_len
+        self.max_new_tokens = max_new_tokens
+        self.overlap_tokens = overlap_tokens
+        self.max_window_tokens = max_window_tokens
+        self.prompt_assembler = prompt_assembler
+        # The window may not tokenize exactly the same within the prompt
+        self.margin = 16
+        self.lock = threading.Lock()
+        self.stats = defaultdict(int)
+
+    def count_tokens(self, text):
+        if self.prompt_assembler is not None:
+            return len(
+                self.prompt_assembler.tokenizer.encode(text, add_special_tokens=False)
+            )
+        return len(text) // CHARS_PER_TOKEN + 1
+
+    def template_tokens(self, obj_dicts):
+        """Returns the tokens of the longest prompt of the given questions, without the contract."""
+        tokens = 0
+        for obj_dict in obj_dicts:
+            if self.prompt_assembler is not None:
+                template = self.prompt_assembler.load_template(obj_dict["prompt_file"])
+                count = len(template["prefix_ids"]) + len(template["suffix_ids"])
+            else:
+                with open(
+                    os.path.join(self.template_folder, obj_dict["prompt_file"]), "r"
+                ) as f:
+                    count = self.count_tokens(f.read())
+            tokens = max(tokens, count)
+        return tokens
+
+    def window_budget(self, obj_dicts):
+        """
+        Returns the tokens of contract that fit in the prompt of every given question.
+
+        Raises:
+            ValueError: If the prompts leave no room for the contract.
+        """
+        budget = (
+            self.max_model_len
+            - self.max_new_tokens
+            - self.template_tokens(obj_dicts)
+            - self.margin
+        )
+        if self.max_window_tokens is not None:
+            budget = min(budget, self.max_window_tokens)
+        if budget <= 0:
+            raise ValueError("The prompts leave no room for the contract.")
+        return budget
+
+    def fits(self, contract, obj_dicts, contract_ids=None):
+        """
+        Checks whether a contract fits in the prompt of every given question.
+
+        Args:
+            contract (str): The text of the contract.
+            obj_dicts (Iterable[dict]): The entries of the questions in the registry.
+            contract_ids (list[int], optional): The token ids of the contract, if already tokenized.
+
+        Returns:
+            bool: False if the contract has to be split into windows.
+        """
+        obj_dicts = list(obj_dicts)
+        if not obj_dicts:
+            return True
+        if contract_ids is not None:
+            num_tokens = len(contract_ids)
+        else:
+            num_tokens = self.count_tokens(contract)
+        return (
+            num_tokens + self.template_tokens(obj_dicts) + self.max_new_tokens
+            <= self.max_model_len
+        )
+
+    def _pieces(self, text, max_tokens):
+        # Splits a text element into pieces of at most max_tokens, at line breaks, else spaces
+        tokens = self.count_tokens(text)
+        if tokens <= max_tokens or len(text) == 1:
+            return [(text, tokens)]
+        for separator in ("\n", " "):
+            parts = text.split(separator)
+            if len(parts) > 1:
+                break
+        else:
+            # No separator, cut the characters in proportion to the tokens
+            size = max(1, len(text) * max_tokens // tokens)
+            parts = [text[i : i + size] for i in range(0, len(text), size)]
+            separator = ""
+
+        pieces = []
+        current = []
+        for part in parts:
+            candidate = separator.join(current + [part])
+            if current and self.count_tokens(candidate) > max_tokens:
+                pieces.extend(self._pieces(separator.join(current), max_tokens))
+                current = [part]
+            else:
+                current.append(part)
+        if current:
+            pieces.extend(self._pieces(separator.join(current), max_tokens))
+        return pieces
+
+    def split(self, contract, max_tokens):
+        """
+        Splits a contract into overlapping windows.
+
+        Args:
+            contract (str): The text of the contract.
+            max_tokens (int): The largest window in tokens, see window_budget.
+
+        Returns:
+            list[str]: The text of the windows, in the order of the contract.
+        """
+        overlap = min(self.overlap_tokens, max_tokens // 4)
+        pieces = []
+        for element in re.split(r"\n\s*\n", contract):
+            if element.strip():
+                pieces.extend(self._pieces(element, max(overlap, 1)))
+
+        windows = []
+        start = 0
+        while start < len(pieces):
+            # Pieces and their separators, by their separate counts
+            end = start + 1
+            tokens = pieces[start][1] + 1
+            while end < len(pieces) and tokens + pieces[end][1] + 1 <= max_tokens:
+                tokens += pieces[end][1] + 1
+                end += 1
+            # The largest window from start that fits when measured as a whole
+            low, high = start + 1, end
+            if self.count_tokens(self._join(pieces[start:end])) <= max_tokens:
+                low = end
+            while low < high:
+                middle = (low + high + 1) // 2
+                if self.count_tokens(self._join(pieces[start:middle])) <= max_tokens:
+                    low = middle
+                else:
+                    high = middle - 1
+            end = low
+            windows.append(self._join(pieces[start:end]))
+            if end == len(pieces):
+                break
+
+            # The next window starts with the last pieces of this one
+            next_start = end
+            tail_tokens = 0
+            while (
+                next_start - 1 > start
+                and tail_tokens + pieces[next_start - 1][1] <= overlap
+            ):
+                next_start -= 1
+                tail_tokens += pieces[next_start][1]
+            start = next_start
+        return windows
+
+    def _join(self, pieces):
+        return "\n\n".join(text for text, _ in pieces)
+
+    def reconcile(self, questionid, candidates):
+        """
+        Reconciles the answers of a question on the windows of a contract into one value.
+
+        "N/A" answers and outputs that failed parsing or validation don't vote, a field is "N/A" only if
+        no window found it. Answers found in their window (routing.is_grounded) are preferred over
+        the others. Among them, the value found by most windows wins, then the one with the highest total
+        confidence, then the one found first in the contract.
+
+        Args:
+            questionid (str): The question ID.
+            candidates (list[dict]): The "value", "error", "grounded" and "confidence" of the answer of
+                each window, and the "window" index.
+
+        Returns:
+            The reconciled value, "N/A" if no window has a valid answer.
+        """
+        valid = [
+            candidate
+            for candidate in candidates
+            if candidate["error"] is None and candidate["value"] != "N/A"
+        ]
+        if not valid:
+            return "N/A"
+        grounded = [candidate for candidate in valid if candidate["grounded"]]
+        voters = grounded or valid
+
+        groups = {}
+        for candidate in voters:
+            key = " ".join(str(candidate["value"]).split()).lower()
+            group = groups.setdefault(
+                key,
+                {
+                    "votes": 0,
+                    "confidence": 0.0,
+                    "first": candidate["window"],
+                    "best": candidate,
+                },
+            )
+            group["votes"] += 1
+            group["confidence"] += candidate["confidence"] or 0.0
+            if (candidate["confidence"] or 0.0) > (group["best"]["confidence"] or 0.0):
+                group["best"] = candidate
+        winner = max(
+            groups.values(),
+            key=lambda group: (group["votes"], group["confidence"], -group["first"]),
+        )
+
+        with self.lock:
+            self.stats["answered"] += 1
+            if len(groups) > 1:
+                self.stats["conflicts"] += 1
+            if not grounded:
+                self.stats["ungrounded"] += 1
+        print(
+            f"Reconciled {questionid}: {winner['best']['value']} "
+            f"({winner['votes']} of {len(candidates)} windows, {len(groups)} distinct values)"
+        )
+        return winner["best"]["value"]
+
+    def record(self, windows, prompts):
+        with self.lock:
+            self.stats["contracts"] += 1
+            self.stats["windows"] += windows
+            self.stats["prompts"] += prompts
+
+    def metrics(self):
+        """
+        Returns the contracts extracted in windows, their windows and prompts, and the reconciled
+        questions: answered by at least one window, with conflicting values across windows, and
+        answered only by values not found in their window.
+
+        Returns:
+            dict: The metrics.
+        """
+        with self.lock:
+            stats = dict(self.stats)
+        contracts = stats.get("contracts", 0)
+        return {
+            "contracts": contracts,
+            "windows": stats.get("windows", 0),
+            "mean_windows": stats.get("windows", 0) / contracts if contracts else None,
+            "prompts": stats.get("prompts", 0),
+            "answered": stats.get("answered", 0),
+            "conflicts": stats.get("conflicts", 0),
+            "ungrounded": stats.get("ungrounded", 0),
+        }
@@ -0,0 +1,154 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PipelineCancelledError(Exception):
+    """The result of a contract that was skipped because its run was cancelled."""
+
+
+class ContractPipeline:
+    """
+    A staged pipeline that processes many contracts with overlapping download, OCR and generation.
+
+    Downloads and OCR run in thread pools (the heavy OCR work happens in the tesseract and poppler
+    subprocesses), generation runs in a single long-lived thread fed by a bounded queue. While the
+    model generates the answers of one contract, the next ones are already downloaded and OCRed,
+    and OCR workers block when the queue is full so that OCRed text doesn't pile up in memory.
+
+    A run can be cancelled, e.g. when its client disconnects: the contracts that weren't fed yet are
+    not downloaded, and the ones in the pipeline skip their remaining stages. Documents downloaded
+    but not read yet are passed to discard_fn.
+
+    Args:
+        download_fn (Callable[[str], Any]): Downloads a document, e.g. FileReader.read_url.
+        ocr_fn (Callable[[Any], str]): Turns a downloaded document into contract text.
+        generate_fn (Callable[[str], dict]): Runs all questions on a contract text.
+        download_workers (int, optional): Number of concurrent downloads. Defaults to 4.
+        ocr_workers (int, optional): Number of concurrent OCR jobs. Defaults to the number of CPUs.
+        queue_size (int, optional): Number of OCRed contracts waiting for generation. Defaults to 2.
+        max_in_flight (int, optional): Number of contracts of one run between download and result. Defaults to 16.
+        discard_fn (Callable[[Any], None], optional): Frees a downloaded document that is skipped before
+            ocr_fn, e.g. FileReader.delete_local_file. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        download_fn,
+        ocr_fn,
+        generate_fn,
+        download_workers=4,
+        ocr_workers=None,
+        queue_size=2,
+        max_in_flight=16,
+        discard_fn=None,
+    ):
+        self.download_fn = download_fn
+        self.ocr_fn = ocr_fn
+        self.generate_fn = generate_fn
+        self.max_in_flight = max_in_flight
+        self.discard_fn = discard_fn
+
+        self.download_pool = ThreadPoolExecutor(
+            max_workers=download_workers, thread_name_prefix="download"
+        )
+        self.ocr_pool = ThreadPoolExecutor(
+            max_workers=ocr_workers or os.cpu_count(), thread_name_prefix="ocr"
+        )
+        self.generation_queue = queue.Queue(maxsize=queue_size)
+        self.generation_thread = threading.Thread(
+            target=self._generation_loop, name="generation", daemon=True
+        )
+        self.generation_thread.start()
+
+    def _generation_loop(self):
+        while True:
+            item, contract, timings, results, in_flight, cancelled = (
+                self.generation_queue.get()
+            )
+            start_time = time.time()
+            try:
+                if cancelled.is_set():
+                    raise PipelineCancelledError(item)
+                output = self.generate_fn(contract)
+                timings["generation"] = time.time() - start_time
+                results.put((item, output, None, timings))
+            except Exception as e:
+                results.put((item, None, e, timings))
+            finally:
+                in_flight.release()
+
+    def _ocr(self, item, document, results, in_flight, cancelled, timings):
+        start_time = time.time()
+        try:
+            if cancelled.is_set():
+                # ocr_fn would have freed the document
+                if self.discard_fn is not None:
+                    self.discard_fn(document)
+                raise PipelineCancelledError(item)
+            contract = self.ocr_fn(document)
+        except Exception as e:
+            results.put((item, None, e, timings))
+            in_flight.release()
+            return
+        timings["ocr"] = time.time() - start_time
+        # Blocks while the generation stage is busy with earlier contracts
+        self.generation_queue.put(
+            (item, contract, timings, results, in_flight, cancelled)
+        )
+
+    def _download(self, item, results, in_flight, cancelled):
+        start_time = time.time()
+        try:
+            if cancelled.is_set():
+                raise PipelineCancelledError(item)
+            document = self.download_fn(item)
+        except Exception as e:
+            results.put((item, None, e, {}))
+            in_flight.release()
+            return
+        timings = {"download": time.time() - start_time}
+        self.ocr_pool.submit(
+            self._ocr, item, document, results, in_flight, cancelled, timings
+        )
+
+    def run(self, items, cancelled=None):
+        """
+        Processes the given items and yields each result as soon as its contract is done.
+        Closing the generator cancels the run.
+
+        Args:
+            items (list): The items to process, e.g. file URLs.
+            cancelled (threading.Event, optional): Cancels the run when set, from any thread. The
+                skipped contracts fail with PipelineCancelledError. Defaults to None.
+
+        Yields:
+            tuple: The item, the output of generate_fn (None on error), the exception raised
+            by one of the stages (None on success) and the time spent in each stage.
+        """
+        items = list(items)
+        results = queue.Queue()
+        in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        if cancelled is None:
+            cancelled = threading.Event()
+
+        def feed():
+            for item in items:
+                in_flight.acquire()
+                if cancelled.is_set():
+                    in_flight.release()
+                    results.put((item, None, PipelineCancelledError(item), {}))
+                    continue
+                self.download_pool.submit(
+                    self._download, item, results, in_flight, cancelled
+                )
+
+        threading.Thread(target=feed, name="pipeline-feeder", daemon=True).start()
+
+        try:
+            for _ in range(len(items)):
+                yield results.get()
+        finally:
+            cancelled.set()
@@ -0,0 +1,204 @@
+import json
+import re
+import threading
+from collections import defaultdict
+
+MONTHS = r"(?:jan|feb|mar|mär|apr|may|mai|jun|jul|aug|sep|oct|okt|nov|dec|dez)"
+# Entity types a prefilter can require in the contract. The patterns run on the contract's shape
+# (ContractText.shape): lowercase with every digit replaced by 0, most of them start with the literal 0,
+# which the regex engine scans for quickly.
+ENTITY_PATTERNS = {
+    "date": [
+        re.compile(r"0 ?[./-] ?00? ?[./-] ?00"),
+        re.compile(r"0000-00-00"),
+        re.compile(rf"0\.? {MONTHS}"),
+        re.compile(r"0, 0000"),
+    ],
+    "amount": [
+        re.compile(r"0 ?(?:€|\$|£|eur|usd|gbp|chf|dollar|pound|pfund)"),
+        re.compile(r"(?:€|\$|£|eur|usd|gbp|chf) ?0"),
+        # German round amounts, e.g. "4.000,- €" or "4.000,-- EUR"
+        re.compile(r"0,[-–]{1,2} ?(?:€|\$|£|eur|usd|gbp|chf)"),
+    ],
+    "number": [re.compile(r"0")],
+}
+PREFILTER_MODES = ("on", "shadow", "off")
+DIGITS_TO_ZERO = str.maketrans("123456789", "000000000")
+
+
+class ContractText:
+    """
+    The text of a contract as the prefilters read it, computed once per contract and shared by the
+    prefilters of all its questions: the lowercase text, its shape and the entity types found.
+
+    Args:
+        text (str): The text of the contract.
+    """
+
+    def __init__(self, text):
+        self.lower = text.lower()
+        self.shape = self.lower.translate(DIGITS_TO_ZERO)
+        self.entities = {}
+
+    def has_entity(self, entity):
+        if entity not in self.entities:
+            self.entities[entity] = any(
+                pattern.search(self.shape) for pattern in ENTITY_PATTERNS[entity]
+            )
+        return self.entities[entity]
+
+
+class QuestionPrefilter:
+    """
+    The compiled relevance prefilter of a question, defined by the "prefilter" entry of the question in
+    the registry, e.g.
+        {"keywords": ["birth", "born", "geboren"], "regex": ["date of birth"], "entities": ["date"]}
+
+    A contract is relevant if any keyword (case-insensitive substring) or regex (on the lowercase text)
+    is found in it, when keywords or regexes are given, and if it contains every required entity type
+    (see ENTITY_PATTERNS). The checks only have to rule out contracts that surely don't have the answer,
+    a contract they keep is answered by the model.
+
+    Args:
+        spec (dict): The "prefilter" entry of the question.
+
+    Raises:
+        ValueError: If an entity type is unknown or a regex is invalid.
+    """
+
+    def __init__(self, spec):
+        self.keywords = [keyword.lower() for keyword in spec.get("keywords", [])]
+        try:
+            self.regexes = [re.compile(regex) for regex in spec.get("regex", [])]
+        except re.error as e:
+            raise ValueError(f"Invalid prefilter regex: {e}")
+
+        entities = spec.get("entities", [])
+        if isinstance(entities, str):
+            entities = [entities]
+        for entity in entities:
+            if entity not in ENTITY_PATTERNS:
+                raise ValueError(
+                    f"Unknown prefilter entity {entity}. Available entities: {list(ENTITY_PATTERNS)}"
+                )
+        self.entities = entities
+
+    def matches(self, contract):
+        """
+        Checks whether the answer of the question may be in a contract.
+
+        Args:
+            contract (str or ContractText): The contract, as a ContractText to check several questions.
+
+        Returns:
+            bool: True if the answer may be in the contract.
+        """
+        if not isinstance(contract, ContractText):
+            contract = ContractText(contract)
+        if self.keywords or self.regexes:
+            # Substring search is much faster than a regex alternation of the keywords
+            triggered = any(
+                keyword in contract.lower for keyword in self.keywords
+            ) or any(regex.search(contract.lower) for regex in self.regexes)
+            if not triggered:
+                return False
+        return all(contract.has_entity(entity) for entity in self.entities)
+
+
+class RelevancePrefilter:
+    """
+    Skips questions whose answer can't be in a contract, without calling the model: questions with a
+    "prefilter" entry in the registry are answered "N/A" when their prefilter doesn't match the contract.
+
+    In shadow mode, the questions still run and the prefilter only counts the questions it would have
+    skipped, and those it would have skipped wrongly (the model found an answer), to measure a prefilter
+    before turning it on.
+
+    Args:
+        mode (str, optional): "on", "shadow" or "off". Defaults to "shadow".
+
+    Raises:
+        ValueError: If the mode is unknown.
+    """
+
+    def __init__(self, mode="shadow"):
+        if mode not in PREFILTER_MODES:
+            raise ValueError(
+                f"Unknown prefilter mode {mode}. Available modes: {PREFILTER_MODES}"
+            )
+        self.mode = mode
+        self.lock = threading.Lock()
+        # (questionid, serialized spec) -> QuestionPrefilter, recompiled when the registry entry changes
+        self.compiled = {}
+        self.stats = defaultdict(lambda: defaultdict(int))
+
+    def _get_prefilter(self, questionid, spec):
+        key = (questionid, json.dumps(spec, sort_keys=True))
+        prefilter = self.compiled.get(key)
+        if prefilter is None:
+            prefilter = QuestionPrefilter(spec)
+            with self.lock:
+                self.compiled[key] = prefilter
+        return prefilter
+
+    def is_relevant(self, questionid, obj_dict, contract):
+        """
+        Checks whether a question may be answered by a contract. Questions without a prefilter always are.
+
+        Args:
+            questionid (str): The question ID.
+            obj_dict (Mapping): The entry of the question in the registry.
+            contract (str or ContractText): The contract, as a ContractText to check several questions.
+
+        Returns:
+            bool: False if the prefilter doesn't match the contract, in "on" and "shadow" mode.
+        """
+        spec = obj_dict.get("prefilter")
+        if self.mode == "off" or not spec:
+            return True
+        relevant = self._get_prefilter(questionid, spec).matches(contract)
+        with self.lock:
+            stats = self.stats[questionid]
+            stats["checked"] += 1
+            if not relevant:
+                stats["skipped"] += 1
+        return relevant
+
+    def record_shadow_result(self, questionid, value):
+        """
+        Records the answer of a question the prefilter would have skipped in shadow mode. An answer
+        other than "N/A" is a false skip.
+        """
+        if value != "N/A":
+            with self.lock:
+                self.stats[questionid]["false_skips"] += 1
+
+    def metrics(self):
+        """
+        Returns the checked and skipped questions and the skip rate per questionid, and in shadow mode
+        the false skips and their rate among the skipped questions.
+
+        Returns:
+            dict: The mode and the metrics of each questionid.
+        """
+        with self.lock:
+            stats = {
+                questionid: dict(question_stats)
+                for questionid, question_stats in self.stats.items()
+            }
+        questions = {}
+        for questionid, question_stats in stats.items():
+            checked = question_stats.get("checked", 0)
+            skipped = question_stats.get("skipped", 0)
+            questions[questionid] = {
+                "checked": checked,
+                "skipped": skipped,
+                "skip_rate": skipped / checked if checked else None,
+            }
+            if self.mode == "shadow":
+                false_skips = question_stats.get("false_skips", 0)
+                questions[questionid]["false_skips"] = false_skips
+                questions[questionid]["false_skip_rate"] = (
+                    false_skips / skipped if skipped else None
+                )
+        return {"mode": self.mode, "questions": questions}
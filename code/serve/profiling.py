@@ -0,0 +1,281 @@
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+
+# Leaf frames of threads waiting for work, not counted as CPU samples
+IDLE_FILES = (
+    "threading.py",
+    "queue.py",
+    "selectors.py",
+    os.path.join("concurrent", "futures", "thread.py"),
+)
+
+
+class ProfileSession:
+    """
+    Profiles the process while one request runs: a sampling CPU profile of all threads and a
+    tracemalloc snapshot of the allocations. Started by RequestProfiler.start.
+
+    The profiles are process-wide. RequestProfiler profiles one request at a time, but work running
+    at the same time in other threads (requests that aren't profiled, pipeline runs, backfills) is
+    sampled and traced too.
+
+    On stop, writes to the output directory:
+        <name>.folded: The CPU samples as folded stacks ("frame;frame;frame count"), for flamegraph.pl
+            or speedscope.
+        <name>.tracemalloc: The allocation snapshot, loadable with tracemalloc.Snapshot.load.
+        <name>_summary.txt: The functions with the most CPU time (including their callees) and the
+            lines with the most allocated memory.
+    """
+
+    def __init__(self, profiler, label):
+        self.profiler = profiler
+        self.profile_id = uuid.uuid4().hex[:12]
+        self.name = "{}_{}_{}".format(
+            time.strftime("%Y%m%d-%H%M%S"),
+            label.strip("/").replace("/", "_"),
+            self.profile_id,
+        )
+        self.stacks = Counter()
+        self.idle_samples = 0
+        self.running = True
+        self.start_time = time.time()
+        self.sampler = threading.Thread(
+            target=self._sample_loop, name="profile-sampler", daemon=True
+        )
+        self.sampler.start()
+
+    def _sample_loop(self):
+        own_thread_id = threading.get_ident()
+        while self.running:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread_id:
+                    continue
+                if frame.f_code.co_filename.endswith(IDLE_FILES):
+                    self.idle_samples += 1
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                    )
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.profiler.sample_interval)
+
+    def stop(self):
+        """
+        Stops the session and writes its profiles.
+
+        Returns:
+            str: The path prefix of the written files.
+        """
+        self.running = False
+        self.sampler.join()
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            ]
+        )
+        _, peak_memory = tracemalloc.get_traced_memory()
+        self.profiler._finish_session()
+        elapsed = time.time() - self.start_time
+
+        path = os.path.join(self.profiler.output_dir, self.name)
+        with open(path + ".folded", "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        snapshot.dump(path + ".tracemalloc")
+
+        inclusive = Counter()
+        for stack, count in self.stacks.items():
+            for function in set(stack.split(";")):
+                inclusive[function] += count
+        interval = self.profiler.sample_interval
+        with open(path + "_summary.txt", "w") as f:
+            f.write("Process-wide profile, includes the work of other threads\n")
+            f.write(f"Elapsed: {elapsed:.3f} s\n")
+            f.write(f"Peak traced memory: {peak_memory / 1024 / 1024:.1f} MB\n")
+            f.write(
+                f"Samples: {sum(self.stacks.values())} busy, {self.idle_samples} idle, "
+                f"every {interval * 1000:.0f} ms\n\n"
+            )
+            f.write("CPU time including callees (approximate seconds):\n")
+            for function, count in inclusive.most_common(self.profiler.top):
+                f.write(f"{count * interval:10.3f}  {function}\n")
+            f.write("\nAllocated memory by line:\n")
+            for stat in snapshot.statistics("lineno")[: self.profiler.top]:
+                f.write(f"{stat}\n")
+        print("Profile written: ", path)
+        return path
+
+
+class RequestProfiler:
+    """
+    Opt-in profiling of live requests. A request is profiled if it has the X-Profile header (when
+    allow_header is True) or if profiling was armed for the next requests of its path. Otherwise the
+    only cost is the check.
+
+    The profiles cover the whole process, so one request is profiled at a time. A request selected
+    while another one is profiled is not profiled and counted as skipped, and an armed request is
+    left for a later request of its path.
+
+    Args:
+        output_dir (str): The directory the profiles are written to.
+        sample_interval (float, optional): Seconds between CPU samples. Defaults to 0.005.
+        tracemalloc_frames (int, optional): Frames stored per allocation. Defaults to 10.
+        top (int, optional): Number of entries of the summaries. Defaults to 30.
+        allow_header (bool, optional): Whether clients can profile a request with the X-Profile header,
+            which starts tracemalloc and writes files. Defaults to False, only armed requests are profiled.
+    """
+
+    def __init__(
+        self,
+        output_dir,
+        sample_interval=0.005,
+        tracemalloc_frames=10,
+        top=30,
+        allow_header=False,
+    ):
+        self.output_dir = output_dir
+        self.sample_interval = sample_interval
+        self.tracemalloc_frames = tracemalloc_frames
+        self.top = top
+        self.allow_header = allow_header
+        self.lock = threading.Lock()
+        # path -> number of next requests to profile
+        self.armed = {}
+        self.active = False
+        self.skipped = 0
+        self.started_tracemalloc = False
+
+    def arm(self, path, count):
+        """Profiles the next count requests of a path, e.g. "/v1/process_contract"."""
+        with self.lock:
+            if count > 0:
+                self.armed[path] = count
+            else:
+                self.armed.pop(path, None)
+
+    def armed_requests(self):
+        with self.lock:
+            return dict(self.armed)
+
+    def should_profile(self, path, headers):
+        """
+        Checks whether a request is profiled, and counts it against the armed requests of its path.
+        A profiled request must be started with start.
+
+        Args:
+            path (str): The path of the request.
+            headers (Mapping): The headers of the request.
+
+        Returns:
+            bool: True if the request is profiled.
+        """
+        requested = False
+        if self.allow_header:
+            requested = headers.get("X-Profile", "").lower() in ("1", "true")
+        if not requested and not self.armed:
+            return False
+        with self.lock:
+            remaining = self.armed.get(path, 0)
+            if not requested and remaining <= 0:
+                return False
+            if self.active:
+                self.skipped += 1
+                return False
+            if not requested:
+                if remaining == 1:
+                    del self.armed[path]
+                else:
+                    self.armed[path] = remaining - 1
+            self.active = True
+            return True
+
+    def start(self, label):
+        """
+        Starts profiling a request selected by should_profile.
+
+        Args:
+            label (str): The label of the profile files, e.g. the request path.
+
+        Returns:
+            ProfileSession: The session, to be stopped when the request is done.
+        """
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            with self.lock:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start(self.tracemalloc_frames)
+                    self.started_tracemalloc = True
+            return ProfileSession(self, label)
+        except BaseException:
+            self._finish_session()
+            raise
+
+    def _finish_session(self):
+        with self.lock:
+            if self.started_tracemalloc:
+                # Tracing slows every allocation down, it only runs while a request is profiled
+                tracemalloc.stop()
+                self.started_tracemalloc = False
+            self.active = False
+
+    def list_profiles(self):
+        """Returns the names of the written profiles, newest first."""
+        if not os.path.exists(self.output_dir):
+            return []
+        return sorted(
+            (
+                name[: -len("_summary.txt")]
+                for name in os.listdir(self.output_dir)
+                if name.endswith("_summary.txt")
+            ),
+            reverse=True,
+        )
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware profiling the requests selected by a RequestProfiler. Other requests are passed
+    to the app untouched, streamed responses included. A profiled request is profiled until its
+    response is sent completely, and its response has the X-Profile-Id header with the name of the profile.
+
+    Args:
+        app (ASGIApp): The wrapped application.
+        profiler (RequestProfiler): Selects and profiles the requests.
+    """
+
+    def __init__(self, app, profiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.profiler.should_profile(
+            scope["path"], Headers(scope=scope)
+        ):
+            return await self.app(scope, receive, send)
+
+        session = self.profiler.start(scope["path"])
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"x-profile-id", session.name.encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            await run_in_threadpool(session.stop)
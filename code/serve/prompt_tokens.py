@@ -0,0 +1,169 @@
+import os
+import threading
+
+CONTRACT_PLACEHOLDER = "{contract}"
+
+
+class PromptTooLongError(ValueError):
+    """Raised when a prompt and its generated tokens don't fit in the model's context."""
+
+    def __init__(self, num_tokens, max_new_tokens, max_model_len):
+        super().__init__(
+            f"The prompt has {num_tokens} tokens, with {max_new_tokens} generated tokens it exceeds "
+            f"the model's context of {max_model_len} tokens."
+        )
+        self.num_tokens = num_tokens
+        self.max_model_len = max_model_len
+
+
+class TokenizedPrompt:
+    """
+    A prompt already tokenized for a model. Backends serving the same model submit the token ids,
+    the others the text. The text is only joined when it is needed.
+
+    Args:
+        token_ids (list[int]): The token ids of the prompt.
+        parts (list[str]): The text of the prompt, in parts.
+        model (str): The model whose tokenizer produced the token ids.
+    """
+
+    def __init__(self, token_ids, parts, model):
+        self.token_ids = token_ids
+        self.parts = parts
+        self.model = model
+
+    def __str__(self):
+        return "".join(self.parts)
+
+
+def prompt_text(prompt):
+    """Returns the text of a prompt, str or TokenizedPrompt."""
+    return prompt if isinstance(prompt, str) else str(prompt)
+
+
+class PromptAssembler:
+    """
+    Assembles the prompts of a contract from token ids instead of formatting and re-tokenizing the
+    whole contract for every question.
+
+    Each prompt file is split around {contract} into a static prefix and suffix, which are tokenized once
+    (again if the file changes). The contract is tokenized once per request, and the token ids of a
+    question's prompt are the concatenation prefix + contract + suffix. The contract and the suffix are
+    tokenized as continuations of a newline, so the result equals tokenizing the formatted prompt when
+    {contract} is on its own line, as in the exp4 templates.
+
+    Args:
+        tokenizer: The Hugging Face tokenizer of the model.
+        model (str): The model name, see TokenizedPrompt.
+        template_folder (str): The folder of the prompt files.
+        max_model_len (int): The context length of the model.
+        max_new_tokens (int, optional): The number of tokens generated after the prompt. Defaults to 128.
+    """
+
+    def __init__(
+        self, tokenizer, model, template_folder, max_model_len, max_new_tokens=128
+    ):
+        self.tokenizer = tokenizer
+        self.model = model
+        self.template_folder = template_folder
+        self.max_model_len = max_model_len
+        self.max_new_tokens = max_new_tokens
+        self.anchor = "\n"
+        self.anchor_ids = tokenizer.encode(self.anchor, add_special_tokens=False)
+        self.templates = {}
+        self.lock = threading.Lock()
+
+    def _encode_continuation(self, text):
+        token_ids = self.tokenizer.encode(self.anchor + text, add_special_tokens=False)
+        if token_ids[: len(self.anchor_ids)] == self.anchor_ids:
+            return token_ids[len(self.anchor_ids) :]
+        # The anchor merged with the text, tokenize the text on its own
+        return self.tokenizer.encode(text, add_special_tokens=False)
+
+    def load_template(self, prompt_file):
+        """
+        Returns the tokenized prefix and suffix of a prompt file, tokenizing them if the file is new or changed.
+
+        Args:
+            prompt_file (str): The name of the prompt file in template_folder.
+
+        Returns:
+            dict: The "prefix" and "suffix" text and their "prefix_ids" and "suffix_ids".
+
+        Raises:
+            ValueError: If the prompt file has no {contract} placeholder.
+        """
+        path = os.path.join(self.template_folder, prompt_file)
+        modified_at = os.stat(path).st_mtime_ns
+        template = self.templates.get(prompt_file)
+        if template is not None and template["modified_at"] == modified_at:
+            return template
+
+        with open(path, "r") as f:
+            text = f.read()
+        if CONTRACT_PLACEHOLDER not in text:
+            raise ValueError(
+                f"Prompt file {prompt_file} has no {CONTRACT_PLACEHOLDER}."
+            )
+        prefix, suffix = text.split(CONTRACT_PLACEHOLDER, 1)
+        # Same unescaping of {{ and }} as PromptTemplate.format
+        prefix, suffix = prefix.format(), suffix.format()
+        template = {
+            "modified_at": modified_at,
+            "prefix": prefix,
+            "suffix": suffix,
+            "prefix_ids": self.tokenizer.encode(prefix),
+            "suffix_ids": self._encode_continuation(suffix),
+        }
+        with self.lock:
+            self.templates[prompt_file] = template
+        return template
+
+    def preload(self, prompt_files):
+        """Tokenizes the given prompt files ahead of the first request."""
+        for prompt_file in prompt_files:
+            self.load_template(prompt_file)
+
+    def encode_contract(self, contract):
+        """
+        Tokenizes a contract, to be passed to assemble for every question.
+
+        Args:
+            contract (str): The text of the contract.
+
+        Returns:
+            list[int]: The token ids of the contract.
+        """
+        return self._encode_continuation(contract)
+
+    def check_length(self, num_tokens):
+        """
+        Raises:
+            PromptTooLongError: If a prompt of num_tokens and the generated tokens exceed max_model_len.
+        """
+        if num_tokens + self.max_new_tokens > self.max_model_len:
+            raise PromptTooLongError(
+                num_tokens, self.max_new_tokens, self.max_model_len
+            )
+
+    def assemble(self, prompt_file, contract, contract_ids):
+        """
+        Assembles the prompt of a question for a contract.
+
+        Args:
+            prompt_file (str): The name of the prompt file of the question.
+            contract (str): The text of the contract.
+            contract_ids (list[int]): The token ids of the contract, from encode_contract.
+
+        Returns:
+            TokenizedPrompt: The prompt.
+
+        Raises:
+            PromptTooLongError: If the prompt doesn't fit in the model's context.
+        """
+        template = self.load_template(prompt_file)
+        token_ids = template["prefix_ids"] + contract_ids + template["suffix_ids"]
+        self.check_length(len(token_ids))
+        return TokenizedPrompt(
+            token_ids, [template["prefix"], contract, template["suffix"]], self.model
+        )
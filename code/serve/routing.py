@@ -0,0 +1,233 @@
+import math
+import re
+import threading
+from collections import defaultdict
+
+from post_operations.parsing import ExtractedDate, parse_output_with_error
+from qa.qualitycheck import check_contract_includes_date, validate_date
+from prompt_tokens import TokenizedPrompt
+
+# A whole number of the text with its separators, e.g. "4.000,00", "3,5", "1'200" or "2023"
+NUMBER_PATTERN = re.compile(r"\d+(?:[.,']\d+)*")
+
+
+def estimate_tokens(text):
+    """
+    Rough token count of a text, ~4 characters per token for Mistral's tokenizer on contracts.
+    The count of a TokenizedPrompt is exact.
+    """
+    if isinstance(text, TokenizedPrompt):
+        return len(text.token_ids)
+    return len(text) // 4 + 1
+
+
+def number_values(token):
+    """
+    Returns the values a number of a contract can be read as, with German ("4.000,50") or English
+    ("4,000.50") separators. "4.000" can be 4000 or 4.0, both are returned.
+
+    Args:
+        token (str): A number matched by NUMBER_PATTERN.
+
+    Returns:
+        set[float]: The possible values.
+    """
+    token = token.replace("'", "")
+    if "." in token and "," in token:
+        # The last separator is the decimal one
+        decimal, thousands = (
+            (",", ".") if token.rfind(",") > token.rfind(".") else (".", ",")
+        )
+        return {float(token.replace(thousands, "").replace(decimal, "."))}
+    for separator in (",", "."):
+        if separator in token:
+            parts = token.split(separator)
+            values = set()
+            if all(len(part) == 3 for part in parts[1:]):
+                values.add(float("".join(parts)))
+            if len(parts) == 2:
+                values.add(float(parts[0] + "." + parts[1]))
+            return values
+    return {float(token)}
+
+
+def is_grounded(value, contract, parser):
+    """
+    Checks that an extracted value appears in the contract.
+
+    Args:
+        value: The parsed value.
+        contract (str): The text of the contract.
+        parser (PydanticOutputParser): The parser the value was extracted with.
+
+    Returns:
+        bool: True if the value is found in the contract.
+    """
+    if parser.pydantic_object is ExtractedDate:
+        return validate_date(value) and check_contract_includes_date(contract, value)
+
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        # Compared with the whole numbers of the contract, "3" isn't found in "2023" and 4000 is found in "4.000,00"
+        target = abs(float(value))
+        return any(
+            math.isclose(candidate, target, rel_tol=1e-9)
+            for token in NUMBER_PATTERN.findall(contract)
+            for candidate in number_values(token)
+        )
+
+    normalized_contract = " ".join(contract.split()).lower()
+    normalized_value = " ".join(str(value).split()).lower()
+    if normalized_value in normalized_contract:
+        return True
+    # Names and addresses are often reformatted, accept if most of their words are found
+    words = normalized_value.replace(",", " ").split()
+    found = sum(word in normalized_contract for word in words)
+    return len(words) > 0 and found / len(words) >= 0.8
+
+
+class ModelRouter:
+    """
+    Routes each question to a tier of generation backends, from the cheapest to the most expensive.
+
+    A question starts at its configured tier and is escalated to the next tier only when the answer
+    fails parsing, isn't found in the contract, or the backend's confidence is below min_confidence.
+    The last tier's answer is always accepted. Calls that are not tied to a question (e.g. repairs,
+    the windows of long contracts) go to the last tier.
+
+    Args:
+        min_confidence (float, optional): The lowest accepted confidence (geometric mean of the token
+            probabilities). Defaults to 0.6.
+        escalate_not_available (bool, optional): Whether an "N/A" answer is escalated, in case the cheap
+            model missed the information. Defaults to True.
+    """
+
+    def __init__(self, min_confidence=0.6, escalate_not_available=True):
+        self.min_confidence = min_confidence
+        self.escalate_not_available = escalate_not_available
+        self.tiers = []
+        self.question_tiers = {}
+        # Shared by the worker threads generating answers
+        self.lock = threading.Lock()
+        self.stats = defaultdict(lambda: defaultdict(float))
+
+    def register_backend(self, name, backend, cost_per_1k_tokens=0.0):
+        """
+        Adds a tier after the registered ones.
+
+        Args:
+            name (str): The name of the tier.
+            backend (GenerationBackend): The backend of the tier.
+            cost_per_1k_tokens (float, optional): The cost of 1000 prompt and output tokens. Defaults to 0.0.
+        """
+        self.tiers.append(
+            {"name": name, "backend": backend, "cost_per_1k_tokens": cost_per_1k_tokens}
+        )
+
+    def set_question_tier(self, questionid, tier_name):
+        """
+        Sets the tier a question starts at. Questions without a tier start at the last (largest) tier.
+
+        Raises:
+            ValueError: If the tier is not registered.
+        """
+        if tier_name not in [tier["name"] for tier in self.tiers]:
+            raise ValueError(f"Tier {tier_name} is not registered.")
+        self.question_tiers[questionid] = tier_name
+
+    def _start_index(self, questionid):
+        tier_name = self.question_tiers.get(questionid)
+        if tier_name is None:
+            return len(self.tiers) - 1
+        return [tier["name"] for tier in self.tiers].index(tier_name)
+
+    def _record(self, tier, prompt, output, accepted):
+        tokens = estimate_tokens(prompt) + estimate_tokens(output)
+        with self.lock:
+            stats = self.stats[tier["name"]]
+            stats["requests"] += 1
+            stats["accepted" if accepted else "escalated"] += 1
+            stats["tokens"] += tokens
+            stats["cost"] += tokens / 1000 * tier["cost_per_1k_tokens"]
+
+    def generate_for_question(self, questionid, prompt, parser, contract):
+        """
+        Generates the answer of a question, escalating through the tiers as needed.
+
+        Args:
+            questionid (str): The question ID.
+            prompt (str): The formatted prompt.
+            parser (PydanticOutputParser): The parser of the question.
+            contract (str): The text of the contract, to check grounding.
+
+        Returns:
+            str: The raw output of the accepted tier.
+        """
+        for index in range(self._start_index(questionid), len(self.tiers)):
+            tier = self.tiers[index]
+            output, confidence = tier["backend"].generate_with_confidence([prompt])[0]
+            if index == len(self.tiers) - 1:
+                self._record(tier, prompt, output, accepted=True)
+                return output
+
+            value, error = parse_output_with_error(output, parser)
+            if error is not None:
+                reason = "parsing failed"
+            elif value == "N/A":
+                reason = "not available" if self.escalate_not_available else None
+            elif not is_grounded(value, contract, parser):
+                reason = "not found in contract"
+            elif confidence is not None and confidence < self.min_confidence:
+                reason = f"low confidence {confidence:.2f}"
+            else:
+                reason = None
+
+            self._record(tier, prompt, output, accepted=reason is None)
+            if reason is None:
+                return output
+            print(f"Escalating {questionid} from {tier['name']}: {reason}")
+
+    def __call__(self, prompt):
+        tier = self.tiers[-1]
+        output = tier["backend"](prompt)
+        self._record(tier, prompt, output, accepted=True)
+        return output
+
+    def batch(self, prompts):
+        tier = self.tiers[-1]
+        outputs = tier["backend"].batch(prompts)
+        for prompt, output in zip(prompts, outputs):
+            self._record(tier, prompt, output, accepted=True)
+        return outputs
+
+    def generate_with_confidence(self, prompts):
+        tier = self.tiers[-1]
+        results = tier["backend"].generate_with_confidence(prompts)
+        for prompt, (output, _) in zip(prompts, results):
+            self._record(tier, prompt, output, accepted=True)
+        return results
+
+    def metrics(self):
+        """
+        Returns the requests, hit rate (share of answers accepted at the tier) and estimated cost per tier.
+
+        Returns:
+            dict: The metrics of each tier.
+        """
+        with self.lock:
+            all_stats = {
+                tier["name"]: defaultdict(float, self.stats[tier["name"]])
+                for tier in self.tiers
+            }
+        metrics = {}
+        for name, stats in all_stats.items():
+            metrics[name] = {
+                "requests": int(stats["requests"]),
+                "accepted": int(stats["accepted"]),
+                "escalated": int(stats["escalated"]),
+                "hit_rate": (
+                    stats["accepted"] / stats["requests"] if stats["requests"] else None
+                ),
+                "estimated_tokens": int(stats["tokens"]),
+                "estimated_cost": stats["cost"],
+            }
+        return metrics
@@ -0,0 +1,223 @@
+import heapq
+import itertools
+import math
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import Future
+
+# Priority classes, lower runs first
+INTERACTIVE = 0
+STANDARD = 1
+BULK = 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", STANDARD: "standard", BULK: "bulk"}
+
+
+class QueueFullError(Exception):
+    """Raised when a scheduler can't admit more work. retry_after is the estimated wait in seconds."""
+
+    def __init__(self, scheduler_name, retry_after):
+        super().__init__(
+            f"{scheduler_name} queue is full, retry after {retry_after} seconds."
+        )
+        self.retry_after = retry_after
+
+
+class RequestScheduler:
+    """
+    A bounded, priority-ordered work queue in front of a stage with limited capacity (e.g. the LLM or OCR).
+
+    Work runs on a fixed number of worker threads. Queued work is ordered by priority class first and
+    then by fair queuing between clients: every client's next item is tagged one round after its previous
+    item (or after the current round), so a client submitting many items can't starve the others of the
+    same priority. Work is rejected with QueueFullError once the queue, or the share of a single client,
+    is full.
+
+    Args:
+        name (str): The name of the stage, used in errors and metrics.
+        workers (int, optional): Number of items processed at the same time. Defaults to 1.
+        max_queue_depth (int, optional): Number of items waiting to be processed. Defaults to 32.
+        max_queued_per_client (int, optional): Number of waiting items of a single client. Defaults to 8.
+    """
+
+    def __init__(self, name, workers=1, max_queue_depth=32, max_queued_per_client=8):
+        self.name = name
+        self.workers = workers
+        self.max_queue_depth = max_queue_depth
+        self.max_queued_per_client = max_queued_per_client
+
+        self.condition = threading.Condition()
+        self.queue = []
+        self.sequence = itertools.count()
+        # priority -> round of the last started item
+        self.virtual_time = defaultdict(int)
+        # (priority, client_id) -> round of the client's last queued item, and its number of queued items
+        self.client_tags = {}
+        self.queued_per_tag_key = defaultdict(int)
+        self.queued_per_client = defaultdict(int)
+        self.queued_per_priority = defaultdict(int)
+        self.in_flight = 0
+
+        # Metrics
+        self.admitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_times = deque(maxlen=1000)
+        self.service_times = deque(maxlen=1000)
+
+        for i in range(workers):
+            threading.Thread(
+                target=self._worker_loop, name=f"{name}-worker-{i}", daemon=True
+            ).start()
+
+    def estimate_retry_after(self):
+        """Estimates the seconds until the queue has room, from the recent service times."""
+        if self.service_times:
+            mean_service_time = sum(self.service_times) / len(self.service_times)
+        else:
+            mean_service_time = 1.0
+        return max(
+            1, math.ceil(mean_service_time * (len(self.queue) + 1) / self.workers)
+        )
+
+    def check_admission(self, client_id=None):
+        """
+        Fails fast if an item of the client would be rejected now.
+
+        Args:
+            client_id (str, optional): The client submitting the work. Defaults to None.
+
+        Raises:
+            QueueFullError: If the queue or the client's share of it is full.
+        """
+        with self.condition:
+            self._check_admission(client_id)
+
+    def _check_admission(self, client_id):
+        if (
+            len(self.queue) >= self.max_queue_depth
+            or self.queued_per_client.get(client_id, 0) >= self.max_queued_per_client
+        ):
+            self.rejected += 1
+            raise QueueFullError(self.name, self.estimate_retry_after())
+
+    def submit(self, fn, *args, priority=STANDARD, client_id=None, admit=True):
+        """
+        Queues fn(*args) for execution.
+
+        Args:
+            fn (Callable): The work to run.
+            *args: The arguments of fn.
+            priority (int, optional): INTERACTIVE, STANDARD or BULK. Defaults to STANDARD.
+            client_id (str, optional): The client submitting the work. Defaults to None.
+            admit (bool, optional): Whether the queue limits apply. Internal stages that already bound
+                their own work can bypass them. Defaults to True.
+
+        Returns:
+            Future: The future of the result of fn.
+
+        Raises:
+            QueueFullError: If admit is True and the queue or the client's share of it is full.
+        """
+        future = Future()
+        with self.condition:
+            if admit:
+                self._check_admission(client_id)
+            tag = (
+                max(
+                    self.client_tags.get((priority, client_id), 0),
+                    self.virtual_time[priority],
+                )
+                + 1
+            )
+            self.client_tags[(priority, client_id)] = tag
+            self.queued_per_tag_key[(priority, client_id)] += 1
+            heapq.heappush(
+                self.queue,
+                (
+                    priority,
+                    tag,
+                    next(self.sequence),
+                    (fn, args, future, client_id, time.monotonic()),
+                ),
+            )
+            self.queued_per_client[client_id] += 1
+            self.queued_per_priority[priority] += 1
+            self.admitted += 1
+            self.condition.notify()
+        return future
+
+    def _worker_loop(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                priority, tag, _, item = heapq.heappop(self.queue)
+                fn, args, future, client_id, queued_at = item
+
+                self.virtual_time[priority] = tag
+                self.queued_per_priority[priority] -= 1
+                self.queued_per_client[client_id] -= 1
+                if self.queued_per_client[client_id] == 0:
+                    del self.queued_per_client[client_id]
+                self.queued_per_tag_key[(priority, client_id)] -= 1
+                if self.queued_per_tag_key[(priority, client_id)] == 0:
+                    # The client's next item starts from the current round again
+                    del self.queued_per_tag_key[(priority, client_id)]
+                    del self.client_tags[(priority, client_id)]
+                self.in_flight += 1
+                self.wait_times.append(time.monotonic() - queued_at)
+
+            start_time = time.monotonic()
+            try:
+                future.set_result(fn(*args))
+                succeeded = True
+            except BaseException as e:
+                future.set_exception(e)
+                succeeded = False
+
+            with self.condition:
+                self.in_flight -= 1
+                self.service_times.append(time.monotonic() - start_time)
+                if succeeded:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+
+    def metrics(self):
+        """
+        Returns the queue depth and wait time metrics of the scheduler.
+
+        Returns:
+            dict: The metrics.
+        """
+        with self.condition:
+            wait_times = sorted(self.wait_times)
+            service_times = list(self.service_times)
+            return {
+                "queue_depth": len(self.queue),
+                "queue_depth_per_priority": {
+                    PRIORITY_NAMES.get(priority, str(priority)): depth
+                    for priority, depth in self.queued_per_priority.items()
+                },
+                "in_flight": self.in_flight,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "failed": self.failed,
+                "wait_time_p50": percentile(wait_times, 50),
+                "wait_time_p95": percentile(wait_times, 95),
+                "wait_time_max": wait_times[-1] if wait_times else None,
+                "service_time_mean": (
+                    sum(service_times) / len(service_times) if service_times else None
+                ),
+            }
+
+
+def percentile(sorted_values, q):
+    """Returns the q-th percentile of an already sorted list, or None if it is empty."""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(q / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
@@ -1,12 +1,21 @@
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse, Response
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi import FastAPI
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
 from langchain.llms import VLLM
 import time
 import uvicorn
 from langchain.output_parsers import PydanticOutputParser
 from langchain.evaluation import load_evaluator, StringDistance
+import hashlib
+import hmac
+import json
+import os
+import queue
+import threading
 import sys
+import uuid
+from urllib.parse import urlparse
 
 sys.path.append("../")
 # from model.ModelOps import ModelOps
@@ -18,6 +27,7 @@ from post_operations.parsing import (
 )
 from prompts.generate_prompts import partial_format
 from data.FileReader import FileReader
+from data.ImagePreparer import ImagePreparer
 from utils import (
     QuestionIdManager,
     PydanticCategoryManager,
@@ -25,10 +35,32 @@ from utils import (
     include_new_question,
     execute_prompt_and_parse,
     process_single_question,
+    process_contract_questions,
     load_template,
+    get_prompt_versions,
+    backfill_batch,
 )
-from eval.evaluation import evaluate_string_similarity, evaluate_number_similarity
+from pipeline import ContractPipeline
+from extraction_store import ExtractionStore
+from profiling import ProfilingMiddleware, RequestProfiler
+from prefilter import RelevancePrefilter, QuestionPrefilter
+from map_reduce import MapReduceExtractor
+from coalescing import SingleFlight, IdempotencyStore, IdempotencyKeyReusedError
+from backends import (
+    VLLMBackend,
+    OpenAICompletionBackend,
+    ReplicaPoolBackend,
+    MicroBatchingBackend,
+    generation_affinity,
+)
+from routing import ModelRouter
+from prompt_tokens import PromptAssembler, PromptTooLongError
+from scheduler import RequestScheduler, QueueFullError, INTERACTIVE, STANDARD, BULK
+from eval.evaluation import evaluate_prediction
 from textract.TextractHelper import TextractHelper
+from textract.TextractJobManager import TextractJobManager
+from textract.TextractQueryCache import TextractQueryCache
+from textract.TextractRateLimiter import TextractRateLimiter
 
 ############## SETUP ##############
 model_id = "mistralai/Mistral-7B-Instruct-v0.2"
@@ -38,17 +70,140 @@ question_id_list_file = "question_id_list.json"
 STRING_DISTANCE_THRESHOLD = 0.1  # Levenshtein distance threshold for string similarity
 S3_PROFILE_NAME = "cisem.altan"
 S3_BUCKET_NAME = "cis-idp"
+TEXTRACT_CACHE_FOLDER = "../../data/textract_cache"
+# Seconds, salary slips are resubmitted in monthly runs
+TEXTRACT_CACHE_TTL = 45 * 24 * 3600
+# Calls per second of each Textract operation, the quotas of the account in the Service Quotas console
+TEXTRACT_MAX_TPS = {
+    "analyze_document": 10,
+    "start_document_analysis": 10,
+    "get_document_analysis": 10,
+    "analyze_id": 5,
+}
+TEXTRACT_MAX_CONCURRENCY = 16  # calls in flight per operation, lowered while throttled
 data_folder = "../../data"
-
-llm = VLLM(
-    model=model_id,
-    trust_remote_code=True,  # mandatory for hf models
-    max_new_tokens=128,
-    top_k=10,
-    top_p=0.95,
-    temperature=0.1,
-    vllm_kwargs={"max_model_len": 16000},  # need to state otw vLLM throws an error
+# Text and results of the processed documents, by content hash
+EXTRACTION_DB_FILE = "../../data/extractions.sqlite3"
+BACKFILL_BATCH_SIZE = 32  # (document, question) pairs generated in one engine call
+# CPU and allocation profiles of requests armed with /v1/admin/profile, or with the X-Profile header
+# if allowed (any client could then profile requests)
+PROFILE_FOLDER = "../../data/profiles"
+PROFILE_ALLOW_HEADER = False
+# Bearer token of the /v1/admin/profile endpoints, None disables them (any client could arm profiling)
+PROFILE_ADMIN_TOKEN = None
+DOWNLOAD_WORKERS = 4
+OCR_WORKERS = os.cpu_count()
+# Memory of the pages a worker renders at the same time, long scans are rendered window by window
+PAGE_RENDER_MAX_BYTES = 256 * 1024 * 1024
+GENERATION_QUEUE_SIZE = 2  # OCRed contracts waiting for the GPU
+IDEMPOTENCY_KEY_TTL = 24 * 3600  # seconds
+LLM_MAX_QUEUE_DEPTH = 16  # requests waiting for the model, more are rejected with 429
+OCR_MAX_QUEUE_DEPTH = 64
+MAX_QUEUED_PER_CLIENT = 4
+REPAIR_RETRIES = 1  # batched repair rounds for outputs that fail parsing
+# "on": questions whose prefilter doesn't match the contract are answered N/A without the model,
+# "shadow": they still run and the false skips are counted (see /v1/metrics), "off".
+# Stays "shadow" until the metrics show the false-skip rate of the shipped prefilters.
+PREFILTER_MODE = "shadow"
+MAX_MODEL_LEN = 16000  # need to state otw vLLM throws an error
+MAX_NEW_TOKENS = 128
+# Contracts longer than the context are split into overlapping windows, each question runs on every
+# window in one batch and the answers of the windows are reconciled
+MAP_REDUCE = True
+MAP_REDUCE_OVERLAP_TOKENS = 256
+MAP_REDUCE_MAX_WINDOW_TOKENS = None  # None: windows fill the context
+# Contracts are tokenized once and the prompts of all questions assembled from token ids
+TOKENIZE_PROMPTS = True
+# Cascading routing: when SMALL_MODEL_ID is set, the questions below are first answered by the
+# small model and escalated to model_id only if the answer fails parsing, grounding or confidence
+SMALL_MODEL_ID = None
+SMALL_MODEL_QUESTIONS = [
+    "sign_date",
+    "start_date",
+    "birth_date",
+    "type_of_contract",
+    "employer_name",
+    "job_title",
+]
+ROUTING_MIN_CONFIDENCE = 0.6
+SMALL_MODEL_COST_PER_1K_TOKENS = 0.2  # relative to the large model
+LARGE_MODEL_COST_PER_1K_TOKENS = 1.0
+# Share of the GPU memory of each in-process model, vLLM takes 0.9 by default
+LARGE_MODEL_GPU_MEMORY = 0.9 if SMALL_MODEL_ID is None else 0.6
+SMALL_MODEL_GPU_MEMORY = 0.3
+# When set, generation goes to separate OpenAI-compatible servers (e.g. vLLM's api_server, or
+# stub_generation_server.py for tests) instead of loading the model in this process.
+# Several URLs are replicas of the same model, requests are load-balanced between them.
+GENERATION_SERVER_URLS = []
+SMALL_MODEL_SERVER_URLS = []
+GENERATION_TIMEOUT = 120  # seconds
+GENERATION_MAX_CONNECTIONS = 16  # concurrent requests to each generation server
+REPLICA_HEALTH_CHECK_INTERVAL = 10  # seconds between health checks of ejected replicas
+IN_PROCESS_MODEL = not GENERATION_SERVER_URLS or (
+    SMALL_MODEL_ID is not None and not SMALL_MODEL_SERVER_URLS
 )
+# The prompts of concurrent requests are generated together by an in-process model
+MICRO_BATCHING = True
+MICRO_BATCH_MAX_SIZE = 32  # prompts per engine call
+MICRO_BATCH_MAX_WAIT = 0.01  # seconds a batch waits for more prompts
+MICRO_BATCH_WORKERS = 24  # requests generating at the same time with micro-batching
+
+
+def load_generation_backend(model, server_urls, gpu_memory_utilization):
+    servers = {
+        server_url: OpenAICompletionBackend(
+            server_url,
+            model,
+            max_new_tokens=MAX_NEW_TOKENS,
+            top_k=10,
+            top_p=0.95,
+            temperature=0.1,
+            timeout=GENERATION_TIMEOUT,
+            max_connections=GENERATION_MAX_CONNECTIONS,
+        )
+        for server_url in server_urls
+    }
+    if len(servers) == 1:
+        return list(servers.values())[0]
+    if len(servers) > 1:
+        return ReplicaPoolBackend(
+            servers, health_check_interval=REPLICA_HEALTH_CHECK_INTERVAL
+        )
+    backend = VLLMBackend(
+        VLLM(
+            model=model,
+            trust_remote_code=True,  # mandatory for hf models
+            max_new_tokens=MAX_NEW_TOKENS,
+            top_k=10,
+            top_p=0.95,
+            temperature=0.1,
+            vllm_kwargs={
+                "max_model_len": MAX_MODEL_LEN,
+                "gpu_memory_utilization": gpu_memory_utilization,
+            },
+        )
+    )
+    if MICRO_BATCHING:
+        return MicroBatchingBackend(
+            backend, max_batch_size=MICRO_BATCH_MAX_SIZE, max_wait=MICRO_BATCH_MAX_WAIT
+        )
+    return backend
+
+
+llm = load_generation_backend(model_id, GENERATION_SERVER_URLS, LARGE_MODEL_GPU_MEMORY)
+
+small_llm = None
+if SMALL_MODEL_ID is None:
+    generation_llm = llm
+else:
+    small_llm = load_generation_backend(
+        SMALL_MODEL_ID, SMALL_MODEL_SERVER_URLS, SMALL_MODEL_GPU_MEMORY
+    )
+    generation_llm = ModelRouter(min_confidence=ROUTING_MIN_CONFIDENCE)
+    generation_llm.register_backend("small", small_llm, SMALL_MODEL_COST_PER_1K_TOKENS)
+    generation_llm.register_backend("large", llm, LARGE_MODEL_COST_PER_1K_TOKENS)
+    for questionid in SMALL_MODEL_QUESTIONS:
+        generation_llm.set_question_tier(questionid, "small")
 
 question_id_manager = QuestionIdManager(question_id_list_file)
 pydantic_category_manager = PydanticCategoryManager(
@@ -60,8 +215,45 @@ pydantic_category_manager = PydanticCategoryManager(
     }
 )
 
-filereader = FileReader()
-textract = TextractHelper(S3_PROFILE_NAME, S3_BUCKET_NAME)
+prompt_assembler = None
+if TOKENIZE_PROMPTS:
+    engine = llm.backend if isinstance(llm, MicroBatchingBackend) else llm
+    if isinstance(engine, VLLMBackend):
+        tokenizer = engine.llm.client.get_tokenizer()
+    else:
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(model_id)
+    prompt_assembler = PromptAssembler(
+        tokenizer, model_id, PROMPT_FOLDER, MAX_MODEL_LEN, MAX_NEW_TOKENS
+    )
+    prompt_assembler.preload(
+        obj_dict["prompt_file"]
+        for obj_dict in question_id_manager.get_all_questionids().values()
+    )
+
+extraction_store = ExtractionStore(EXTRACTION_DB_FILE)
+relevance_prefilter = RelevancePrefilter(PREFILTER_MODE)
+map_reduce = None
+if MAP_REDUCE:
+    map_reduce = MapReduceExtractor(
+        PROMPT_FOLDER,
+        MAX_MODEL_LEN,
+        MAX_NEW_TOKENS,
+        overlap_tokens=MAP_REDUCE_OVERLAP_TOKENS,
+        max_window_tokens=MAP_REDUCE_MAX_WINDOW_TOKENS,
+        prompt_assembler=prompt_assembler,
+    )
+request_profiler = RequestProfiler(PROFILE_FOLDER, allow_header=PROFILE_ALLOW_HEADER)
+filereader = FileReader(ImagePreparer(max_window_bytes=PAGE_RENDER_MAX_BYTES))
+textract = TextractHelper(
+    S3_PROFILE_NAME,
+    S3_BUCKET_NAME,
+    query_cache=TextractQueryCache(TEXTRACT_CACHE_FOLDER, ttl=TEXTRACT_CACHE_TTL),
+    rate_limiter=TextractRateLimiter(
+        TEXTRACT_MAX_TPS, max_concurrency=TEXTRACT_MAX_CONCURRENCY
+    ),
+)
 distance_evaluator = load_evaluator(
     "string_distance", distance=StringDistance.LEVENSHTEIN
 )
@@ -69,9 +261,259 @@ webhook_manager = WebhookManager(
     url="https://webhook.site/c14b751e-3823-48ea-b30b-77c840760188"
 )
 
+# A single worker for in-process models without micro-batching, vLLM engine calls are not thread safe
+if not IN_PROCESS_MODEL:
+    llm_workers = GENERATION_MAX_CONNECTIONS * len(GENERATION_SERVER_URLS)
+elif MICRO_BATCHING:
+    llm_workers = MICRO_BATCH_WORKERS
+else:
+    llm_workers = 1
+llm_scheduler = RequestScheduler(
+    "llm",
+    workers=llm_workers,
+    max_queue_depth=LLM_MAX_QUEUE_DEPTH,
+    max_queued_per_client=MAX_QUEUED_PER_CLIENT,
+)
+ocr_scheduler = RequestScheduler(
+    "ocr",
+    workers=OCR_WORKERS,
+    max_queue_depth=OCR_MAX_QUEUE_DEPTH,
+    max_queued_per_client=MAX_QUEUED_PER_CLIENT,
+)
+
+
+def generate_all_answers(contract, on_result=None):
+    # All questions of a contract go to the same replica, which has the contract in its prefix cache
+    with generation_affinity(hashlib.sha1(contract.encode()).hexdigest()):
+        return process_contract_questions(
+            generation_llm,
+            contract,
+            question_id_manager,
+            pydantic_category_manager,
+            PROMPT_FOLDER,
+            repair_retries=REPAIR_RETRIES,
+            prompt_assembler=prompt_assembler,
+            on_result=on_result,
+            prefilter=relevance_prefilter,
+            map_reduce=map_reduce,
+        )
+
+
+def generate_and_store(content_hash, contract, on_result=None):
+    """Runs all included questions on a contract and stores the results with their prompt versions."""
+    prompt_versions = get_prompt_versions(question_id_manager.snapshot(), PROMPT_FOLDER)
+    parsed_output = generate_all_answers(contract, on_result)
+    extraction_store.put_results(
+        content_hash,
+        {
+            questionid: value
+            for questionid, value in parsed_output.items()
+            if questionid in prompt_versions
+        },
+        prompt_versions,
+    )
+    return parsed_output
+
+
+def read_contract_file(
+    filepath, priority=STANDARD, client_id=None, source_url=None, admit=True
+):
+    """
+    Reads a downloaded contract file. Contracts already in the extraction store are not OCRed again,
+    and concurrent reads of the same content share a single OCR.
+
+    Args:
+        filepath (str): The path to the contract file.
+        priority (int, optional): The priority of the OCR. Defaults to STANDARD.
+        client_id (str, optional): The client requesting the contract. Defaults to None.
+        source_url (str, optional): The URL of the contract, kept in the store. Defaults to None.
+        admit (bool, optional): Whether the OCR queue limits apply. Defaults to True.
+
+    Returns:
+        tuple[str, str]: The SHA-256 of the file and the text of the contract.
+    """
+    content_hash = filereader.hash_file(filepath)
+    contract = extraction_store.get_text(content_hash)
+    if contract is None:
+        contract = single_flight.do(
+            ("read_contract", content_hash),
+            lambda: ocr_scheduler.submit(
+                filereader.read_contract,
+                filepath,
+                priority=priority,
+                client_id=client_id,
+                admit=admit,
+            ).result(),
+        )
+        extraction_store.put_document(content_hash, contract, source_url)
+    return content_hash, contract
+
+
+def read_pipeline_contract(filepath):
+    try:
+        return read_contract_file(filepath, priority=BULK, admit=False)
+    finally:
+        filereader.delete_local_file(filepath)
+
+
+# The pipeline bounds its own work, its stages bypass the queue limits but keep the bulk priority
+contract_pipeline = ContractPipeline(
+    download_fn=filereader.read_url,
+    ocr_fn=read_pipeline_contract,
+    generate_fn=lambda document: llm_scheduler.submit(
+        generate_and_store, *document, priority=BULK, admit=False
+    ).result(),
+    download_workers=DOWNLOAD_WORKERS,
+    ocr_workers=OCR_WORKERS,
+    queue_size=GENERATION_QUEUE_SIZE,
+    discard_fn=filereader.delete_local_file,
+)
+
+single_flight = SingleFlight()
+idempotency_store = IdempotencyStore(ttl=IDEMPOTENCY_KEY_TTL)
+
+
+def read_contract_once(file_url, priority=STANDARD, client_id=None):
+    """
+    Downloads and reads a contract. Concurrent requests for the same URL, or for a
+    different URL with the same content, share a single download and OCR.
+
+    Args:
+        file_url (str): The URL of the contract.
+        priority (int, optional): The priority of the OCR. Defaults to STANDARD.
+        client_id (str, optional): The client requesting the contract. Defaults to None.
+
+    Returns:
+        tuple[str, str]: The SHA-256 of the file and the text of the contract.
+    """
+
+    def download_and_read():
+        filepath = filereader.read_url(file_url)
+        try:
+            return read_contract_file(
+                filepath, priority, client_id, source_url=file_url
+            )
+        finally:
+            filereader.delete_local_file(filepath)
+
+    return single_flight.do(("download", file_url), download_and_read)
+
+
+def process_contract_once(file_url, client_id=None):
+    content_hash, contract = read_contract_once(file_url, STANDARD, client_id)
+    return single_flight.do(
+        ("process_contract", content_hash),
+        lambda: llm_scheduler.submit(
+            generate_and_store,
+            content_hash,
+            contract,
+            priority=STANDARD,
+            client_id=client_id,
+        ).result(),
+    )
+
+
+def process_contract_and_notify(file_url, client_id=None):
+    """Processes a contract and sends its results to the webhook, not again for replayed requests."""
+    parsed_output = process_contract_once(file_url, client_id)
+    webhook_manager.send_results(parsed_output)
+    return parsed_output
+
+
+def ask_single_question_once(file_url, questionid, client_id=None):
+    content_hash, contract = read_contract_once(file_url, INTERACTIVE, client_id)
+    return single_flight.do(
+        ("ask_single_question", content_hash, questionid),
+        lambda: llm_scheduler.submit(
+            process_single_question,
+            generation_llm,
+            contract,
+            questionid,
+            question_id_manager,
+            pydantic_category_manager,
+            PROMPT_FOLDER,
+            prompt_assembler,
+            map_reduce,
+            priority=INTERACTIVE,
+            client_id=client_id,
+        ).result(),
+    )
+
+
+def get_client_id(request: Request):
+    """Identifies the client of a request for fair scheduling, by X-Client-Id header or address."""
+    client_id = request.headers.get("X-Client-Id")
+    if client_id is None and request.client is not None:
+        client_id = request.client.host
+    return client_id
+
+
+async def run_idempotent(request: Request, fn, *args):
+    """
+    Runs a blocking request handler in the threadpool. If the request has an Idempotency-Key header,
+    the stored result of a completed request with the same key and body is returned instead, and
+    concurrent requests with the same key and body share one computation. Reusing a key with a
+    different body raises IdempotencyKeyReusedError (422).
+
+    Args:
+        request (Request): The HTTP request object.
+        fn (Callable): The blocking handler.
+        *args: The arguments of the handler.
+
+    Returns:
+        Any: The result of the handler.
+    """
+    idempotency_key = request.headers.get("Idempotency-Key")
+    if idempotency_key is None:
+        return await run_in_threadpool(fn, *args)
+
+    key = (request.url.path, idempotency_key)
+    fingerprint = hashlib.sha256(await request.body()).hexdigest()
+    result = idempotency_store.get(key, fingerprint)
+    if result is not None:
+        print("Returning stored result for Idempotency-Key: ", idempotency_key)
+        return result
+
+    def run_and_store():
+        result = fn(*args)
+        idempotency_store.put(key, result, fingerprint)
+        return result
+
+    return await run_in_threadpool(
+        single_flight.do, ("idempotency",) + key + (fingerprint,), run_and_store
+    )
+
+
 app = FastAPI()
 
 
+@app.exception_handler(QueueFullError)
+async def queue_full_handler(request: Request, exc: QueueFullError) -> Response:
+    return JSONResponse(
+        {"detail": str(exc)},
+        status_code=429,
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+@app.exception_handler(IdempotencyKeyReusedError)
+async def idempotency_key_reused_handler(
+    request: Request, exc: IdempotencyKeyReusedError
+) -> Response:
+    return JSONResponse({"detail": str(exc)}, status_code=422)
+
+
+@app.exception_handler(PromptTooLongError)
+async def prompt_too_long_handler(
+    request: Request, exc: PromptTooLongError
+) -> Response:
+    return JSONResponse({"detail": str(exc)}, status_code=413)
+
+
+# A plain ASGI middleware, requests that aren't profiled go to the app directly
+app.add_middleware(ProfilingMiddleware, profiler=request_profiler)
+
+
 ############## ENDPOINTS ##############
 @app.get("/")
 def read_root():
@@ -85,14 +527,11 @@ async def ask_single_question(request: Request) -> Response:
     file_url = request_dict.pop("file_url")
     questionid = request_dict.pop("questionid")
 
-    contract = filereader.read_contract_from_url(file_url)
-    return process_single_question(
-        llm,
-        contract,
-        questionid,
-        question_id_manager,
-        pydantic_category_manager,
-        PROMPT_FOLDER,
+    # Fail fast before downloading when the model is saturated
+    client_id = get_client_id(request)
+    llm_scheduler.check_admission(client_id)
+    return await run_idempotent(
+        request, ask_single_question_once, file_url, questionid, client_id
     )
 
 
@@ -106,36 +545,153 @@ async def process_contract(request: Request) -> Response:
     # Read contract
     file_url = request_dict.pop("file_url")
 
-    contract = filereader.read_contract_from_url(file_url)
-
-    # Create output dictionary
-    parsed_output = {}
-    for questionid in question_id_manager.get_all_questionids():
-        if not question_id_manager.get_questionid(questionid)["included"]:
-            continue
-        # parsed_output[questionid] = []
-        print("*" * 20)
-        print("Questionid: ", questionid)
-
-        outputs = process_single_question(
-            llm,
-            contract,
-            questionid,
-            question_id_manager,
-            pydantic_category_manager,
-            PROMPT_FOLDER,
-        )
-
-        parsed_output[questionid] = outputs
+    # Fail fast before downloading when the model is saturated
+    client_id = get_client_id(request)
+    llm_scheduler.check_admission(client_id)
+    parsed_output = await run_idempotent(
+        request, process_contract_and_notify, file_url, client_id
+    )
 
     end_time = time.time()
     elapsed_time = end_time - start_time
     print(f"Time taken for processContract: {elapsed_time} seconds")
     print("Done!")
-    webhook_manager.send_results(parsed_output)
     return JSONResponse(parsed_output)
 
 
+def format_event(event, data, sse):
+    """Formats a streamed event as a Server-Sent Event, or as a JSON line with an "event" field."""
+    if sse:
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    return json.dumps({"event": event, **data}) + "\n"
+
+
+@app.post("/v1/process_contract_stream")
+async def process_contract_stream(request: Request) -> Response:
+    """
+    Processes a contract like /v1/process_contract, streaming the parsed output of each question
+    as soon as it is done. Outputs repaired after failing parsing come after the others.
+
+    Args:
+        request (Request): The HTTP request object, with the "file_url" of the contract.
+            Events are Server-Sent Events if the Accept header is text/event-stream, else JSON lines.
+
+    Returns:
+        Response: A stream of "result" events with the questionid, its parsed output and the seconds
+        since the request started, followed by a "summary" event with all parsed outputs and the time
+        spent reading and generating (or an "error" event).
+    """
+    request_dict = await request.json()
+    file_url = request_dict.pop("file_url")
+    sse = "text/event-stream" in request.headers.get("Accept", "")
+
+    client_id = get_client_id(request)
+    llm_scheduler.check_admission(client_id)
+
+    def stream_events():
+        start_time = time.time()
+        events = queue.Queue()
+        done = object()
+
+        def generate_and_finish(content_hash, contract):
+            try:
+                return generate_and_store(
+                    content_hash,
+                    contract,
+                    on_result=lambda questionid, result, _: events.put(
+                        (questionid, result, time.time() - start_time)
+                    ),
+                )
+            finally:
+                events.put(done)
+
+        try:
+            content_hash, contract = read_contract_once(file_url, STANDARD, client_id)
+            read_time = time.time() - start_time
+            future = llm_scheduler.submit(
+                generate_and_finish,
+                content_hash,
+                contract,
+                priority=STANDARD,
+                client_id=client_id,
+            )
+            for event in iter(events.get, done):
+                questionid, result, elapsed = event
+                yield format_event(
+                    "result",
+                    {"questionid": questionid, "result": result, "elapsed": elapsed},
+                    sse,
+                )
+            parsed_output = future.result()
+        except Exception as e:
+            print("Processing failed for ", file_url, ": ", e)
+            yield format_event("error", {"file_url": file_url, "error": str(e)}, sse)
+            return
+
+        elapsed_time = time.time() - start_time
+        print(f"Time taken for processContract: {elapsed_time} seconds")
+        webhook_manager.send_results(parsed_output)
+        yield format_event(
+            "summary",
+            {
+                "file_url": file_url,
+                "result": parsed_output,
+                "timings": {"read": read_time, "total": elapsed_time},
+            },
+            sse,
+        )
+
+    return StreamingResponse(
+        stream_events(),
+        media_type="text/event-stream" if sse else "application/x-ndjson",
+    )
+
+
+@app.post("/v1/process_contracts")
+async def process_contracts(request: Request) -> Response:
+    """
+    Processes a list of contracts in a pipeline that OCRs the next contracts while
+    the model generates the answers of the current one.
+
+    Args:
+        request (Request): The HTTP request object, with a list of "file_urls".
+
+    Returns:
+        Response: A stream of JSON lines, one per contract in order of completion, with the
+        file URL, the parsed output (or the error) and the time spent in each stage. When the
+        client disconnects, the remaining contracts are not processed.
+    """
+    request_dict = await request.json()
+    file_urls = request_dict.pop("file_urls")
+
+    llm_scheduler.check_admission(get_client_id(request))
+
+    async def stream_results():
+        cancelled = threading.Event()
+        results = contract_pipeline.run(file_urls, cancelled)
+        try:
+            async for file_url, parsed_output, error, timings in iterate_in_threadpool(
+                results
+            ):
+                if await request.is_disconnected():
+                    print("Client disconnected, cancelling the remaining contracts")
+                    break
+                result = {"file_url": file_url, "timings": timings}
+                if error is None:
+                    result["result"] = parsed_output
+                    # The webhook gets the parsed output, as from /v1/process_contract
+                    await run_in_threadpool(webhook_manager.send_results, parsed_output)
+                else:
+                    print("Processing failed for ", file_url, ": ", error)
+                    result["error"] = str(error)
+                yield json.dumps(result) + "\n"
+        finally:
+            # Also reached when the stream is cancelled while waiting for a result
+            cancelled.set()
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+
 @app.post("/v1/add_question")
 async def add_question(request: Request) -> Response:
     # Receive 1-2 sentence question and create prompt template, add to file
@@ -152,6 +708,11 @@ async def add_question(request: Request) -> Response:
     ground_truth = request_dict.pop(
         "ground_truth", None
     )  # should be a list, same length as filenames, ground truth corresponding to each file in order
+    # optional, e.g. {"keywords": ["birth", "born"], "entities": ["date"]}
+    prefilter = request_dict.pop("prefilter", None)
+    if prefilter:
+        # Fails before the evaluation if the prefilter is invalid
+        QuestionPrefilter(prefilter)
 
     # Create format
     pydantic_field = pydantic_category_manager.get_pydantic_field(pydantic_category)
@@ -178,34 +739,33 @@ async def add_question(request: Request) -> Response:
         for i, file_url in enumerate(file_urls):
             contract = filereader.read_contract_from_url(file_url)
 
-            output = execute_prompt_and_parse(llm, prompt, contract, parser)
+            if prefilter and not QuestionPrefilter(prefilter).matches(contract):
+                # Evaluated as in production, a wrong skip counts as a wrong answer
+                print("Skipped by prefilter: ", file_url)
+                output = "N/A"
+            else:
+                output = llm_scheduler.submit(
+                    execute_prompt_and_parse,
+                    llm,
+                    prompt,
+                    contract,
+                    parser,
+                    priority=INTERACTIVE,
+                    admit=False,
+                ).result()
             print("File URL: ", file_url, "\nExtracted entity: ", output)
 
             if ground_truth is not None:
                 print("Ground truth: ", ground_truth[i])
-                if output == "N/A":
-                    evaluation.append(False)
-                elif type(output) == str:
-                    evaluation.append(
-                        evaluate_string_similarity(
-                            ground_truth[i],
-                            output,
-                            distance_evaluator,
-                            STRING_DISTANCE_THRESHOLD,
-                        )
-                    )
-                elif type(output) == int or type(output) == float:
-                    evaluation.append(
-                        evaluate_number_similarity(
-                            ground_truth[i],
-                            output,
-                            tolerated_difference_in_number_output,
-                        )
-                    )
-                else:
-                    raise ValueError(
-                        f"Output type {type(output)} not supported for evaluation."
+                evaluation.append(
+                    evaluate_prediction(
+                        ground_truth[i],
+                        output,
+                        distance_evaluator,
+                        STRING_DISTANCE_THRESHOLD,
+                        tolerated_difference_in_number_output,
                     )
+                )
 
         if ground_truth is not None:
             print(
@@ -227,6 +787,7 @@ async def add_question(request: Request) -> Response:
             pydantic_category=pydantic_category,
             template_folder=PROMPT_FOLDER,
             question_id_manager=question_id_manager,
+            prefilter=prefilter,
         )
         return JSONResponse("Question added")
     else:
@@ -242,6 +803,147 @@ async def remove_question(request: Request) -> Response:
     return JSONResponse("Question removed")
 
 
+backfill_jobs = {}
+
+
+def run_backfill(job):
+    try:
+        while True:
+            # One batch per scheduler item, interactive requests run between batches
+            computed = llm_scheduler.submit(
+                backfill_batch,
+                generation_llm,
+                extraction_store,
+                question_id_manager,
+                pydantic_category_manager,
+                PROMPT_FOLDER,
+                BACKFILL_BATCH_SIZE,
+                REPAIR_RETRIES,
+                prompt_assembler,
+                relevance_prefilter,
+                map_reduce,
+                priority=BULK,
+                admit=False,
+            ).result()
+            if computed == 0:
+                break
+            job["computed"] += computed
+            job["batches"] += 1
+        job["status"] = "done"
+    except Exception as e:
+        print("Backfill failed: ", e)
+        job["status"] = "failed"
+        job["error"] = str(e)
+    job["finished_at"] = time.time()
+
+
+@app.post("/v1/backfill")
+async def start_backfill() -> Response:
+    """
+    Starts computing the results of stored documents that are missing or outdated for the included
+    questions, e.g. after /v1/add_question, without downloading or OCRing the documents again.
+
+    Returns:
+        Response: The id of the backfill job, of the running job if there is one.
+    """
+    for job_id, job in backfill_jobs.items():
+        if job["status"] == "running":
+            return JSONResponse({"job_id": job_id, **job})
+
+    job_id = uuid.uuid4().hex
+    job = {"status": "running", "computed": 0, "batches": 0, "started_at": time.time()}
+    backfill_jobs[job_id] = job
+    threading.Thread(target=run_backfill, args=(job,), daemon=True).start()
+    return JSONResponse({"job_id": job_id, **job})
+
+
+@app.get("/v1/backfill/{job_id}")
+async def get_backfill(job_id: str) -> Response:
+    job = backfill_jobs.get(job_id)
+    if job is None:
+        return JSONResponse({"detail": "Backfill job not found."}, status_code=404)
+    return JSONResponse({"job_id": job_id, **job})
+
+
+def check_profile_admin(request):
+    """Returns the error response of a request without the profiling admin token, else None."""
+    if PROFILE_ADMIN_TOKEN is None:
+        return JSONResponse({"detail": "Profiling admin is disabled."}, status_code=404)
+    authorization = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(
+        authorization.encode(), f"Bearer {PROFILE_ADMIN_TOKEN}".encode()
+    ):
+        return JSONResponse({"detail": "Invalid admin token."}, status_code=401)
+    return None
+
+
+@app.post("/v1/admin/profile")
+async def arm_profiling(request: Request) -> Response:
+    """
+    Profiles the next requests of a path. Requires the PROFILE_ADMIN_TOKEN as a bearer token.
+
+    Args:
+        request (Request): The HTTP request object, with the "path" to profile (defaults to
+            /v1/process_contract) and the number of "requests" (0 disarms).
+
+    Returns:
+        Response: The number of requests still to profile per path.
+    """
+    error = check_profile_admin(request)
+    if error is not None:
+        return error
+    request_dict = await request.json()
+    path = request_dict.pop("path", "/v1/process_contract")
+    count = int(request_dict.pop("requests", 1))
+    request_profiler.arm(path, count)
+    return JSONResponse({"armed": request_profiler.armed_requests()})
+
+
+@app.get("/v1/admin/profile")
+async def list_profiles(request: Request) -> Response:
+    error = check_profile_admin(request)
+    if error is not None:
+        return error
+    return JSONResponse(
+        {
+            "armed": request_profiler.armed_requests(),
+            # Profiled requests are profiled one at a time, the others are skipped
+            "skipped": request_profiler.skipped,
+            "profile_folder": PROFILE_FOLDER,
+            "profiles": request_profiler.list_profiles(),
+        }
+    )
+
+
+@app.get("/v1/metrics")
+async def metrics() -> Response:
+    return JSONResponse(
+        {
+            "llm": llm_scheduler.metrics(),
+            "ocr": ocr_scheduler.metrics(),
+            "coalesced_calls": single_flight.coalesced_calls,
+            "replicas": {
+                name: backend.metrics()
+                for name, backend in [("large", llm), ("small", small_llm)]
+                if isinstance(backend, ReplicaPoolBackend)
+            },
+            "routing": (
+                generation_llm.metrics()
+                if isinstance(generation_llm, ModelRouter)
+                else None
+            ),
+            "micro_batching": {
+                name: backend.metrics()
+                for name, backend in [("large", llm), ("small", small_llm)]
+                if isinstance(backend, MicroBatchingBackend)
+            },
+            "prefilter": relevance_prefilter.metrics(),
+            "map_reduce": map_reduce.metrics() if map_reduce is not None else None,
+            "textract": textract.rate_limiter.metrics(),
+        }
+    )
+
+
 @app.get("/v1/list_all_questions")
 async def list_all_questions() -> Response:
     return JSONResponse(list(question_id_manager.get_all_questionids().keys()))
@@ -252,7 +954,8 @@ async def list_all_questions() -> Response:
 @app.post("/v1/query_salary_slip")
 async def query_single_page_s3_pdf(request: Request) -> Response:
     """
-    Queries a single page PDF document stored in an S3 bucket using Amazon Textract.
+    Queries a document using Amazon Textract.
+    Answers of questions already asked for the same document are served from the cache.
 
     Args:
         request (Request): The HTTP request object.
@@ -264,18 +967,56 @@ async def query_single_page_s3_pdf(request: Request) -> Response:
     file_url = request_dict.pop("file_url")
     questions = request_dict.pop("questions")
 
-    # read from url
-    temp_file_path = filereader.read_url(file_url)
-    # write s3
-    filename_in_s3 = textract.upload_file_to_s3(temp_file_path)
+    # Downloads, S3 transfers and Textract jobs block, polling jobs can take minutes
+    query_dict = await run_in_threadpool(query_salary_slip_once, file_url, questions)
+    return JSONResponse(query_dict)
 
-    response = textract.sync_query_document(filename_in_s3, questions)
-    query_dict = textract.get_query_results(response)
 
-    # clean
-    textract.delete_s3_file(filename_in_s3)
-    filereader.delete_local_file(temp_file_path)
-    return JSONResponse(query_dict)
+def query_salary_slip_once(file_url, questions):
+    document_bytes = filereader.read_url_bytes(file_url)
+    return textract.cached_query(
+        document_bytes,
+        questions,
+        lambda missing_questions: query_document_with_textract(
+            document_bytes, file_url, missing_questions
+        ),
+    )
+
+
+def query_document_with_textract(document_bytes, file_url, questions):
+    """
+    Runs the given queries on a document with Amazon Textract.
+    Single-page documents under the size limit are sent directly as bytes, other documents
+    are staged in the S3 bucket for the duration of an asynchronous query.
+
+    Args:
+        document_bytes (bytes): The content of the document.
+        file_url (str): The URL the document was downloaded from.
+        questions (list[str]): The list of queries to run on the document.
+
+    Returns:
+        dict: A dictionary containing the query and query result.
+    """
+    # Fast path, no S3 round trips
+    if textract.can_query_bytes(document_bytes):
+        response = textract.query_document_bytes(document_bytes, questions)
+        return textract.get_query_results(response)
+
+    # write s3
+    filename_in_s3 = "tmp/{}/{}".format(
+        uuid.uuid4().hex, os.path.basename(urlparse(file_url).path)
+    )
+    textract.upload_bytes_to_s3(document_bytes, filename_in_s3)
+    try:
+        # Multipage or large documents are only supported by the asynchronous API
+        job_manager = TextractJobManager(textract)
+        job_id = job_manager.submit(filename_in_s3, questions)
+        for _ in job_manager.wait_for_jobs([job_id]):
+            pass
+        return job_manager.get_query_results(job_id)
+    finally:
+        # clean
+        textract.delete_s3_file(filename_in_s3)
 
 
 if __name__ == "__main__":
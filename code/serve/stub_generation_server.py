@@ -0,0 +1,92 @@
+"""
+A stub OpenAI-compatible completion server, to run the API against a remote generation backend
+without a GPU. Every prompt is answered with "N/A" in the JSON template requested by the prompt.
+
+    python stub_generation_server.py --port 8000 --latency 0.5
+
+Prompts sent as token ids are decoded with the tokenizer given by --tokenizer, e.g. the served model.
+"""
+
+import argparse
+import asyncio
+import json
+import re
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+app = FastAPI()
+latency = 0.0
+tokenizer = None
+
+
+def stub_answer(prompt):
+    # The prompts end with an output template such as {{"date_found": "DD.MM.YYYY"}}
+    fields = re.findall(r'\{\{?"(\w+)":', prompt)
+    field = fields[-1] if fields else "answer"
+    return json.dumps({field: "N/A"})
+
+
+def decode(token_ids):
+    if tokenizer is None:
+        return ""
+    return tokenizer.decode(token_ids)
+
+
+@app.get("/health")
+def health():
+    return {"status": "ok"}
+
+
+@app.post("/v1/completions")
+async def completions(request: Request) -> Response:
+    request_dict = await request.json()
+    prompts = request_dict["prompt"]
+    if isinstance(prompts, str) or isinstance(prompts[0], int):
+        prompts = [prompts]
+    prompts = [
+        prompt if isinstance(prompt, str) else decode(prompt) for prompt in prompts
+    ]
+
+    await asyncio.sleep(latency)
+    choices = []
+    for index, prompt in enumerate(prompts):
+        text = stub_answer(prompt)
+        choices.append(
+            {
+                "index": index,
+                "text": text,
+                "logprobs": {"token_logprobs": [-0.01] * max(len(text) // 4, 1)},
+                "finish_reason": "stop",
+            }
+        )
+    return JSONResponse(
+        {
+            "id": "cmpl-" + uuid.uuid4().hex,
+            "object": "text_completion",
+            "created": int(time.time()),
+            "model": request_dict.get("model"),
+            "choices": choices,
+        }
+    )
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--port", type=int, default=8000)
+    arg_parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds added to every request"
+    )
+    arg_parser.add_argument(
+        "--tokenizer", default=None, help="Hugging Face tokenizer of token id prompts"
+    )
+    args = arg_parser.parse_args()
+    latency = args.latency
+    if args.tokenizer is not None:
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    uvicorn.run(app, host="0.0.0.0", port=args.port)
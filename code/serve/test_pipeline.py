@@ -0,0 +1,58 @@
+import os
+import threading
+import time
+
+from pipeline import ContractPipeline, PipelineCancelledError
+
+
+def test_cancelled_run_deletes_unread_downloads(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("./tmp")
+    reading = threading.Event()
+    resume_reading = threading.Event()
+
+    def download(item):
+        filepath = os.path.join("./tmp", f"{item}.pdf")
+        with open(filepath, "w") as f:
+            f.write(item)
+        return filepath
+
+    def read(filepath):
+        # As read_pipeline_contract, the document is deleted once read
+        try:
+            reading.set()
+            resume_reading.wait()
+            with open(filepath) as f:
+                return f.read()
+        finally:
+            os.remove(filepath)
+
+    pipeline = ContractPipeline(
+        download_fn=download,
+        ocr_fn=read,
+        generate_fn=lambda contract: {"contract": contract},
+        ocr_workers=1,
+        discard_fn=os.remove,
+    )
+    items = [f"contract_{i}" for i in range(8)]
+    cancelled = threading.Event()
+    results = []
+    consumer = threading.Thread(
+        target=lambda: results.extend(pipeline.run(items, cancelled)), daemon=True
+    )
+    consumer.start()
+
+    # The single OCR worker holds the first contract, the next ones are downloaded and wait for it
+    assert reading.wait(timeout=5)
+    deadline = time.time() + 5
+    while len(os.listdir("./tmp")) < len(items) and time.time() < deadline:
+        time.sleep(0.01)
+    assert len(os.listdir("./tmp")) == len(items)
+    cancelled.set()
+    resume_reading.set()
+    consumer.join(timeout=5)
+
+    errors = [error for _, _, error, _ in results]
+    assert len(errors) == len(items)
+    assert sum(isinstance(error, PipelineCancelledError) for error in errors) >= 1
+    assert os.listdir("./tmp") == []
@@ -1,28 +1,111 @@
 import os
+import hashlib
 import json
+import tempfile
+import threading
+import time
+from types import MappingProxyType
 from langchain.prompts import PromptTemplate
 from langchain.output_parsers import PydanticOutputParser
 import requests
 from post_operations.parsing import (
     parse_output,
+    parse_output_with_error,
 )
+from prompts.generate_prompts import partial_format
+from routing import ModelRouter, is_grounded
+from prompt_tokens import PromptAssembler, PromptTooLongError
+from prefilter import RelevancePrefilter, ContractText
+from map_reduce import MapReduceExtractor
+
+REPAIR_PROMPT_FILE = "exp4_repair_prompt.txt"
+
+
+def parse_included(included):
+    """
+    Converts the "included" flag of a question, stored either as a boolean or as a string, to a boolean.
+
+    Args:
+        included (bool or str): The stored flag.
+
+    Returns:
+        bool: Whether the question is included.
+    """
+    if isinstance(included, str):
+        return included.strip().lower() == "true"
+    return bool(included)
+
+
+class QuestionIdSnapshot:
+    """
+    An immutable version of the question registry.
+
+    Requests take a snapshot once and read all questions from it, so that questions added or
+    removed meanwhile don't change the set of questions of a running extraction.
+
+    Args:
+        questionid_obj_dict (dict): The question IDs and their associated data.
+        version (int): The version of the registry.
+
+    Attributes:
+        version (int): The version of the registry.
+        included_questionids (tuple[str]): The question IDs that are included, in registry order.
+    """
+
+    def __init__(self, questionid_obj_dict, version):
+        self.version = version
+        self._questionid_obj_dict = MappingProxyType(
+            {
+                questionid: MappingProxyType(dict(question_data))
+                for questionid, question_data in questionid_obj_dict.items()
+            }
+        )
+        self.included_questionids = tuple(
+            questionid
+            for questionid, question_data in self._questionid_obj_dict.items()
+            if question_data["included"]
+        )
+
+    def get_questionid(self, questionid):
+        """
+        Retrieves the data associated with a given question ID.
+
+        Args:
+            questionid (str): The question ID.
+
+        Returns:
+            Mapping: The read-only data associated with the question ID, or None if the question ID is not found.
+        """
+        return self._questionid_obj_dict.get(questionid, None)
+
+    def get_all_questionids(self):
+        """
+        Returns the entire, read-only question ID dictionary.
+
+        Returns:
+            Mapping: The question ID dictionary.
+        """
+        return self._questionid_obj_dict
 
 
 class QuestionIdManager:
     """
     A class that manages question IDs and their associated data.
 
+    The registry is kept as a versioned, immutable QuestionIdSnapshot. Writers build a new version under
+    a lock, persist it with an atomic rename and swap it in, readers are never blocked.
+
     Args:
         filename (str): The name of the external JSON file to initialize the question ID dictionary from.
 
     Attributes:
-        questionid_obj_dict (dict): A dictionary that stores question IDs and their associated data.
         filename (str): The name of the external JSON file.
 
     Methods:
         __init__(self, filename="external_file.json"): Initializes the QuestionIdManager object.
         initialize_questionid_obj_dict(self, json_path_file): Initializes the question ID dictionary from an external JSON file.
-        add_questionid(self, questionid, prompt_file, pydantic_category, included="True"): Adds a new question ID and its associated data to the dictionary.
+        snapshot(self): Returns the current version of the registry.
+        add_questionid(self, questionid, prompt_file, pydantic_category, included=True, prefilter=None): Adds a new question ID and its associated data to the dictionary.
         get_questionid(self, questionid): Retrieves the data associated with a given question ID.
         remove_questionid(self, questionid): Removes a question ID and its associated data from the dictionary.
         update_json_file(self): Writes the question ID dictionary back to the external JSON file.
@@ -30,8 +113,9 @@ class QuestionIdManager:
     """
 
     def __init__(self, filename="external_file.json"):
-        self.questionid_obj_dict = {}
         self.filename = filename
+        self.lock = threading.Lock()
+        self._snapshot = QuestionIdSnapshot({}, version=0)
 
         # Initialize questionid_obj_dict from an external file
         self.initialize_questionid_obj_dict(json_path_file=self.filename)
@@ -59,19 +143,46 @@ class QuestionIdManager:
             data = json.load(file)
 
         # Parse the data and populate questionid_obj_dict
-
+        questionid_obj_dict = {}
         for questionid, question_data in data.items():
-            prompt_file = question_data["prompt_file"]
-            pydantic_object = question_data["pydantic_object"]
-            included = question_data["included"]
-            self.questionid_obj_dict[questionid] = {
-                "prompt_file": prompt_file,
-                "pydantic_object": pydantic_object,
-                "included": included,
+            questionid_obj_dict[questionid] = {
+                "prompt_file": question_data["prompt_file"],
+                "pydantic_object": question_data["pydantic_object"],
+                "included": parse_included(question_data["included"]),
             }
+            if question_data.get("prefilter"):
+                questionid_obj_dict[questionid]["prefilter"] = question_data[
+                    "prefilter"
+                ]
+
+        with self.lock:
+            self._snapshot = QuestionIdSnapshot(
+                questionid_obj_dict, version=self._snapshot.version + 1
+            )
+
+    @property
+    def questionid_obj_dict(self):
+        return self._snapshot.get_all_questionids()
+
+    def snapshot(self):
+        """
+        Returns the current version of the registry. It won't change, even if questions are added or removed.
+
+        Returns:
+            QuestionIdSnapshot: The current version of the registry.
+        """
+        return self._snapshot
+
+    def _commit(self, questionid_obj_dict):
+        # Must be called with self.lock held
+        snapshot = QuestionIdSnapshot(
+            questionid_obj_dict, version=self._snapshot.version + 1
+        )
+        self._write_json_file(snapshot)
+        self._snapshot = snapshot
 
     def add_questionid(
-        self, questionid, prompt_file, pydantic_category, included="True"
+        self, questionid, prompt_file, pydantic_category, included=True, prefilter=None
     ):
         """
         Adds a new question ID and its associated data to the dictionary.
@@ -80,15 +191,20 @@ class QuestionIdManager:
             questionid (str): The question ID.
             prompt_file (str): The file containing the prompt for the question.
             pydantic_category (str): The Pydantic category of the question.
-            included (str, optional): Whether the question is included or not. Defaults to "True".
+            included (bool, optional): Whether the question is included or not. Defaults to True.
+            prefilter (dict, optional): The relevance prefilter of the question, see
+                prefilter.QuestionPrefilter. Defaults to None.
         """
-        # Use the function to append new data to a JSON file
-        self.questionid_obj_dict[questionid] = {
-            "prompt_file": prompt_file,
-            "pydantic_object": pydantic_category,
-            "included": included,
-        }
-        self.update_json_file()
+        with self.lock:
+            questionid_obj_dict = dict(self._snapshot.get_all_questionids())
+            questionid_obj_dict[questionid] = {
+                "prompt_file": prompt_file,
+                "pydantic_object": pydantic_category,
+                "included": parse_included(included),
+            }
+            if prefilter:
+                questionid_obj_dict[questionid]["prefilter"] = prefilter
+            self._commit(questionid_obj_dict)
 
     def get_questionid(self, questionid):
         """
@@ -100,7 +216,7 @@ class QuestionIdManager:
         Returns:
             dict: The data associated with the question ID, or None if the question ID is not found.
         """
-        return self.questionid_obj_dict.get(questionid, None)
+        return self._snapshot.get_questionid(questionid)
 
     def remove_questionid(self, questionid):
         """
@@ -112,20 +228,39 @@ class QuestionIdManager:
         Raises:
             ValueError: If the question ID is not found.
         """
-        if questionid in self.questionid_obj_dict:
-            del self.questionid_obj_dict[questionid]
-            self.update_json_file()
-        else:
-            raise ValueError(f"Questionid {questionid} not found.")
+        with self.lock:
+            questionid_obj_dict = dict(self._snapshot.get_all_questionids())
+            if questionid not in questionid_obj_dict:
+                raise ValueError(f"Questionid {questionid} not found.")
+            del questionid_obj_dict[questionid]
+            self._commit(questionid_obj_dict)
+
+    def _write_json_file(self, snapshot):
+        # Write to a temporary file in the same folder, then rename it over the original,
+        # so that the file is never left partially written
+        folder = os.path.dirname(os.path.abspath(self.filename))
+        fd, tmp_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as file:
+                json.dump(
+                    {
+                        questionid: dict(question_data)
+                        for questionid, question_data in snapshot.get_all_questionids().items()
+                    },
+                    file,
+                    indent=4,
+                )
+            os.replace(tmp_path, self.filename)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
 
     def update_json_file(self):
         """
         Writes the question ID dictionary back to the external JSON file.
         """
-        # Write everything back to the file
-
-        with open(self.filename, "w") as file:
-            json.dump(self.questionid_obj_dict, file)
+        with self.lock:
+            self._write_json_file(self._snapshot)
 
     def get_all_questionids(self):
         """
@@ -134,7 +269,7 @@ class QuestionIdManager:
         Returns:
             dict: The question ID dictionary.
         """
-        return self.questionid_obj_dict
+        return self._snapshot.get_all_questionids()
 
 
 class PydanticCategoryManager:
@@ -217,7 +352,12 @@ def load_template(template_folder, template_name):
 
 
 def include_new_question(
-    prompt, name_of_entity, pydantic_category, template_folder, question_id_manager
+    prompt,
+    name_of_entity,
+    pydantic_category,
+    template_folder,
+    question_id_manager,
+    prefilter=None,
 ):
     prompt_file = os.path.join(template_folder, f"exp4_{name_of_entity}.txt")  # rename
     with open(prompt_file, "w") as file:
@@ -225,43 +365,594 @@ def include_new_question(
 
     # Add questionid to included_questionid_list
     question_id_manager.add_questionid(
-        name_of_entity, f"exp4_{name_of_entity}.txt", pydantic_category
+        name_of_entity,
+        f"exp4_{name_of_entity}.txt",
+        pydantic_category,
+        prefilter=prefilter,
     )
 
 
-def process_single_question(
+def get_prompt_version(template_folder, obj_dict):
+    """
+    Returns the version of a question's prompt, a hash of its prompt file, output format and prefilter.
+    Stored results of an older version are outdated.
+
+    Args:
+        template_folder (str): The folder of the prompt files.
+        obj_dict (dict): The entry of the question in the registry.
+
+    Returns:
+        str: The version.
+    """
+    prompt = load_template(
+        template_name=obj_dict["prompt_file"], template_folder=template_folder
+    )
+    version = obj_dict["pydantic_object"] + "\n" + prompt
+    if obj_dict.get("prefilter"):
+        # Answers skipped by an older prefilter are outdated too
+        version += "\n" + json.dumps(obj_dict["prefilter"], sort_keys=True)
+    return hashlib.sha1(version.encode()).hexdigest()[:16]
+
+
+def get_prompt_versions(
+    snapshot: QuestionIdSnapshot, template_folder, questionids=None
+):
+    """
+    Returns the prompt version of each given questionid of a registry snapshot, of each included
+    questionid by default.
+    """
+    if questionids is None:
+        questionids = snapshot.included_questionids
+    return {
+        questionid: get_prompt_version(
+            template_folder, snapshot.get_questionid(questionid)
+        )
+        for questionid in questionids
+    }
+
+
+def build_question_prompt(
+    contract,
+    obj_dict,
+    template_folder,
+    prompt_assembler: PromptAssembler = None,
+    contract_ids=None,
+):
+    """
+    Builds the prompt of a question for a contract.
+
+    Args:
+        contract (str): The text of the contract.
+        obj_dict (dict): The entry of the question in the registry.
+        template_folder (str): The folder of the prompt files.
+        prompt_assembler (PromptAssembler, optional): Assembles the prompt from token ids, from contract_ids
+            if the contract is already tokenized. Defaults to None, the prompt is formatted as text.
+        contract_ids (list[int], optional): The token ids of the contract. Defaults to None.
+
+    Returns:
+        str or TokenizedPrompt: The prompt.
+    """
+    if prompt_assembler is not None:
+        if contract_ids is None:
+            contract_ids = prompt_assembler.encode_contract(contract)
+        return prompt_assembler.assemble(
+            obj_dict["prompt_file"], contract, contract_ids
+        )
+
+    prompt = load_template(
+        template_name=obj_dict["prompt_file"], template_folder=template_folder
+    )
+    prompt_template = PromptTemplate(
+        template=prompt,
+        input_variables=["contract"],
+    )
+    return prompt_template.format(contract=contract)
+
+
+def generate_single_question(
     llm,
     contract,
     questionid,
     question_id_manager: QuestionIdManager,
     pydantic_category_manager: PydanticCategoryManager,
     template_folder: str,
+    prompt_assembler: PromptAssembler = None,
+    contract_ids=None,
 ):
+    """
+    Runs a question on a contract without parsing the output. If llm is a ModelRouter,
+    the question is routed to its tier. With a prompt_assembler, the prompt is assembled from
+    token ids, from contract_ids if the contract is already tokenized.
+
+    Returns:
+        tuple[str, PydanticOutputParser]: The raw output of the model and the parser of the question.
+
+    Raises:
+        ValueError: If the questionid is not found.
+    """
     print("Questionid: ", questionid)
     obj_dict = question_id_manager.get_questionid(questionid)
     if obj_dict is not None:
-        prompt = load_template(
-            template_name=obj_dict["prompt_file"], template_folder=template_folder
+        prompt = build_question_prompt(
+            contract, obj_dict, template_folder, prompt_assembler, contract_ids
         )
-
-        prompt_template = PromptTemplate(
-            template=prompt,
-            input_variables=["contract"],
+        parser = PydanticOutputParser(
+            pydantic_object=pydantic_category_manager.get_pydantic_object(
+                obj_dict["pydantic_object"]
+            )
         )
-        prompt = prompt_template.format(contract=contract)
-        outputs = llm(prompt)
+        if isinstance(llm, ModelRouter):
+            outputs = llm.generate_for_question(questionid, prompt, parser, contract)
+        else:
+            outputs = llm(prompt)
 
         print("Output: ", outputs)
         print("*" * 20)
-        # Parse
-        parser = PydanticOutputParser(
+        return outputs, parser
+    else:
+        raise ValueError(f"Questionid {questionid} not found.")
+
+
+def process_single_question(
+    llm,
+    contract,
+    questionid,
+    question_id_manager: QuestionIdManager,
+    pydantic_category_manager: PydanticCategoryManager,
+    template_folder: str,
+    prompt_assembler: PromptAssembler = None,
+    map_reduce: MapReduceExtractor = None,
+):
+    if map_reduce is not None:
+        obj_dict = question_id_manager.get_questionid(questionid)
+        if obj_dict is None:
+            raise ValueError(f"Questionid {questionid} not found.")
+        if not map_reduce.fits(contract, [obj_dict]):
+            return process_contract_windows(
+                llm,
+                contract,
+                {questionid: obj_dict},
+                map_reduce,
+                pydantic_category_manager,
+                template_folder,
+                repair_retries=0,
+                prompt_assembler=prompt_assembler,
+            )[questionid]
+    outputs, parser = generate_single_question(
+        llm,
+        contract,
+        questionid,
+        question_id_manager,
+        pydantic_category_manager,
+        template_folder,
+        prompt_assembler,
+    )
+    # Parse
+    return parse_output(outputs, parser)
+
+
+def repair_failed_outputs(llm, failures, template_folder, max_retries=1):
+    """
+    Retries outputs that couldn't be parsed. Each failure gets a short prompt with the bad output and
+    the parsing or validation error, and the prompts of all failures are generated as one batch.
+    Failures that are still not parsed are retried up to max_retries rounds.
+
+    Outputs that already answer N/A are not repaired, the information is missing from the contract.
+
+    Args:
+        llm: The language model used for generation.
+        failures (dict): Any key (e.g. questionid, or (contract, questionid) across contracts) mapped to
+            a dict with the "output", "error" and "parser" of the failed question.
+        template_folder (str): The folder of the prompt files.
+        max_retries (int, optional): The number of repair rounds. Defaults to 1.
+
+    Returns:
+        dict: The parsed value of each key of failures, "N/A" if it couldn't be repaired.
+    """
+    repaired = {key: "N/A" for key in failures}
+    pending = {
+        key: failure
+        for key, failure in failures.items()
+        if "N/A" not in failure["output"]
+    }
+    if not pending:
+        return repaired
+
+    repair_template = load_template(
+        template_name=REPAIR_PROMPT_FILE, template_folder=template_folder
+    )
+    for _ in range(max_retries):
+        keys = list(pending.keys())
+        prompts = []
+        for key in keys:
+            parser = pending[key]["parser"]
+            prompts.append(
+                partial_format(
+                    repair_template,
+                    pydantic_field=list(parser.pydantic_object.__fields__.keys())[0],
+                    output=pending[key]["output"],
+                    error=pending[key]["error"],
+                )
+            )
+        print("Repairing outputs: ", keys)
+        outputs = llm.batch(prompts)
+
+        still_failing = {}
+        for key, output in zip(keys, outputs):
+            parser = pending[key]["parser"]
+            value, error = parse_output_with_error(output, parser)
+            if error is None:
+                repaired[key] = value
+            elif "N/A" not in output:
+                still_failing[key] = {
+                    "output": output,
+                    "error": error,
+                    "parser": parser,
+                }
+        pending = still_failing
+        if not pending:
+            break
+    return repaired
+
+
+def process_contract_windows(
+    llm,
+    contract,
+    questions,
+    map_reduce: MapReduceExtractor,
+    pydantic_category_manager: PydanticCategoryManager,
+    template_folder: str,
+    repair_retries: int = 1,
+    prompt_assembler: PromptAssembler = None,
+):
+    """
+    Runs questions on a contract that doesn't fit in the model's context. The contract is split into
+    overlapping windows, the prompts of every question on every window are generated in a single engine
+    call, and the answers of the windows are reconciled per question, see MapReduceExtractor.
+
+    Outputs that can't be parsed are repaired only for the questions no window answered.
+
+    Args:
+        llm: The language model used for generation.
+        contract (str): The text of the contract.
+        questions (dict): The entry in the registry of each questionid to run.
+        map_reduce (MapReduceExtractor): Splits the contract and reconciles the answers.
+        pydantic_category_manager (PydanticCategoryManager): The registry of the output formats.
+        template_folder (str): The folder of the prompt files.
+        repair_retries (int, optional): The number of repair rounds, 0 disables repairs. Defaults to 1.
+        prompt_assembler (PromptAssembler, optional): Assembles the prompts from token ids, each window
+            is tokenized once for all questions. Defaults to None, prompts are formatted as text.
+
+    Returns:
+        dict: The reconciled output of each questionid.
+    """
+    budget = map_reduce.window_budget(questions.values())
+    parsers = {
+        questionid: PydanticOutputParser(
             pydantic_object=pydantic_category_manager.get_pydantic_object(
                 obj_dict["pydantic_object"]
             )
         )
-        return parse_output(outputs, parser)
+        for questionid, obj_dict in questions.items()
+    }
+
+    windows = []
+    keys = []
+    prompts = []
+    pending = map_reduce.split(contract, budget)[::-1]
+    while pending:
+        window = pending.pop()
+        window_ids = None
+        if prompt_assembler is not None:
+            window_ids = prompt_assembler.encode_contract(window)
+        try:
+            window_prompts = [
+                build_question_prompt(
+                    window, obj_dict, template_folder, prompt_assembler, window_ids
+                )
+                for obj_dict in questions.values()
+            ]
+        except PromptTooLongError as e:
+            # Split again with the excess tokens less, no text of the contract is dropped
+            excess = e.num_tokens + map_reduce.max_new_tokens - e.max_model_len
+            if window_ids is not None:
+                window_tokens = len(window_ids)
+            else:
+                window_tokens = map_reduce.count_tokens(window)
+            print(f"Window {len(windows)} is {excess} tokens too long, splitting it")
+            max_tokens = max(1, window_tokens - excess - map_reduce.margin)
+            pending.extend(map_reduce.split(window, max_tokens)[::-1])
+            continue
+        for questionid, prompt in zip(questions, window_prompts):
+            keys.append((questionid, len(windows)))
+            prompts.append(prompt)
+        windows.append(window)
+    print(f"Contract split into {len(windows)} windows of at most {budget} tokens")
+    map_reduce.record(len(windows), len(prompts))
+    outputs = llm.generate_with_confidence(prompts) if prompts else []
+
+    candidates = {questionid: [] for questionid in questions}
+    failures = {}
+    for (questionid, index), (output, confidence) in zip(keys, outputs):
+        parser = parsers[questionid]
+        value, error = parse_output_with_error(output, parser)
+        candidates[questionid].append(
+            {
+                "value": value,
+                "error": error,
+                "grounded": error is None
+                and value != "N/A"
+                and is_grounded(value, windows[index], parser),
+                "confidence": confidence,
+                "window": index,
+            }
+        )
+        if error is not None and questionid not in failures:
+            failures[questionid] = {"output": output, "error": error, "parser": parser}
+
+    results = {
+        questionid: map_reduce.reconcile(questionid, candidates[questionid])
+        for questionid in questions
+    }
+    failures = {
+        questionid: failure
+        for questionid, failure in failures.items()
+        if results[questionid] == "N/A"
+    }
+    if failures and repair_retries > 0:
+        results.update(
+            repair_failed_outputs(llm, failures, template_folder, repair_retries)
+        )
+    return results
+
+
+def process_contract_questions(
+    llm,
+    contract,
+    question_id_manager: QuestionIdManager,
+    pydantic_category_manager: PydanticCategoryManager,
+    template_folder: str,
+    repair_retries: int = 1,
+    prompt_assembler: PromptAssembler = None,
+    on_result=None,
+    prefilter: RelevancePrefilter = None,
+    map_reduce: MapReduceExtractor = None,
+):
+    """
+    Runs all included questions on a contract. Outputs that can't be parsed are then
+    repaired in a single batch, see repair_failed_outputs. Questions whose prefilter doesn't
+    match the contract are answered "N/A" without calling the model. Contracts that don't fit in
+    the model's context are extracted in windows, see process_contract_windows.
+
+    Args:
+        llm: The language model used for generation.
+        contract (str): The text of the contract.
+        question_id_manager (QuestionIdManager): The registry of the questions.
+        pydantic_category_manager (PydanticCategoryManager): The registry of the output formats.
+        template_folder (str): The folder of the prompt files.
+        repair_retries (int, optional): The number of repair rounds, 0 disables repairs. Defaults to 1.
+        prompt_assembler (PromptAssembler, optional): Assembles the prompts from token ids, the contract
+            is tokenized once for all questions. Defaults to None, prompts are formatted as text.
+        on_result (Callable[[str, Any, float], None], optional): Called with the questionid, the parsed
+            output and the seconds since the start of the extraction as soon as each question is done,
+            after the repair pass for repaired questions. Defaults to None.
+        prefilter (RelevancePrefilter, optional): Skips the questions whose answer can't be in the
+            contract. Defaults to None, all questions run.
+        map_reduce (MapReduceExtractor, optional): Splits contracts that don't fit in the model's context.
+            Defaults to None, their prompts fail.
+
+    Returns:
+        dict: The parsed output of each included questionid.
+    """
+    # Registry changes during the extraction don't affect it
+    snapshot = question_id_manager.snapshot()
+    start_time = time.time()
+    contract_ids = None
+    if prompt_assembler is not None:
+        contract_ids = prompt_assembler.encode_contract(contract)
+    parsed_output = {}
+    failures = {}
+    shadow_skipped = []
+    if prefilter is not None:
+        # Lowercased and scanned once for the prefilters of all questions
+        prefilter_text = ContractText(contract)
+    questionids = []
+    for questionid in snapshot.included_questionids:
+        if prefilter is not None:
+            obj_dict = snapshot.get_questionid(questionid)
+            if not prefilter.is_relevant(questionid, obj_dict, prefilter_text):
+                if prefilter.mode == "on":
+                    print("Skipped by prefilter: ", questionid)
+                    parsed_output[questionid] = "N/A"
+                    if on_result is not None:
+                        on_result(questionid, "N/A", time.time() - start_time)
+                    continue
+                shadow_skipped.append(questionid)
+        questionids.append(questionid)
+
+    questions = {
+        questionid: snapshot.get_questionid(questionid) for questionid in questionids
+    }
+    if map_reduce is not None and not map_reduce.fits(
+        contract, questions.values(), contract_ids
+    ):
+        # Repaired within the windows' extraction
+        parsed_output.update(
+            process_contract_windows(
+                llm,
+                contract,
+                questions,
+                map_reduce,
+                pydantic_category_manager,
+                template_folder,
+                repair_retries,
+                prompt_assembler,
+            )
+        )
+        if on_result is not None:
+            for questionid in questionids:
+                on_result(
+                    questionid, parsed_output[questionid], time.time() - start_time
+                )
     else:
-        raise ValueError(f"Questionid {questionid} not found.")
+        for questionid in questionids:
+            print("*" * 20)
+            outputs, parser = generate_single_question(
+                llm,
+                contract,
+                questionid,
+                snapshot,
+                pydantic_category_manager,
+                template_folder,
+                prompt_assembler,
+                contract_ids,
+            )
+            parsed_output[questionid], error = parse_output_with_error(outputs, parser)
+            if error is not None:
+                failures[questionid] = {
+                    "output": outputs,
+                    "error": error,
+                    "parser": parser,
+                }
+            elif on_result is not None:
+                on_result(
+                    questionid, parsed_output[questionid], time.time() - start_time
+                )
+
+    if failures and repair_retries > 0:
+        parsed_output.update(
+            repair_failed_outputs(llm, failures, template_folder, repair_retries)
+        )
+    if on_result is not None:
+        for questionid in failures:
+            on_result(questionid, parsed_output[questionid], time.time() - start_time)
+    for questionid in shadow_skipped:
+        prefilter.record_shadow_result(questionid, parsed_output[questionid])
+    return parsed_output
+
+
+def backfill_batch(
+    llm,
+    extraction_store,
+    question_id_manager: QuestionIdManager,
+    pydantic_category_manager: PydanticCategoryManager,
+    template_folder: str,
+    batch_size: int = 32,
+    repair_retries: int = 1,
+    prompt_assembler: PromptAssembler = None,
+    prefilter: RelevancePrefilter = None,
+    map_reduce: MapReduceExtractor = None,
+):
+    """
+    Computes one batch of the stored documents' results that are missing or outdated for the included
+    questions. The prompts of the batch are generated in a single engine call, and outputs that can't
+    be parsed are repaired in another one. Documents are neither downloaded nor OCRed again.
+
+    Args:
+        llm: The language model used for generation.
+        extraction_store (ExtractionStore): The store of the documents and their results.
+        question_id_manager (QuestionIdManager): The registry of the questions.
+        pydantic_category_manager (PydanticCategoryManager): The registry of the output formats.
+        template_folder (str): The folder of the prompt files.
+        batch_size (int, optional): The number of (document, question) pairs of the batch. Defaults to 32.
+        repair_retries (int, optional): The number of repair rounds, 0 disables repairs. Defaults to 1.
+        prompt_assembler (PromptAssembler, optional): Assembles the prompts from token ids. Defaults to None.
+        prefilter (RelevancePrefilter, optional): Answers "N/A" without calling the model when the answer
+            can't be in the document. Defaults to None.
+        map_reduce (MapReduceExtractor, optional): Extracts the documents that don't fit in the model's
+            context in windows, after the batch. Defaults to None, they are stored as "N/A".
+
+    Returns:
+        int: The number of computed pairs, 0 once every result is up to date.
+    """
+    snapshot = question_id_manager.snapshot()
+    prompt_versions = get_prompt_versions(snapshot, template_folder)
+    pairs = extraction_store.find_missing(prompt_versions, limit=batch_size)
+    if not pairs:
+        return 0
+
+    texts = extraction_store.get_texts({content_hash for content_hash, _ in pairs})
+    results = {}
+    prompts = {}
+    parsers = {}
+    contract_ids = {}
+    prefilter_texts = {}
+    shadow_skipped = []
+    # content_hash -> {questionid: obj_dict} of the documents too long for the model's context
+    windowed = {}
+    for content_hash, questionid in pairs:
+        obj_dict = snapshot.get_questionid(questionid)
+        if prefilter is not None and content_hash not in prefilter_texts:
+            prefilter_texts[content_hash] = ContractText(texts[content_hash])
+        if prefilter is not None and not prefilter.is_relevant(
+            questionid, obj_dict, prefilter_texts[content_hash]
+        ):
+            if prefilter.mode == "on":
+                results[(content_hash, questionid)] = "N/A"
+                continue
+            shadow_skipped.append((content_hash, questionid))
+        parsers[(content_hash, questionid)] = PydanticOutputParser(
+            pydantic_object=pydantic_category_manager.get_pydantic_object(
+                obj_dict["pydantic_object"]
+            )
+        )
+        if prompt_assembler is not None and content_hash not in contract_ids:
+            contract_ids[content_hash] = prompt_assembler.encode_contract(
+                texts[content_hash]
+            )
+        if map_reduce is not None and not map_reduce.fits(
+            texts[content_hash], [obj_dict], contract_ids.get(content_hash)
+        ):
+            windowed.setdefault(content_hash, {})[questionid] = obj_dict
+            continue
+        try:
+            prompts[(content_hash, questionid)] = build_question_prompt(
+                texts[content_hash],
+                obj_dict,
+                template_folder,
+                prompt_assembler,
+                contract_ids.get(content_hash),
+            )
+        except PromptTooLongError as e:
+            # Stored as N/A, the document would be retried in every batch otherwise
+            print(f"Skipping {questionid} of {content_hash}: ", e)
+            results[(content_hash, questionid)] = "N/A"
+
+    keys = list(prompts.keys())
+    print(f"Backfilling {len(keys)} results of {len(texts)} documents")
+    outputs = llm.batch([prompts[key] for key in keys]) if keys else []
+
+    failures = {}
+    for key, output in zip(keys, outputs):
+        results[key], error = parse_output_with_error(output, parsers[key])
+        if error is not None:
+            failures[key] = {"output": output, "error": error, "parser": parsers[key]}
+    if failures and repair_retries > 0:
+        results.update(
+            repair_failed_outputs(llm, failures, template_folder, repair_retries)
+        )
+    for content_hash, questions in windowed.items():
+        windows_output = process_contract_windows(
+            llm,
+            texts[content_hash],
+            questions,
+            map_reduce,
+            pydantic_category_manager,
+            template_folder,
+            repair_retries,
+            prompt_assembler,
+        )
+        for questionid, value in windows_output.items():
+            results[(content_hash, questionid)] = value
+    for content_hash, questionid in shadow_skipped:
+        prefilter.record_shadow_result(questionid, results[(content_hash, questionid)])
+
+    results_per_document = {}
+    for (content_hash, questionid), value in results.items():
+        results_per_document.setdefault(content_hash, {})[questionid] = value
+    for content_hash, document_results in results_per_document.items():
+        extraction_store.put_results(content_hash, document_results, prompt_versions)
+    return len(results)
 
 
 def execute_prompt_and_parse(llm, prompt, contract, parser):
@@ -0,0 +1,133 @@
+from collections import defaultdict
+
+
+class TextractBlockIndex:
+    """
+    Index over the blocks of a Textract response, built in a single pass.
+
+    Blocks are looked up by Id and by BlockType, and the Relationships of every block are kept as
+    typed adjacency lists (e.g. ANSWER, CHILD), so that query answers, lines and words are resolved
+    through their relationships instead of the order of the blocks.
+
+    Args:
+        blocks (Iterable[dict]): The blocks of one or more Textract responses.
+    """
+
+    def __init__(self, blocks):
+        self.blocks_by_id = {}
+        self.blocks_by_type = defaultdict(list)
+        self.relationships = defaultdict(lambda: defaultdict(list))
+
+        for block in blocks:
+            self.blocks_by_id[block["Id"]] = block
+            self.blocks_by_type[block["BlockType"]].append(block)
+            for relationship in block.get("Relationships", []):
+                self.relationships[block["Id"]][relationship["Type"]].extend(
+                    relationship["Ids"]
+                )
+
+    @classmethod
+    def from_response(cls, response):
+        """
+        Builds the index of a Textract response.
+
+        Args:
+            response (dict): The response of analyze_document, or merged get_document_analysis pages.
+
+        Returns:
+            TextractBlockIndex: The index of the blocks of the response.
+        """
+        return cls(response["Blocks"])
+
+    def get_block(self, block_id):
+        """Returns the block with the given Id, or None if it doesn't exist."""
+        return self.blocks_by_id.get(block_id, None)
+
+    def get_blocks(self, block_type, page=None):
+        """
+        Returns the blocks of the given type, in response order.
+
+        Args:
+            block_type (str): The BlockType, e.g. "LINE" or "WORD".
+            page (int, optional): Only return the blocks of this page. Defaults to None (all pages).
+
+        Returns:
+            list[dict]: The matching blocks.
+        """
+        blocks = self.blocks_by_type.get(block_type, [])
+        if page is None:
+            return blocks
+        return [block for block in blocks if block.get("Page", 1) == page]
+
+    def get_related(self, block_id, relationship_type):
+        """
+        Returns the blocks a block points to with the given relationship type.
+
+        Args:
+            block_id (str): The Id of the source block.
+            relationship_type (str): The relationship type, e.g. "ANSWER" or "CHILD".
+
+        Returns:
+            list[dict]: The related blocks. Ids missing from the response are skipped.
+        """
+        related_ids = self.relationships.get(block_id, {}).get(relationship_type, [])
+        return [
+            self.blocks_by_id[related_id]
+            for related_id in related_ids
+            if related_id in self.blocks_by_id
+        ]
+
+    def get_text(self, block_id):
+        """
+        Returns the text of a block, built from its WORD children if it has no text of its own.
+
+        Args:
+            block_id (str): The Id of the block.
+
+        Returns:
+            str: The text of the block.
+        """
+        block = self.blocks_by_id[block_id]
+        if "Text" in block:
+            return block["Text"]
+        return " ".join(
+            child["Text"]
+            for child in self.get_related(block_id, "CHILD")
+            if child["BlockType"] == "WORD"
+        )
+
+    def get_lines(self, page=None):
+        """
+        Returns the text of the LINE blocks, in reading order as returned by Textract.
+
+        Args:
+            page (int, optional): Only return the lines of this page. Defaults to None (all pages).
+
+        Returns:
+            list[str]: The lines of text.
+        """
+        return [block["Text"] for block in self.get_blocks("LINE", page)]
+
+    def get_query_answers(self):
+        """
+        Resolves every query to its answers through the ANSWER relationships.
+
+        Returns:
+            dict: The query text mapped to a list of answers, sorted by decreasing confidence. Each answer
+            is a dict with "text", "confidence" and "page". Queries without an answer map to an empty list.
+        """
+        query_answers = {}
+        for query in self.get_blocks("QUERY"):
+            answers = query_answers.setdefault(query["Query"]["Text"], [])
+            for result in self.get_related(query["Id"], "ANSWER"):
+                answers.append(
+                    {
+                        "text": result.get("Text", ""),
+                        "confidence": result.get("Confidence"),
+                        "page": result.get("Page", query.get("Page", 1)),
+                    }
+                )
+
+        for answers in query_answers.values():
+            answers.sort(key=lambda answer: answer["confidence"] or 0, reverse=True)
+        return query_answers
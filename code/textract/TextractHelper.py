@@ -1,26 +1,67 @@
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+import io
 import time
-from pdf2image import convert_from_path
+import uuid
 from PyPDF2 import PdfWriter, PdfReader
 import os
+from textract.TextractBlockIndex import TextractBlockIndex
+from data.ImagePreparer import ImagePreparer
+
+SYNC_DOCUMENT_MAX_BYTES = (
+    10 * 1024 * 1024
+)  # Limit of Document={"Bytes": ...} in analyze_document
+MAX_POOL_CONNECTIONS = 32
+MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
 
 
 # BEGIN: 9d8f7g6h5j4k
 class TextractHelper:
-    def __init__(self, profile_name, bucket_name):
+    def __init__(self, profile_name, bucket_name, query_cache=None, rate_limiter=None):
         """
         Initializes a TextractHelper object with the specified AWS profile name.
 
         Args:
             profile_name (str): The name of the AWS profile to use for authentication.
             bucket_name (str): The name of the S3 bucket to use for storing the extracted text.
+            query_cache (TextractQueryCache, optional): Cache of query results used by cached_query. Defaults to None.
+            rate_limiter (TextractRateLimiter, optional): Limits and retries the Textract calls of all threads.
+                Defaults to None, calls are not limited.
 
         Returns:
             None
         """
         self.session = boto3.Session(profile_name=profile_name)
-        self.client = self.session.client("textract", region_name="eu-central-1")
+        # Clients are created once and shared, so that their connection pools are reused across requests
+        client_config = Config(max_pool_connections=MAX_POOL_CONNECTIONS)
+        textract_config = client_config
+        if rate_limiter is not None:
+            # Throttled and transient errors are retried by the rate limiter, which slows down on
+            # throttling, instead of botocore
+            textract_config = client_config.merge(
+                Config(retries={"mode": "standard", "total_max_attempts": 1})
+            )
+        self.client = self.session.client(
+            "textract", region_name="eu-central-1", config=textract_config
+        )
+        self.s3_client = self.session.client("s3", config=client_config)
+        self.transfer_config = TransferConfig(
+            multipart_threshold=MULTIPART_CHUNKSIZE,
+            multipart_chunksize=MULTIPART_CHUNKSIZE,
+            max_concurrency=10,
+            use_threads=True,
+        )
         self.bucket = bucket_name
+        self.query_cache = query_cache
+        self.rate_limiter = rate_limiter
+
+    def _call(self, operation, **kwargs):
+        # Calls an operation of the Textract client, within the limits of the rate limiter
+        fn = getattr(self.client, operation)
+        if self.rate_limiter is None:
+            return fn(**kwargs)
+        return self.rate_limiter.call(operation, fn, **kwargs)
 
     def async_query_document(self, document, questions):
         """
@@ -37,8 +78,11 @@ class TextractHelper:
             dict: A dictionary containing the response metadata and the results of the queries.
         """
 
-        # Analyze the document
-        response = self.client.start_document_analysis(
+        # Analyze the document. The token is the same for every retry of the rate limiter, a retry of a
+        # request Textract already accepted returns the same job instead of starting (and billing) another
+        response = self._call(
+            "start_document_analysis",
+            ClientRequestToken=uuid.uuid4().hex,
             DocumentLocation={"S3Object": {"Bucket": self.bucket, "Name": document}},
             FeatureTypes=["QUERIES"],
             QueriesConfig={
@@ -48,6 +92,39 @@ class TextractHelper:
 
         return response
 
+    def get_async_query_page(self, job_id, next_token=None):
+        """
+        Retrieves one page of the results of an asynchronous document analysis job.
+
+        Args:
+            job_id (str): The JobId returned by start_document_analysis.
+            next_token (str, optional): The pagination token returned with the previous page. Defaults to None.
+
+        Returns:
+            dict: The get_document_analysis response, including JobStatus, Blocks and NextToken (if more pages exist).
+        """
+        kwargs = {"JobId": job_id}
+        if next_token is not None:
+            kwargs["NextToken"] = next_token
+        return self._call("get_document_analysis", **kwargs)
+
+    def merge_async_query_pages(self, pages):
+        """
+        Merges the paginated results of an asynchronous document analysis job into a single response.
+
+        Args:
+            pages (Iterable[dict]): The get_document_analysis responses of a job, in order.
+
+        Returns:
+            dict: A response with the blocks of all pages, suitable for get_query_results.
+        """
+        merged = {"Blocks": []}
+        for page in pages:
+            if "DocumentMetadata" in page:
+                merged["DocumentMetadata"] = page["DocumentMetadata"]
+            merged["Blocks"].extend(page.get("Blocks", []))
+        return merged
+
     def sync_query_document(self, document, questions):
         """
         Analyzes a ONE-PAGE document in an S3 bucket for the specified questions and returns the query and answer.
@@ -63,7 +140,8 @@ class TextractHelper:
         """
 
         # Analyze the document
-        response = self.client.analyze_document(
+        response = self._call(
+            "analyze_document",
             Document={"S3Object": {"Bucket": self.bucket, "Name": document}},
             FeatureTypes=["QUERIES"],
             QueriesConfig={
@@ -73,6 +151,58 @@ class TextractHelper:
 
         return response
 
+    def query_document_bytes(self, document_bytes, questions):
+        """
+        Analyzes a ONE-PAGE document sent directly as bytes, without storing it in S3.
+
+        Args:
+            document_bytes (bytes): The content of the document (PDF, PNG, JPEG or TIFF).
+            questions (list[str]): The list of queries to run on the document.
+
+        Returns:
+            dict: The AWS Textract response containing the query and answer.
+        """
+        response = self._call(
+            "analyze_document",
+            Document={"Bytes": document_bytes},
+            FeatureTypes=["QUERIES"],
+            QueriesConfig={
+                "Queries": [{"Text": "{}".format(question)} for question in questions]
+            },
+        )
+
+        return response
+
+    def count_pages(self, document_bytes):
+        """
+        Counts the pages of a document. Documents that are not PDFs are considered to have one page.
+
+        Args:
+            document_bytes (bytes): The content of the document.
+
+        Returns:
+            int: The number of pages.
+        """
+        if not document_bytes.startswith(b"%PDF"):
+            return 1
+        return len(PdfReader(io.BytesIO(document_bytes)).pages)
+
+    def can_query_bytes(self, document_bytes):
+        """
+        Checks whether a document can be sent directly as bytes to the synchronous API,
+        i.e. it is a single page and under the size limit.
+
+        Args:
+            document_bytes (bytes): The content of the document.
+
+        Returns:
+            bool: True if query_document_bytes can be used for the document, False otherwise.
+        """
+        return (
+            len(document_bytes) <= SYNC_DOCUMENT_MAX_BYTES
+            and self.count_pages(document_bytes) == 1
+        )
+
     def query_local_image(self, image_path, questions):
         """
         Analyzes a local image file using Amazon Textract and returns the results of running the specified
@@ -92,7 +222,8 @@ class TextractHelper:
             ## Read bytes ###
             img_bytes = img_file.read()
 
-            response = self.client.analyze_document(
+            response = self._call(
+                "analyze_document",
                 Document={"Bytes": img_bytes},
                 FeatureTypes=["QUERIES"],
                 QueriesConfig={
@@ -106,8 +237,9 @@ class TextractHelper:
     def analyze_id(self, document):
         # Analyze document
         # process using S3 object
-        response = self.client.analyze_id(
-            DocumentPages=[{"S3Object": {"Bucket": self.bucket, "Name": document}}]
+        response = self._call(
+            "analyze_id",
+            DocumentPages=[{"S3Object": {"Bucket": self.bucket, "Name": document}}],
         )
 
         for doc_fields in response["IdentityDocuments"]:
@@ -131,12 +263,14 @@ class TextractHelper:
         Returns:
             str: The filename of the downloaded file.
         """
-        s3 = boto3.resource("s3")
-
-        s3.meta.client.download_file(document, filename)
+        self.s3_client.download_file(
+            self.bucket, document, filename, Config=self.transfer_config
+        )
         return filename
 
-    def multipage_pdf_to_local_images(self, document, file_prefix, tmp_folder):
+    def multipage_pdf_to_local_images(
+        self, document, file_prefix, tmp_folder, image_preparer=None
+    ):
         """
         Converts a multipage PDF document to a list of PNG images, saving them to disk with the given file prefix.
         Args:
@@ -144,12 +278,16 @@ class TextractHelper:
             :type document: str
             :param file_prefix: The prefix to use for the output PNG files.
             :type file_prefix: str
+            :param image_preparer: Renders the pages, each at the DPI chosen from its size and text density.
+                Defaults to an ImagePreparer with the default settings.
+            :type image_preparer: ImagePreparer
             :return: A list of paths to the output PNG files.
             :rtype: List[str]
         """
-        images = convert_from_path(document)
+        image_preparer = image_preparer or ImagePreparer()
         output_filenames = []
-        for i, image in enumerate(images):
+        # Pages are rendered a window at a time and saved one by one, long scans don't fill the memory
+        for i, image in enumerate(image_preparer.iter_ocr_pages(document)):
             out_img_name = file_prefix + str(i) + ".png"
             image.save(tmp_folder + "/" + out_img_name, "PNG")
             output_filenames.append(out_img_name)
@@ -169,7 +307,6 @@ class TextractHelper:
 
         inputpdf = PdfReader(open(document, "rb"))
 
-        s3_client = boto3.client("s3")
         output_filenames = []
 
         for i in range(len(inputpdf.pages)):
@@ -179,8 +316,11 @@ class TextractHelper:
             with open(output_filename, "wb") as outputStream:
                 output.write(outputStream)
             try:
-                s3_client.upload_file(
-                    output_filename, self.bucket, tmp_folder + "/" + output_filename
+                self.s3_client.upload_file(
+                    output_filename,
+                    self.bucket,
+                    tmp_folder + "/" + output_filename,
+                    Config=self.transfer_config,
                 )
                 output_filenames.append(output_filename)
             except:
@@ -201,23 +341,32 @@ class TextractHelper:
 
     def delete_s3_file(self, filenames):
         """
-        Deletes the given list of files from the S3 bucket associated with this TextractHelper instance.
+        Deletes the given files from the S3 bucket associated with this TextractHelper instance.
 
         Args:
-            :param filenames: A list of filenames to delete from the S3 bucket.
-            :type filenames: list(str)
+            :param filenames: A filename or a list of filenames to delete from the S3 bucket.
+            :type filenames: str or list(str)
         """
-        s3 = boto3.resource("s3")
-        for filename in filenames:
-            s3.Object(self.bucket_name, filename).delete()
+        if isinstance(filenames, str):
+            filenames = [filenames]
+        # delete_objects accepts at most 1000 keys per call
+        for i in range(0, len(filenames), 1000):
+            response = self.s3_client.delete_objects(
+                Bucket=self.bucket,
+                Delete={
+                    "Objects": [{"Key": key} for key in filenames[i : i + 1000]],
+                    "Quiet": True,
+                },
+            )
+            if response.get("Errors"):
+                raise S3Error(f"Problem deleting files from s3: {response['Errors']}")
 
-    def upload_file_to_s3(self, file_name):
+    def upload_file_to_s3(self, file_name, object_name=None):
         """Upload a file to an S3 bucket
 
         :param file_name: File to upload
-        :param bucket: Bucket to upload to
         :param object_name: S3 object name. If not specified then file_name is used
-        :return: True if file was uploaded, else False
+        :return: The S3 object name of the uploaded file
         """
 
         # If S3 object_name was not specified, use file_name
@@ -225,37 +374,108 @@ class TextractHelper:
             object_name = os.path.basename(file_name)
 
         # Upload the file
-        s3_client = boto3.client("s3")
         try:
-            response = s3_client.upload_file(file_name, self.bucket_name, object_name)
-            print("Upload file to s3: ", response)
+            self.s3_client.upload_file(
+                file_name, self.bucket, object_name, Config=self.transfer_config
+            )
+        except Exception as e:
+            raise S3Error(f"Problem uploading file to s3: {e}")
+        return object_name
+
+    def upload_bytes_to_s3(self, document_bytes, object_name):
+        """Upload an in-memory document to an S3 bucket
+
+        :param document_bytes: Content of the document to upload
+        :param object_name: S3 object name
+        :return: The S3 object name of the uploaded document
+        """
+        try:
+            self.s3_client.upload_fileobj(
+                io.BytesIO(document_bytes),
+                self.bucket,
+                object_name,
+                Config=self.transfer_config,
+            )
         except Exception as e:
             raise S3Error(f"Problem uploading file to s3: {e}")
-        return file_name
+        return object_name
+
+    def index_blocks(self, response):
+        """
+        Builds an index over the blocks of a response, to be shared by the result extraction methods.
+
+        Args:
+            response (dict): The response from AWS Textract.
+
+        Returns:
+            TextractBlockIndex: The index of the blocks of the response.
+        """
+        return TextractBlockIndex.from_response(response)
+
+    def get_query_answers(self, response):
+        """
+        Extracts all answers of each query, with their confidence and page number.
+
+        Args:
+            response (dict or TextractBlockIndex): The response from AWS Textract, or its index.
+
+        Returns:
+            dict: The query text mapped to a list of answers ({"text", "confidence", "page"}),
+            sorted by decreasing confidence.
+        """
+        if not isinstance(response, TextractBlockIndex):
+            response = self.index_blocks(response)
+        return response.get_query_answers()
 
     def get_query_results(self, response):
         """
         Extracts query and query result from the response and returns them as a dictionary.
+        Answers are linked to their query through the ANSWER relationships, the most confident
+        answer is kept. Queries without an answer are left out.
 
         Args:
-            response (dict): The response from AWS Textract.
+            response (dict or TextractBlockIndex): The response from AWS Textract, or its index.
 
         Returns:
             dict: A dictionary containing the query and query result extracted from the response.
         """
-        query_dict = {}
-        query = ""
-        query_result = ""
-        for block in response["Blocks"]:
-            if block["BlockType"] == "QUERY":
-                query = block["Query"]["Text"]
-            elif block["BlockType"] == "QUERY_RESULT":
-                query_result = block["Text"]
-            if query and query_result:
-                query_dict[query] = query_result
-                query = ""
-                query_result = ""
-        return query_dict
+        return {
+            query: answers[0]["text"]
+            for query, answers in self.get_query_answers(response).items()
+            if answers
+        }
+
+    def cached_query(
+        self, document_bytes, questions, query_fn, feature_types=("QUERIES",)
+    ):
+        """
+        Returns the query results of a document, asking Textract only the questions that are not cached.
+
+        Args:
+            document_bytes (bytes): The content of the document.
+            questions (list[str]): The list of queries to run on the document.
+            query_fn (Callable[[list[str]], dict]): Runs the given queries with Textract and returns
+                the result of get_query_results.
+            feature_types (tuple[str], optional): The FeatureTypes used by query_fn. Defaults to ("QUERIES",).
+
+        Returns:
+            dict: A dictionary containing the query and query result, like get_query_results.
+        """
+        if self.query_cache is None:
+            return query_fn(questions)
+
+        key = self.query_cache.document_key(document_bytes, feature_types)
+        answers, missing = self.query_cache.get(key, questions)
+        if missing:
+            query_dict = query_fn(missing)
+            self.query_cache.put(key, missing, query_dict)
+            answers.update({question: query_dict.get(question) for question in missing})
+        # Questions without an answer are left out, as in get_query_results
+        return {
+            question: answer
+            for question, answer in answers.items()
+            if answer is not None
+        }
 
     def query_each_page_pdf(self, document, file_prefix, tmp_folder, questions):
         """
@@ -291,3 +511,7 @@ class TextractHelper:
 
 class S3Error(Exception):
     pass
+
+
+class TextractJobError(Exception):
+    pass
@@ -0,0 +1,197 @@
+import time
+
+from textract.TextractHelper import TextractJobError
+
+
+class TextractJobManager:
+    """
+    Submits many documents to the asynchronous Textract API and collects their query results.
+
+    Jobs are polled with an adaptive backoff: every job starts with a short polling delay which grows
+    while the job stays IN_PROGRESS, so that short documents are picked up quickly and long ones
+    don't waste get_document_analysis calls.
+
+    Args:
+        textract_helper (TextractHelper): The helper holding the Textract client and the S3 bucket.
+        initial_delay (float, optional): Seconds to wait before the first poll of a job. Defaults to 1.0.
+        max_delay (float, optional): Upper bound of the polling delay of a job in seconds. Defaults to 30.0.
+        backoff_factor (float, optional): Factor the polling delay grows with after each IN_PROGRESS poll. Defaults to 1.5.
+        timeout (float, optional): Seconds after which a job that is still running is given up. Defaults to 1800.
+    """
+
+    FINISHED_STATUSES = ("SUCCEEDED", "PARTIAL_SUCCESS", "FAILED")
+
+    def __init__(
+        self,
+        textract_helper,
+        initial_delay=1.0,
+        max_delay=30.0,
+        backoff_factor=1.5,
+        timeout=1800,
+    ):
+        self.textract = textract_helper
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.jobs = {}
+
+    def submit(self, document, questions):
+        """
+        Starts an asynchronous query job for a document in the S3 bucket.
+
+        Args:
+            document (str): The name of the document in the S3 bucket.
+            questions (list[str]): The list of queries to run on the document.
+
+        Returns:
+            str: The JobId of the started job.
+        """
+        response = self.textract.async_query_document(document, questions)
+        job_id = response["JobId"]
+        now = time.monotonic()
+        self.jobs[job_id] = {
+            "document": document,
+            "status": "IN_PROGRESS",
+            "submitted_at": now,
+            "next_poll_at": now + self.initial_delay,
+            "delay": self.initial_delay,
+            "first_page": None,
+        }
+        return job_id
+
+    def submit_many(self, documents, questions):
+        """
+        Starts an asynchronous query job for each of the given documents.
+
+        Args:
+            documents (list[str]): The names of the documents in the S3 bucket.
+            questions (list[str]): The list of queries to run on every document.
+
+        Returns:
+            list[str]: The JobIds of the started jobs, in the order of the documents.
+        """
+        return [self.submit(document, questions) for document in documents]
+
+    def poll(self, job_id):
+        """
+        Polls a job once and updates its status and next polling time.
+
+        Args:
+            job_id (str): The JobId of the job.
+
+        Returns:
+            str: The status of the job.
+        """
+        job = self.jobs[job_id]
+        response = self.textract.get_async_query_page(job_id)
+        job["status"] = response["JobStatus"]
+
+        if job["status"] in self.FINISHED_STATUSES:
+            # The first page of the results comes with the final status, keep it to avoid fetching it again
+            job["first_page"] = response
+            if job["status"] == "FAILED":
+                job["error"] = response.get("StatusMessage", "Unknown error")
+        elif time.monotonic() - job["submitted_at"] > self.timeout:
+            job["status"] = "FAILED"
+            job["error"] = f"Job did not finish within {self.timeout} seconds"
+        else:
+            job["delay"] = min(job["delay"] * self.backoff_factor, self.max_delay)
+            job["next_poll_at"] = time.monotonic() + job["delay"]
+        return job["status"]
+
+    def wait_for_jobs(self, job_ids=None):
+        """
+        Polls the given jobs until all of them are finished, yielding each job as soon as it finishes.
+
+        Args:
+            job_ids (list[str], optional): The jobs to wait for. Defaults to all jobs that are still running.
+
+        Yields:
+            tuple[str, str]: The JobId and the final status of each finished job.
+        """
+        if job_ids is None:
+            job_ids = list(self.jobs.keys())
+        pending = set()
+        for job_id in job_ids:
+            if self.jobs[job_id]["status"] in self.FINISHED_STATUSES:
+                yield job_id, self.jobs[job_id]["status"]
+            else:
+                pending.add(job_id)
+
+        while pending:
+            next_job_id = min(pending, key=lambda j: self.jobs[j]["next_poll_at"])
+            wait = self.jobs[next_job_id]["next_poll_at"] - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+
+            status = self.poll(next_job_id)
+            if status in self.FINISHED_STATUSES:
+                pending.remove(next_job_id)
+                yield next_job_id, status
+
+    def iter_result_pages(self, job_id):
+        """
+        Streams the result pages of a finished job by following the NextToken pagination.
+
+        Args:
+            job_id (str): The JobId of a finished job.
+
+        Yields:
+            dict: The get_document_analysis responses of the job, in order.
+
+        Raises:
+            TextractJobError: If the job failed or hasn't finished yet.
+        """
+        job = self.jobs[job_id]
+        if job["status"] == "FAILED":
+            raise TextractJobError(f"Job {job_id} failed: {job['error']}")
+        if job["status"] not in self.FINISHED_STATUSES:
+            raise TextractJobError(f"Job {job_id} has not finished yet.")
+
+        page = job["first_page"]
+        if page is None:
+            page = self.textract.get_async_query_page(job_id)
+        while True:
+            yield page
+            next_token = page.get("NextToken")
+            if next_token is None:
+                break
+            page = self.textract.get_async_query_page(job_id, next_token)
+
+    def get_query_results(self, job_id):
+        """
+        Collects all result pages of a finished job and extracts the query results from them.
+
+        Args:
+            job_id (str): The JobId of a finished job.
+
+        Returns:
+            dict: A dictionary containing the query and query result extracted from the job results.
+        """
+        response = self.textract.merge_async_query_pages(self.iter_result_pages(job_id))
+        self.jobs[job_id]["first_page"] = None  # Results are consumed, release memory
+        return self.textract.get_query_results(response)
+
+    def run(self, documents, questions):
+        """
+        Submits all documents, then yields the query results of each document as soon as its job finishes.
+        Failed jobs are reported and skipped, their error is kept in self.jobs.
+
+        Args:
+            documents (list[str]): The names of the documents in the S3 bucket.
+            questions (list[str]): The list of queries to run on every document.
+
+        Yields:
+            tuple[str, dict]: The document name and its query results.
+        """
+        job_ids = self.submit_many(documents, questions)
+        for job_id, status in self.wait_for_jobs(job_ids):
+            document = self.jobs[job_id]["document"]
+            if status == "FAILED":
+                print(
+                    f"Textract job {job_id} for {document} failed: ",
+                    self.jobs[job_id]["error"],
+                )
+                continue
+            yield document, self.get_query_results(job_id)
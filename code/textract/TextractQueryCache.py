@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+class TextractQueryCache:
+    """
+    Caches Textract query results by document content and question.
+
+    Entries are keyed by the SHA-256 of the document bytes and the feature types of the analysis,
+    and hold one answer per normalized question, so that a request asking a superset of already
+    answered questions only needs the missing ones from Textract. Entries are kept in an in-memory
+    LRU tier and, if cache_dir is given, in a JSON file per document on disk. Expired answers are
+    dropped from the disk tier when their file is read and when the cache is created, see prune.
+
+    Args:
+        cache_dir (str, optional): Folder of the on-disk tier. Defaults to None (memory only).
+        ttl (float, optional): Seconds after which a cached answer expires. Defaults to 45 days.
+        max_memory_entries (int, optional): Number of documents kept in memory. Defaults to 1024.
+    """
+
+    def __init__(self, cache_dir=None, ttl=45 * 24 * 3600, max_memory_entries=1024):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_memory_entries = max_memory_entries
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.prune()
+
+    @staticmethod
+    def document_key(document_bytes, feature_types=("QUERIES",)):
+        """
+        Builds the cache key of a document.
+
+        Args:
+            document_bytes (bytes): The content of the document.
+            feature_types (tuple[str], optional): The FeatureTypes of the analysis. Defaults to ("QUERIES",).
+
+        Returns:
+            str: The cache key.
+        """
+        digest = hashlib.sha256(document_bytes).hexdigest()
+        return digest + "_" + "-".join(sorted(feature_types))
+
+    @staticmethod
+    def normalize_question(question):
+        """Normalizes whitespace and case so that trivially different questions share an entry."""
+        return " ".join(question.split()).lower()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def _fresh(self, entry, now):
+        return {
+            question: cached
+            for question, cached in entry.items()
+            if now - cached["stored_at"] <= self.ttl
+        }
+
+    def _load(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if self.cache_dir is None or not os.path.exists(self._path(key)):
+            return {}
+        with open(self._path(key), "r") as file:
+            entry = json.load(file)
+        fresh = self._fresh(entry, time.time())
+        if not fresh:
+            os.remove(self._path(key))
+            return {}
+        if len(fresh) < len(entry):
+            self._write(key, fresh)
+        self._remember(key, fresh)
+        return fresh
+
+    def _remember(self, key, entry):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def _store(self, key, entry):
+        self._remember(key, entry)
+        if self.cache_dir is not None:
+            self._write(key, entry)
+
+    def _write(self, key, entry):
+        # Write to a temporary file first, readers never see a partially written entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as file:
+            json.dump(entry, file)
+        os.replace(tmp_path, self._path(key))
+
+    def get(self, key, questions):
+        """
+        Looks up the answers of the given questions.
+
+        Args:
+            key (str): The cache key of the document.
+            questions (list[str]): The questions to look up.
+
+        Returns:
+            tuple[dict, list[str]]: The cached answers by question (None if Textract found no answer),
+            and the questions that are not cached or expired.
+        """
+        now = time.time()
+        with self.lock:
+            entry = self._load(key)
+        answers = {}
+        missing = []
+        for question in questions:
+            cached = entry.get(self.normalize_question(question))
+            if cached is not None and now - cached["stored_at"] <= self.ttl:
+                answers[question] = cached["answer"]
+            else:
+                missing.append(question)
+        with self.lock:
+            self.hits += len(answers)
+            self.misses += len(missing)
+        return answers, missing
+
+    def put(self, key, questions, query_dict):
+        """
+        Stores the answers of the given questions. Questions without an answer are cached as None.
+
+        Args:
+            key (str): The cache key of the document.
+            questions (list[str]): The questions that were sent to Textract.
+            query_dict (dict): The query results returned by get_query_results.
+        """
+        now = time.time()
+        with self.lock:
+            entry = dict(self._load(key))
+            for question in questions:
+                entry[self.normalize_question(question)] = {
+                    "answer": query_dict.get(question),
+                    "stored_at": now,
+                }
+            self._store(key, entry)
+
+    def prune(self):
+        """
+        Drops the expired answers of the disk tier, and deletes the files of documents without answers left.
+
+        Returns:
+            int: The number of deleted files.
+        """
+        if self.cache_dir is None:
+            return 0
+        now = time.time()
+        deleted = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".json"):
+                continue
+            key = name[: -len(".json")]
+            with self.lock:
+                try:
+                    with open(self._path(key), "r") as file:
+                        entry = json.load(file)
+                except (OSError, ValueError):
+                    continue
+                fresh = self._fresh(entry, now)
+                if not fresh:
+                    os.remove(self._path(key))
+                    self.memory.pop(key, None)
+                    deleted += 1
+                elif len(fresh) < len(entry):
+                    self._write(key, fresh)
+        return deleted
@@ -0,0 +1,306 @@
+import random
+import threading
+import time
+
+from botocore.exceptions import ConnectionError as BotoConnectionError, HTTPClientError
+
+# Error codes of Textract meaning the account's quota is exceeded, the call is retried later
+THROTTLING_ERROR_CODES = (
+    "ThrottlingException",
+    "ProvisionedThroughputExceededException",
+    "LimitExceededException",
+)
+# Server-side errors that are retried without slowing down, as botocore's standard retry mode does
+TRANSIENT_ERROR_CODES = (
+    "InternalServerError",
+    "InternalFailure",
+    "ServiceUnavailable",
+    "ServiceUnavailableException",
+    "RequestTimeout",
+    "RequestTimeoutException",
+)
+
+
+def get_error_code(exception):
+    """Returns the error code of a botocore ClientError, or None for other exceptions."""
+    response = getattr(exception, "response", None)
+    if not isinstance(response, dict):
+        return None
+    return response.get("Error", {}).get("Code")
+
+
+def is_transient_error(exception):
+    """
+    Checks whether an error of a Textract call is transient: a connection error or timeout, or a 5xx
+    response that isn't throttling.
+    """
+    if isinstance(exception, (BotoConnectionError, HTTPClientError)):
+        return True
+    if get_error_code(exception) in TRANSIENT_ERROR_CODES:
+        return True
+    response = getattr(exception, "response", None)
+    if not isinstance(response, dict):
+        return False
+    return response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0) >= 500
+
+
+class AdaptiveRateLimit:
+    """
+    The limits of one Textract operation: a token bucket for the calls per second and a limit of the
+    calls in flight, both adapted with AIMD. Every successful call increases the concurrency limit by
+    1 / limit (about +1 per round of calls) and the rate by rate_increase / rate (about +rate_increase
+    TPS per second). A throttled call multiplies both by decrease_factor, at most once per cooldown,
+    since the calls in flight when the quota is hit are all throttled together.
+
+    Args:
+        max_rate (float): The largest rate in calls per second, e.g. the account's quota.
+        min_rate (float, optional): Defaults to 0.2.
+        burst (float, optional): The capacity of the token bucket. Defaults to max_rate.
+        max_concurrency (int, optional): Defaults to 16.
+        min_concurrency (int, optional): Defaults to 1.
+        rate_increase (float, optional): The additive increase of the rate, in TPS per second. Defaults to 0.5.
+        decrease_factor (float, optional): The multiplicative decrease on throttling. Defaults to 0.5.
+        cooldown (float, optional): Seconds between two decreases. Defaults to 2.
+    """
+
+    def __init__(
+        self,
+        max_rate,
+        min_rate=0.2,
+        burst=None,
+        max_concurrency=16,
+        min_concurrency=1,
+        rate_increase=0.5,
+        decrease_factor=0.5,
+        cooldown=2.0,
+    ):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.burst = burst or max_rate
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.rate_increase = rate_increase
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+
+        self.condition = threading.Condition()
+        self.rate = max_rate
+        self.concurrency_limit = float(max_concurrency)
+        self.tokens = self.burst
+        self.last_refill = time.monotonic()
+        self.last_decrease = float("-inf")
+        self.in_flight = 0
+
+        # Metrics
+        self.calls = 0
+        self.throttles = 0
+        self.decreases = 0
+        self.wait_time = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.last_refill) * self.rate
+        )
+        self.last_refill = now
+
+    def acquire(self):
+        """
+        Waits for a slot under the concurrency limit and a token of the bucket.
+
+        Returns:
+            float: The seconds waited.
+        """
+        start_time = time.monotonic()
+        with self.condition:
+            while self.in_flight >= int(self.concurrency_limit):
+                self.condition.wait()
+            self.in_flight += 1
+            self._refill()
+            # A missing token is reserved, the caller sleeps until it is refilled
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+        waited = time.monotonic() - start_time
+        with self.condition:
+            self.calls += 1
+            self.wait_time += waited
+        return waited
+
+    def release(self, throttled, adapt=True):
+        """
+        Frees the slot of a finished call and adapts the limits.
+
+        Args:
+            throttled (bool): Whether the call was throttled.
+            adapt (bool, optional): Whether a call that wasn't throttled increases the limits, False for
+                calls that failed otherwise. Defaults to True.
+        """
+        with self.condition:
+            self.in_flight -= 1
+            self._refill()
+            if throttled:
+                self.throttles += 1
+                now = time.monotonic()
+                if now - self.last_decrease >= self.cooldown:
+                    self.last_decrease = now
+                    self.decreases += 1
+                    self.concurrency_limit = max(
+                        self.min_concurrency,
+                        self.concurrency_limit * self.decrease_factor,
+                    )
+                    self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+                    # The bucket doesn't hold more than a second of the new rate
+                    self.tokens = min(self.tokens, self.rate)
+            elif adapt:
+                self.concurrency_limit = min(
+                    self.max_concurrency,
+                    self.concurrency_limit + 1 / self.concurrency_limit,
+                )
+                self.rate = min(
+                    self.max_rate, self.rate + self.rate_increase / self.rate
+                )
+            self.condition.notify_all()
+
+    def metrics(self):
+        with self.condition:
+            return {
+                "rate": self.rate,
+                "concurrency_limit": int(self.concurrency_limit),
+                "in_flight": self.in_flight,
+                "calls": self.calls,
+                "throttles": self.throttles,
+                "decreases": self.decreases,
+                "wait_time": self.wait_time,
+                "wait_mean": self.wait_time / self.calls if self.calls else None,
+            }
+
+
+class TextractRateLimiter:
+    """
+    Client-side rate limiting of the Textract calls of the process, shared by all threads. Each operation
+    (analyze_document, start_document_analysis, get_document_analysis, analyze_id...) has its own quota
+    and its own AdaptiveRateLimit. Throttled calls are retried with exponential backoff and jitter, and
+    slow the operation down instead of failing the request. Transient errors (connection errors, timeouts
+    and 5xx responses) are retried the same way without slowing down, the Textract client doesn't retry
+    when a limiter is used. Retried calls must be idempotent, e.g. start_document_analysis with a
+    ClientRequestToken.
+
+    Args:
+        max_rates (dict, optional): The largest rate of each operation in calls per second, operations
+            not listed use default_max_rate. Defaults to None.
+        default_max_rate (float, optional): Defaults to 1.
+        max_retries (int, optional): Retries of a throttled or failed call before its error is raised. Defaults to 6.
+        backoff (float, optional): Seconds before the first retry, doubled for each retry. Defaults to 0.5.
+        max_backoff (float, optional): Upper bound of the backoff in seconds. Defaults to 20.
+        **limit_kwargs: Passed to the AdaptiveRateLimit of each operation, e.g. max_concurrency.
+    """
+
+    def __init__(
+        self,
+        max_rates=None,
+        default_max_rate=1.0,
+        max_retries=6,
+        backoff=0.5,
+        max_backoff=20.0,
+        **limit_kwargs,
+    ):
+        self.max_rates = max_rates or {}
+        self.default_max_rate = default_max_rate
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.limit_kwargs = limit_kwargs
+        self.lock = threading.Lock()
+        self.limits = {}
+        self.retries = {}
+        self.backoff_time = {}
+        self.failures = {}
+        self.transient_errors = {}
+
+    def get_limit(self, operation):
+        with self.lock:
+            if operation not in self.limits:
+                self.limits[operation] = AdaptiveRateLimit(
+                    self.max_rates.get(operation, self.default_max_rate),
+                    **self.limit_kwargs,
+                )
+                self.retries[operation] = 0
+                self.backoff_time[operation] = 0.0
+                self.failures[operation] = 0
+                self.transient_errors[operation] = 0
+            return self.limits[operation]
+
+    def call(self, operation, fn, *args, **kwargs):
+        """
+        Calls a Textract operation within its limits, retrying it while it is throttled or fails with a
+        transient error.
+
+        Args:
+            operation (str): The name of the operation, e.g. "analyze_document".
+            fn (Callable): The client method of the operation.
+            *args, **kwargs: The arguments of the call.
+
+        Returns:
+            Any: The response of the call.
+
+        Raises:
+            Exception: The error of the call, or the throttling or transient error once the retries are exhausted.
+        """
+        limit = self.get_limit(operation)
+        for attempt in range(self.max_retries + 1):
+            limit.acquire()
+            throttled = False
+            failed = False
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                failed = True
+                throttled = get_error_code(e) in THROTTLING_ERROR_CODES
+                if not throttled and not is_transient_error(e):
+                    raise
+                if attempt == self.max_retries:
+                    with self.lock:
+                        self.failures[operation] += 1
+                    raise
+                reason = "throttled" if throttled else f"failed ({e})"
+            finally:
+                limit.release(throttled, adapt=not failed)
+
+            delay = min(self.max_backoff, self.backoff * 2**attempt)
+            delay *= random.uniform(0.5, 1.0)
+            if attempt == 0:
+                # Once per call, the retries and backoff are in the metrics
+                print(
+                    f"Textract {operation} {reason}, retrying up to {self.max_retries} times"
+                )
+            with self.lock:
+                if not throttled:
+                    self.transient_errors[operation] += 1
+                self.retries[operation] += 1
+                self.backoff_time[operation] += delay
+            time.sleep(delay)
+
+    def metrics(self):
+        """
+        Returns the current rate and concurrency limit, the calls, throttle events, retried transient errors,
+        retries, calls that failed after all retries, and the time spent waiting for the limits and in
+        backoff, per operation.
+
+        Returns:
+            dict: The metrics of each operation.
+        """
+        with self.lock:
+            operations = list(self.limits.items())
+        metrics = {}
+        for operation, limit in operations:
+            metrics[operation] = limit.metrics()
+            with self.lock:
+                metrics[operation]["retries"] = self.retries[operation]
+                metrics[operation]["backoff_time"] = self.backoff_time[operation]
+                metrics[operation]["failures"] = self.failures[operation]
+                metrics[operation]["transient_errors"] = self.transient_errors[
+                    operation
+                ]
+        return metrics